@@ -0,0 +1 @@
+"""Benchmarks for kritis-reverse-proxy hot paths. Run with ``make bench``."""
@@ -0,0 +1,145 @@
+"""Offline admission load test against fake registries and a fake Kritis.
+
+Replays AdmissionReviews of the test deployments through the proxy, first
+once each against a cold digest cache, then round-robin against the warm
+cache. Results are compared to a stored baseline, exiting with status 1 when
+admissions/s, p50 or p99 latency regress by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+
+from benchmarks import fixtures, loadgen
+from tag_resolver_proxy import fakes
+
+
+KRITIS_PORT = 9561
+QUAY_PORT = 9562
+DOCKER_PORT = 9563
+PROXY_PORT = 9564
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Result metrics, and whether a higher value is better
+METRICS = {'rate': True, 'p50': False, 'p99': False}
+
+arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+arg_parser.add_argument('--concurrency', help='Concurrent admission clients', type=int, default=32)
+arg_parser.add_argument('--duration', help='Seconds of warm cache load', type=float, default=5)
+arg_parser.add_argument('--variants', help='Copies of each test deployment, with distinct tags', type=int, default=20)
+arg_parser.add_argument('--registry-latency', help='Seconds fake registries take per request', type=float, default=0.02)
+arg_parser.add_argument('--kritis-latency', help='Seconds fake Kritis takes per admission', type=float, default=0.005)
+arg_parser.add_argument('--error-rate', help='Fraction of fake registry and Kritis requests failing with HTTP 500',
+                        type=float, default=0.0)
+arg_parser.add_argument('--baseline', help='Baseline results file', default=BASELINE_FILE)
+arg_parser.add_argument('--save-baseline', help='Store results as baseline instead of comparing',
+                        action='store_true', default=False)
+arg_parser.add_argument('--tolerance', help='Allowed fraction of regression against baseline', type=float,
+                        default=0.25)
+
+
+def test_file(name: str) -> str:
+    return os.path.join(fakes.TEST_DIR, name)
+
+
+def run_proxy():
+    """Serve the proxy in current process, with registries pointed to the fakes."""
+    os.environ['KRITIS_REVERSE_PROXY_NO_SSL'] = '1'
+    from tag_resolver_proxy.resolve_tags import docker_io, quay_io
+    import tag_resolver_proxy.__main__
+
+    quay_io.QuayIOTagResolver.api_base_uri = f'http://127.0.0.1:{QUAY_PORT}'
+    docker_io.DockerIOTagResolver.api_base_uri = f'http://127.0.0.1:{DOCKER_PORT}'
+    docker_io.DockerIOTagResolver.auth_url = f'http://127.0.0.1:{DOCKER_PORT}'
+
+    sys.argv = [
+        'tag_resolver_proxy',
+        '--port', str(PROXY_PORT),
+        '--log-level', 'ERROR',
+        '--upstream-uri', f'127.0.0.1:{KRITIS_PORT}',
+        '--quay-token-file', test_file('quay.token'),
+        '--tls-cert-file', test_file('server.crt'), '--tls-key-file', test_file('server.key'),
+        '--client-cert-file', test_file('kritis.crt'), '--client-key-file', test_file('kritis.key'),
+        '--client-ca-cert-file', test_file('ca.crt'),
+    ]
+    tag_resolver_proxy.__main__.main()
+
+
+def summary(result: loadgen.LoadResult) -> dict:
+    return {'rate': result.rate, 'p50': result.percentile(0.5), 'p99': result.percentile(0.99),
+            'errors': result.errors}
+
+
+async def measure(args) -> dict:
+    url = f'http://127.0.0.1:{PROXY_PORT}/'
+    await loadgen.wait_ready(f'{url}metrics')
+    reviews = fixtures.deployment_reviews(args.variants)
+    cold = await loadgen.replay(url, reviews, args.concurrency)
+    print(f'cold cache: {cold}')
+    warm = await loadgen.run_load(url, reviews, args.concurrency, args.duration)
+    print(f'warm cache: {warm}')
+    return {'cold': summary(cold), 'warm': summary(warm)}
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Descriptions of results worse than baseline by more than tolerance."""
+    found = []
+    for phase, metrics in baseline.items():
+        for metric, higher_is_better in METRICS.items():
+            expected, actual = metrics[metric], results[phase][metric]
+            limit = expected * (1 - tolerance) if higher_is_better else expected * (1 + tolerance)
+            if (actual < limit) if higher_is_better else (actual > limit):
+                found.append(f'{phase} {metric} {actual:.4f}, baseline {expected:.4f}')
+    return found
+
+
+def main(argv=None) -> int:
+    args = arg_parser.parse_args(argv)
+    settings = {name: getattr(args, name) for name in
+                ('concurrency', 'duration', 'variants', 'registry_latency', 'kritis_latency', 'error_rate')}
+
+    processes = [
+        multiprocessing.Process(target=fakes.run_kritis, args=(KRITIS_PORT, args.kritis_latency, args.error_rate),
+                                daemon=True),
+        multiprocessing.Process(target=fakes.run_registries,
+                                args=(QUAY_PORT, DOCKER_PORT, args.registry_latency, args.error_rate), daemon=True),
+    ]
+    for process in processes:
+        process.start()
+    proxy = multiprocessing.Process(target=run_proxy)
+    proxy.start()
+    try:
+        results = asyncio.get_event_loop().run_until_complete(measure(args))
+    finally:
+        os.kill(proxy.pid, signal.SIGTERM)
+        proxy.join()
+        for process in processes:
+            process.terminate()
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'settings': settings, 'results': results}, baseline_file, indent=2, sort_keys=True)
+        print(f'Stored baseline in {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline in {args.baseline}, store one with --save-baseline')
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['settings'] != settings:
+        print(f'Baseline {args.baseline} was recorded with other settings: {baseline["settings"]}')
+        return 2
+
+    found = regressions(results, baseline['results'], args.tolerance)
+    for regression in found:
+        print(f'Regression: {regression}')
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
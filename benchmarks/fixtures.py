@@ -0,0 +1,87 @@
+"""Synthetic AdmissionReview fixtures of a given size, and replays of test deployments."""
+import copy
+import glob
+import json
+import os
+
+import yaml
+
+from tag_resolver_proxy.fakes import TEST_DIR, fake_digest
+
+
+def container(index: int, env_size: int) -> dict:
+    return {
+        'name': f'sidecar-{index}',
+        'image': f'quay.io/test/sidecar-{index}:1.0.{index}',
+        'command': ['/bin/sleep', 'infinity'],
+        'env': [{'name': f'VAR_{index}_{n}', 'value': 'x' * 64} for n in range(env_size)],
+        'resources': {'requests': {'cpu': '0m', 'memory': '0M'}, 'limits': {'cpu': '0m', 'memory': '0M'}},
+    }
+
+
+def admission_review(size: int, containers: int = 4, env_size: int = 0) -> dict:
+    """Build a Deployment AdmissionReview whose JSON encoding is at least ``size`` bytes."""
+    review = {
+        'kind': 'AdmissionReview',
+        'apiVersion': 'admission.k8s.io/v1beta1',
+        'request': {
+            'uid': 'benchmark',
+            'userInfo': {'username': 'benchmark'},
+            'object': {
+                'apiVersion': 'apps/v1',
+                'kind': 'Deployment',
+                'metadata': {'name': 'benchmark', 'namespace': 'benchmark'},
+                'spec': {
+                    'replicas': 1,
+                    'template': {'spec': {
+                        'containers': [container(n, env_size) for n in range(containers)],
+                    }},
+                },
+            },
+        },
+    }
+    encoded = len(json.dumps(review))
+    if encoded >= size:
+        return review
+    per_env = len(json.dumps(container(0, 1))) - len(json.dumps(container(0, 0)))
+    return admission_review(size, containers, env_size + max(1, (size - encoded) // (per_env * containers)))
+
+
+SIZES = {'1KB': 1024, '50KB': 50 * 1024, '500KB': 500 * 1024}
+
+
+def pin_images(review: dict) -> dict:
+    """Replace container image tags with digests, so the proxy resolves nothing."""
+    for container_spec in review['request']['object']['spec']['template']['spec']['containers']:
+        repository, tag = container_spec['image'].rsplit(':', 1)
+        container_spec['image'] = f'{repository}@{fake_digest(repository, tag)}'
+    return review
+
+
+def deployment_reviews(variants: int) -> list:
+    """AdmissionReviews of the test deployments, each in `variants` copies.
+
+    The first copy keeps the deployment as is, the others tag its images `1.0.1` .. `1.0.{variants-1}`,
+    so a cold cache has a lookup to make for every copy.
+    """
+    reviews = []
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, 'deployments', '*.yaml'))):
+        with open(path) as deployment_file:
+            deployment = yaml.load(deployment_file, Loader=yaml.SafeLoader)
+        for n in range(variants):
+            variant = copy.deepcopy(deployment)
+            if n:
+                for container_spec in variant['spec']['template']['spec']['containers']:
+                    container_spec['image'] = f'{container_spec["image"].rsplit(":", 1)[0]}:1.0.{n}'
+            reviews.append({
+                'kind': 'AdmissionReview',
+                'apiVersion': 'admission.k8s.io/v1beta1',
+                'request': {
+                    'uid': f'{os.path.basename(path)}-{n}',
+                    'namespace': variant['metadata'].get('namespace'),
+                    'operation': 'CREATE',
+                    'userInfo': {'username': 'benchmark'},
+                    'object': variant,
+                },
+            })
+    return reviews
@@ -0,0 +1,49 @@
+"""CPU per admission spent finding container images in the AdmissionReview.
+
+Compares the previous walk over ``spec.containers`` and
+``spec.template.spec.containers`` only with
+``tag_resolver_proxy.process.container_specs``, which also covers init and
+ephemeral containers and CronJob pod templates.
+"""
+import time
+
+from benchmarks.fixtures import admission_review
+from tag_resolver_proxy import process
+
+ROUNDS = 20_000
+
+
+def previous_container_specs(request_payload):
+    spec = request_payload['request']['object']['spec']
+    yield from spec.get('containers', [])
+    if 'template' in spec:
+        yield from spec['template']['spec'].get('containers', [])
+
+
+def images_before(request_payload) -> list:
+    return [container_spec['image'] for container_spec in previous_container_specs(request_payload)]
+
+
+def images_after(request_payload) -> list:
+    return [container_spec['image'] for container_spec in process.container_specs(request_payload)]
+
+
+def cpu_per_call(func, request_payload) -> float:
+    started = time.process_time()
+    for _ in range(ROUNDS):
+        func(request_payload)
+    return (time.process_time() - started) / ROUNDS
+
+
+def main():
+    for containers in (4, 16, 64):
+        review = admission_review(0, containers=containers, env_size=16)
+        assert images_before(review) == images_after(review)
+        before = cpu_per_call(images_before, review)
+        after = cpu_per_call(images_after, review)
+        print(f'{containers:>3} containers: previous walk {before * 1e6:6.2f} us, '
+              f'all containers {after * 1e6:6.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Closed-loop admission load generator."""
+import asyncio
+import itertools
+import json
+import time
+import typing
+
+import aiohttp
+
+
+class LoadResult:
+
+    def __init__(self, latencies: list, errors: int, elapsed: float):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return float('nan')
+        return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * fraction))]
+
+    @property
+    def rate(self) -> float:
+        return len(self.latencies) / self.elapsed
+
+    def __str__(self):
+        return (f'{self.rate:8.1f} admissions/s, p50 {self.percentile(0.5) * 1e3:7.2f} ms, '
+                f'p99 {self.percentile(0.99) * 1e3:7.2f} ms, {self.errors} errors')
+
+
+async def _post(session: aiohttp.ClientSession, url: str, body: bytes) -> typing.Optional[float]:
+    """POST AdmissionReview, returning its latency, None on failure."""
+    started = time.perf_counter()
+    try:
+        async with session.post(url, data=body, headers={'Content-Type': 'application/json'}) as resp:
+            response = await resp.json()
+            if resp.status != 200 or 'response' not in response:
+                return None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return None
+    return time.perf_counter() - started
+
+
+async def _run_clients(url: str, bodies: typing.Iterator[bytes], concurrency: int, deadline: float) -> LoadResult:
+    latencies = []
+    errors = 0
+
+    async def client(session):
+        nonlocal errors
+        for body in bodies:
+            if time.perf_counter() >= deadline:
+                break
+            latency = await _post(session, url, body)
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency, ssl=False)) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    return LoadResult(latencies, errors, time.perf_counter() - started)
+
+
+async def run_load(url: str, reviews: list, concurrency: int, duration: float) -> LoadResult:
+    """POST AdmissionReviews round-robin from `concurrency` clients for `duration` seconds."""
+    bodies = itertools.cycle([json.dumps(review).encode() for review in reviews])
+    return await _run_clients(url, bodies, concurrency, time.perf_counter() + duration)
+
+
+async def replay(url: str, reviews: list, concurrency: int) -> LoadResult:
+    """POST every AdmissionReview once, from `concurrency` clients."""
+    bodies = iter([json.dumps(review).encode() for review in reviews])
+    return await _run_clients(url, bodies, concurrency, float('inf'))
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    """Wait for proxy to serve given URL."""
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
+        while True:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'{url} is not ready after {timeout} seconds')
+            await asyncio.sleep(0.1)
+
+
+__all__ = ['LoadResult', 'replay', 'run_load', 'wait_ready']
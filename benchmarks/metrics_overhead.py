@@ -0,0 +1,70 @@
+"""CPU per admission spent on latency and decision instrumentation.
+
+Times the metric calls an admission makes, on their own: request timings set
+up by `webhook_middleware`, `metrics.observe_stage` for each stage, a tag
+resolution histogram observation per container and the decision counter.
+Timing whole admissions with and without metrics is too noisy to tell a few
+microseconds apart. Exits with status 1 when instrumentation takes longer than
+`BOUND_SECONDS` plus `BOUND_PER_CONTAINER_SECONDS` per container.
+"""
+import sys
+import time
+import timeit
+
+from aiohttp import test_utils
+
+from tag_resolver_proxy import metrics, reverse_proxy
+from tag_resolver_proxy.resolve_tags import base, init_registries
+
+ROUNDS = 20_000
+REPEATS = 7
+STAGES = ('parse', 'whitelist', 'resolve', 'upstream', 'total')
+
+# Instrumentation budget of an admission
+BOUND_SECONDS = 10e-6
+BOUND_PER_CONTAINER_SECONDS = 2e-6
+
+
+def instrument_admission(request, resolver: base.TagResolver, containers: int):
+    """Metric calls of an admission of `containers` cached images, as the proxy makes them."""
+    request['timings'] = {}
+    for stage in STAGES[:2]:
+        metrics.observe_stage(request, stage, time.perf_counter())
+    for _ in range(containers):
+        started = time.perf_counter()
+        elapsed = time.perf_counter() - started
+        resolution_seconds = resolver.resolution_seconds.get('hit')
+        if resolution_seconds is None:
+            resolution_seconds = resolver.resolution_seconds['hit'] = \
+                base.TAG_RESOLUTION_SECONDS.labels(resolver.registry_base_uri, 'hit')
+        resolution_seconds.observe(elapsed)
+    for stage in STAGES[2:]:
+        metrics.observe_stage(request, stage, time.perf_counter())
+    reverse_proxy.DECISIONS['allow'].inc()
+
+
+def seconds_per_admission(containers: int) -> float:
+    request = test_utils.make_mocked_request('POST', '/')
+    resolver = base.ResolverMeta.resolvers['quay.io']
+    # Like all of timeit, runs with garbage collection disabled
+    timer = timeit.Timer(lambda: instrument_admission(request, resolver, containers))
+    return min(timer.repeat(REPEATS, ROUNDS)) / ROUNDS
+
+
+def main() -> int:
+    init_registries()
+    exceeded = False
+    for containers in (1, 4, 16):
+        elapsed = seconds_per_admission(containers)
+        bound = BOUND_SECONDS + containers * BOUND_PER_CONTAINER_SECONDS
+        exceeded = exceeded or elapsed > bound
+        print(f'{containers:>3} containers: {elapsed * 1e6:5.1f} us of metrics per admission, '
+              f'bound {bound * 1e6:.0f} us')
+    started = time.process_time()
+    body = metrics.REGISTRY.render()
+    print(f'/metrics render: {(time.process_time() - started) * 1e3:.2f} ms, {len(body)} bytes')
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""CPU per admission spent decoding the AdmissionReview body.
+
+Compares the previous behaviour (``request.json()`` in the whitelist
+middleware and again in the handler) with a single decode shared through
+``tag_resolver_proxy.payload``.
+"""
+import json
+import time
+
+from benchmarks.fixtures import SIZES, admission_review
+from tag_resolver_proxy import payload
+
+
+def cpu_per_call(func, body: bytes, rounds: int) -> float:
+    started = time.process_time()
+    for _ in range(rounds):
+        func(body)
+    return (time.process_time() - started) / rounds
+
+
+def decode_twice(body: bytes):
+    json.loads(body.decode())
+    json.loads(body.decode())
+
+
+def decode_once(body: bytes):
+    payload.AdmissionPayload(body)
+
+
+def main():
+    backend = 'orjson' if payload.orjson is not None else 'json'
+    print(f'JSON backend: {backend}')
+    for label, size in SIZES.items():
+        body = json.dumps(admission_review(size)).encode()
+        rounds = max(10, 2_000_000 // len(body))
+        before = cpu_per_call(decode_twice, body, rounds)
+        after = cpu_per_call(decode_once, body, rounds)
+        print(f'{label:>6} ({len(body)} bytes): '
+              f'decode x2 {before * 1e6:9.1f} us, decode x1 {after * 1e6:9.1f} us, '
+              f'{before / after:5.1f}x less CPU')
+
+
+if __name__ == '__main__':
+    main()
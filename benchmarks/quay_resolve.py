@@ -0,0 +1,40 @@
+"""Quay digest lookup cost per resolve mode, against a local fake Quay."""
+import asyncio
+import time
+
+from tag_resolver_proxy import fakes
+from tag_resolver_proxy.resolve_tags import base, quay_io
+
+
+async def measure(fake_quay: fakes.FakeQuay, api_base_uri: str, mode: str, lookups: int) -> (float, float):
+    resolver = quay_io.QuayIOTagResolver(None, resolve_mode=mode)
+    resolver.api_base_uri = api_base_uri
+    resolver.ensure_client()
+
+    fake_quay.bytes_sent = 0
+    started = time.perf_counter()
+    for n in range(lookups):
+        image = base.ResolverMeta.for_image_url(f'quay.io/test/software:1.0.{n}')
+        resolved = await resolver.resolve_single_image(image)
+        assert resolved.endswith(fakes.fake_digest('test/software', f'1.0.{n}')), resolved
+    elapsed = time.perf_counter() - started
+
+    await resolver.client.close()
+    return elapsed / lookups, fake_quay.bytes_sent / lookups
+
+
+async def main():
+    for tags in (100, 1000, 5000):
+        fake_quay = fakes.FakeQuay(tags_per_repository=tags)
+        runner, api_base_uri = await fakes.serve(fake_quay.app())
+        lookups = min(tags, 50)
+        try:
+            for mode in quay_io.QuayIOTagResolver.resolve_modes:
+                latency, transferred = await measure(fake_quay, api_base_uri, mode, lookups)
+                print(f'{tags:>5} tags, {mode:>10} mode: {latency * 1e3:8.2f} ms, {transferred:11.0f} bytes per lookup')
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,80 @@
+"""Image reference parsing cost per image, on a corpus of real image references.
+
+Compares the previous ``split``-based parser, which rejects or mis-parses some of
+the corpus, with the reference grammar parser, uncached and with its parse cache.
+"""
+import time
+
+from tag_resolver_proxy.resolve_tags import base, reference
+
+
+DIGEST = 'sha256:e8f497444c8d663da3c8a7e4ea58d16f1b130c1122c098b9946cd23dca0f9aab'
+
+CORPUS = [
+    'nginx:1.19.0',
+    'busybox:1.31.1',
+    'redis:6.0.5-alpine',
+    'tutum/curl:trusty',
+    'bitnami/postgresql:11.8.0-debian-10-r19',
+    'docker.io/library/alpine:3.12',
+    'docker.io/calico/node:v3.14.1',
+    'quay.io/prometheus/node-exporter:v1.0.1',
+    'quay.io/coreos/etcd:v3.4.9',
+    'quay.io/jetstack/cert-manager-controller:v0.15.1',
+    'k8s.gcr.io/pause:3.2',
+    'k8s.gcr.io/kube-proxy:v1.18.3',
+    'gcr.io/google-containers/cluster-proportional-autoscaler-amd64:1.7.1',
+    'registry.gitlab.com/gitlab-org/gitlab-runner/gitlab-runner-helper:x86_64-4c96e5ad',
+    'mcr.microsoft.com/oss/kubernetes/ingress/nginx-ingress-controller:0.34.1',
+    'localhost:5000/team/app:1.2.3',
+    f'quay.io/calico/node@{DIGEST}',
+    f'docker.io/calico/node:v3.14.1@{DIGEST}',
+]
+
+
+def legacy_parse(image_url):
+    """Parser before reference grammar support, without resolver lookup and validation."""
+    repo, tag = image_url.split(':')
+    parts = repo.split('/')
+    if len(parts) == 1:
+        return image_url, 'docker.io', 'library', parts[0], tag
+    if len(parts) == 2:
+        software, org = parts
+        return image_url, 'docker.io', org, software, tag
+    if len(parts) == 3:
+        domain, org, software = parts
+        return image_url, domain, org, software, tag
+    raise AssertionError('An image URL must have format hub/org/software')
+
+
+def ns_per_image(parse, images, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for image in images:
+            parse(image)
+    return (time.perf_counter() - started) / rounds / len(images) * 1e9
+
+
+def main():
+    legacy_corpus = []
+    for image in CORPUS:
+        try:
+            legacy_parse(image)
+            legacy_corpus.append(image)
+        except (AssertionError, ValueError) as exc:
+            print(f'previous parser rejects {image}: {exc!r}')
+
+    rounds = 2000
+    base.parse_image_url.cache_clear()
+    for label, parse, images in [
+        ('previous', legacy_parse, legacy_corpus),
+        ('grammar', reference.parse, legacy_corpus),
+        ('grammar, cached', base.parse_image_url, legacy_corpus),
+        ('grammar, whole corpus', reference.parse, CORPUS),
+        ('grammar, whole corpus, cached', base.parse_image_url, CORPUS),
+    ]:
+        print(f'{label:>30}: {ns_per_image(parse, images, rounds):7.0f} ns per image')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Per-image whitelist check cost as the whitelist grows.
+
+Compares the previous behaviour (``str.startswith`` against every
+whitelisted repository) with the path segment trie of
+``tag_resolver_proxy.white_list``, for an image which is not whitelisted,
+the worst case of both.
+"""
+import time
+
+from tag_resolver_proxy import white_list
+
+IMAGE = 'quay.io/verygoodsecurity/payments:1.2.3'
+ROUNDS = 20_000
+
+
+def whitelist(size: int) -> list:
+    return [f'registry-{n}.example.com/org-{n}' for n in range(size)]
+
+
+def startswith_any(repositories, image: str) -> bool:
+    for repository in repositories:
+        if image.startswith(repository):
+            return True
+    return False
+
+
+def cpu_per_call(func, *args) -> float:
+    started = time.process_time()
+    for _ in range(ROUNDS):
+        func(*args)
+    return (time.process_time() - started) / ROUNDS
+
+
+def main():
+    for size in (10, 100, 1000, 10000):
+        repositories = whitelist(size)
+        resolver = white_list.ImageWhitelistResolver(repositories)
+        before = cpu_per_call(startswith_any, repositories, IMAGE)
+        after = cpu_per_call(resolver.is_whitelisted, IMAGE)
+        print(f'{size:>6} entries: startswith {before * 1e6:9.2f} us, trie {after * 1e6:6.2f} us per image')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Admission throughput of `python -m tag_resolver_proxy --workers N`.
+
+Runs the proxy in a subprocess against a fake Kritis, with digest-pinned images,
+so the numbers reflect body handling, TLS to upstream and worker scaling.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+
+from benchmarks import fixtures, loadgen
+from tag_resolver_proxy import fakes
+
+
+KRITIS_PORT = 9551
+PROXY_PORT = 9552
+DURATION = 5
+CONCURRENCY = 64
+
+
+def test_file(name: str) -> str:
+    return os.path.join(fakes.TEST_DIR, name)
+
+
+def start_proxy(workers: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [
+            sys.executable, '-m', 'tag_resolver_proxy',
+            '--workers', str(workers),
+            '--port', str(PROXY_PORT),
+            '--upstream-uri', f'127.0.0.1:{KRITIS_PORT}',
+            '--tls-cert-file', test_file('server.crt'), '--tls-key-file', test_file('server.key'),
+            '--client-cert-file', test_file('kritis.crt'), '--client-key-file', test_file('kritis.key'),
+            '--client-ca-cert-file', test_file('ca.crt'),
+        ],
+        env=dict(os.environ, KRITIS_REVERSE_PROXY_NO_SSL='1'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+async def measure(workers: int) -> loadgen.LoadResult:
+    proxy = start_proxy(workers)
+    try:
+        await loadgen.wait_ready(f'http://127.0.0.1:{PROXY_PORT}/metrics')
+        reviews = [fixtures.pin_images(fixtures.admission_review(8 * 1024))]
+        return await loadgen.run_load(f'http://127.0.0.1:{PROXY_PORT}/', reviews, CONCURRENCY, DURATION)
+    finally:
+        proxy.send_signal(signal.SIGTERM)
+        proxy.wait()
+
+
+def main():
+    kritis = multiprocessing.Process(target=fakes.run_kritis, args=(KRITIS_PORT,), daemon=True)
+    kritis.start()
+    try:
+        print(f'{os.cpu_count()} CPUs available')
+        for workers in (1, 2, 4):
+            result = asyncio.get_event_loop().run_until_complete(measure(workers))
+            print(f'{workers} workers: {result}')
+    finally:
+        kritis.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,140 @@
+import copy
 import logging
+import signal
 import ssl
 import os
+import shutil
+import tempfile
+import time
 
 import aiohttp.web
 
 import tag_resolver_proxy.arguments
+import tag_resolver_proxy.logs
 import tag_resolver_proxy.resolve_tags
 import tag_resolver_proxy.webapp
 
 
 NOSSL = os.environ.get('KRITIS_REVERSE_PROXY_NO_SSL', False)
 
+logger = logging.getLogger(__name__)
+
+# Seconds a worker must have served for to be replaced when it dies, rather than stopping all workers
+WORKER_MIN_UPTIME = 10
+
+
+def serve(args, ssl_ctx, reuse_port=False):
+    """Run proxy application in current process until terminated."""
+    tag_resolver_proxy.resolve_tags.init_registries(
+        args.cache_backend,
+        max_entries=args.cache_max_entries,
+        max_bytes=args.cache_max_bytes,
+        ttl=args.cache_ttl,
+        negative_ttl=args.cache_negative_ttl,
+        jitter=args.cache_ttl_jitter,
+        stale_while_revalidate=args.cache_stale_while_revalidate,
+        stale_if_error=args.cache_stale_if_error,
+    )
+
+    aiohttp.web.run_app(
+        tag_resolver_proxy.webapp.app(args),
+        port=args.port, ssl_context=ssl_ctx if not NOSSL else None,
+        reuse_port=reuse_port, shutdown_timeout=args.shutdown_timeout,
+    )
+
+
+def spawn_worker(args, ssl_ctx) -> int:
+    """Fork a worker process serving the proxy, returning its pid."""
+    # Stop the log writer thread while forking, so no worker inherits a lock it holds
+    tag_resolver_proxy.logs.stop_logging()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        # Signal handlers of the parent are inherited by replaced workers
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        tag_resolver_proxy.logs.setup_logging(args.log_format, args.log_level)
+        try:
+            serve(args, ssl_ctx, reuse_port=True)
+        except BaseException:
+            logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            tag_resolver_proxy.logs.stop_logging()
+            os._exit(status)
+    tag_resolver_proxy.logs.setup_logging(args.log_format, args.log_level)
+    return pid
+
+
+def serve_workers(args, ssl_ctx) -> int:
+    """Fork worker processes sharing the listening port with SO_REUSEPORT.
+
+    Only the first worker warms up the digest cache, the others find its digests
+    in the shared cache. A worker which dies is replaced, unless it ran for less than
+    WORKER_MIN_UPTIME seconds: then all workers are stopped, so the pod restarts.
+    SIGTERM is forwarded to workers, which stop accepting connections
+    and drain in-flight admissions for up to --shutdown-timeout seconds.
+    Returns the first non-zero worker exit status.
+    """
+    shared_cache_dir = None
+    if args.cache_backend == 'memory':
+        # Workers share resolved digests through a sqlite file, removed once they exit
+        shared_cache_dir = tempfile.mkdtemp(prefix='kritis-reverse-proxy-')
+        args.cache_backend = f'sqlite://{shared_cache_dir}/digests.db'
+        logger.info('Sharing digest cache between workers with %s', args.cache_backend)
+
+    cold_args = copy.copy(args)
+    cold_args.warm_repository = []
+    cold_args.warm_images_file = None
+
+    # Start time of worker processes by pid
+    workers = {}
+    for index in range(args.workers):
+        workers[spawn_worker(args if index == 0 else cold_args, ssl_ctx)] = time.monotonic()
+    logger.info('Started workers %s', list(workers))
+
+    stopping = False
+
+    def terminate(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for worker in workers:
+            try:
+                os.kill(worker, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    # Terminal interrupts reach the whole process group, workers handle them on their own
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    exit_status = 0
+    try:
+        while workers:
+            worker, status = os.wait()
+            started = workers.pop(worker, None)
+            if started is None:
+                continue
+            worker_status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+            if stopping:
+                exit_status = exit_status or worker_status
+            elif time.monotonic() - started < WORKER_MIN_UPTIME:
+                logger.error('Worker %d exited with status %d right after start, stopping', worker, worker_status)
+                exit_status = worker_status or 1
+                terminate(signal.SIGTERM, None)
+            else:
+                logger.warning('Worker %d exited with status %d, replacing it', worker, worker_status)
+                workers[spawn_worker(cold_args, ssl_ctx)] = time.monotonic()
+    finally:
+        if shared_cache_dir is not None:
+            shutil.rmtree(shared_cache_dir, ignore_errors=True)
+    return exit_status
+
 
 def main():
 
     args = tag_resolver_proxy.arguments.arg_parser.parse_args()
+    tag_resolver_proxy.logs.setup_logging(args.log_format, args.log_level)
 
     ssl_ctx = ssl.SSLContext()
     ssl_ctx.load_cert_chain(args.tls_cert_file, args.tls_key_file)
@@ -25,14 +145,35 @@ def main():
             'quay.io': args.quay_token_file,
         }
     )
-    tag_resolver_proxy.resolve_tags.init_registries()
-
-    aiohttp.web.run_app(
-        tag_resolver_proxy.webapp.app(args),
-        port=args.port, ssl_context=ssl_ctx if not NOSSL else None
+    registry_limits = {
+        'rate_limit': args.registry_rate_limit,
+        'burst': args.registry_burst,
+        'max_requests': args.registry_max_requests,
+        'lookup_timeout': args.registry_lookup_timeout,
+        'pool_options': {
+            'limit': args.registry_pool_size,
+            'limit_per_host': args.registry_pool_per_host,
+            'keepalive_timeout': args.registry_keepalive,
+            'dns_cache_ttl': args.registry_dns_ttl,
+            'connect_timeout': args.registry_connect_timeout,
+            'read_timeout': args.registry_read_timeout,
+        },
+    }
+    tag_resolver_proxy.arguments.registry_options.update(
+        {
+            'docker.io': registry_limits,
+            'quay.io': {'resolve_mode': args.quay_resolve_mode, 'prefetch': args.quay_prefetch, **registry_limits},
+        }
     )
+    tag_resolver_proxy.arguments.auth.update(args.oci_registry_auth_file)
+    for domain, api_base_uri in args.oci_registry:
+        tag_resolver_proxy.arguments.registry_options[domain] = {'api_base_uri': api_base_uri, **registry_limits}
+        tag_resolver_proxy.arguments.oci_registries.append(domain)
+
+    if args.workers > 1:
+        raise SystemExit(serve_workers(args, ssl_ctx))
+    serve(args, ssl_ctx)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
     main()
@@ -1,6 +1,20 @@
 import argparse
 
 
+def oci_registry(value: str) -> tuple:
+    """Registry domain and base URI of `domain` or `domain=https://registry.example.com` option."""
+    domain, _, api_base_uri = value.partition('=')
+    return domain, api_base_uri or f'https://{domain}'
+
+
+def registry_file(value: str) -> tuple:
+    """Registry domain and file path of `domain=/path/to/file` option."""
+    domain, separator, path = value.partition('=')
+    if not separator or not path:
+        raise argparse.ArgumentTypeError(f'{value} is not of domain=/path/to/file format')
+    return domain, path
+
+
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('--tls-key-file', help='TLS cert file to run server with')
 arg_parser.add_argument('--tls-cert-file', help='TLS cert file to run server with')
@@ -12,15 +26,149 @@ arg_parser.add_argument('--docker-auth-file', help='A path file containing '
                                                    'Docker username and access token/password')
 arg_parser.add_argument('--quay-token-file', help='A file containing Quay access token')
 
+arg_parser.add_argument('--quay-resolve-mode',
+                        help='Look up Quay digests with tag API, registry v2 manifest HEAD requests, '
+                             'or by listing the whole repository',
+                        choices=['tag', 'manifest', 'repository'], default='tag')
+arg_parser.add_argument('--quay-prefetch',
+                        help='Cache digests of all tags whenever a whole Quay repository is listed',
+                        action='store_true')
+arg_parser.add_argument('--oci-registry',
+                        help='Resolve tags of given registry with OCI distribution API, as domain, e.g. ghcr.io, '
+                             'or domain=https://endpoint when served elsewhere',
+                        type=oci_registry, action='append', default=[])
+arg_parser.add_argument('--oci-registry-auth-file',
+                        help='Credentials of an OCI registry as domain=/path/to/file, '
+                             'the file containing <username>:<password>',
+                        type=registry_file, action='append', default=[])
+
+arg_parser.add_argument('--registry-concurrency',
+                        help='Maximum concurrent tag lookups per registry within one admission request',
+                        type=int, default=8)
+
+arg_parser.add_argument('--registry-rate-limit',
+                        help='Maximum requests per second to each registry, 0 for no limit. '
+                             'Halved while the registry throttles requests',
+                        type=float, default=0)
+arg_parser.add_argument('--registry-burst', help='Requests to each registry allowed at once over the rate limit',
+                        type=int, default=10)
+arg_parser.add_argument('--registry-max-requests', help='Maximum concurrent requests to each registry',
+                        type=int, default=16)
+arg_parser.add_argument('--registry-pool-size', help='Maximum open connections to each registry',
+                        type=int, default=32)
+arg_parser.add_argument('--registry-pool-per-host',
+                        help='Maximum open connections to each host of a registry, e.g. its token service, '
+                             '0 for no limit',
+                        type=int, default=0)
+arg_parser.add_argument('--registry-keepalive', help='Seconds to keep idle registry connections open',
+                        type=float, default=60)
+arg_parser.add_argument('--registry-dns-ttl', help='Seconds to cache registry host name lookups',
+                        type=float, default=60)
+arg_parser.add_argument('--registry-prewarm', help='Connections to open to each registry host at startup',
+                        type=int, default=1)
+arg_parser.add_argument('--registry-connect-timeout', help='Registry connect timeout, seconds',
+                        type=float, default=3)
+arg_parser.add_argument('--registry-read-timeout', help='Registry socket read timeout, seconds',
+                        type=float, default=10)
+arg_parser.add_argument('--registry-lookup-timeout',
+                        help='Seconds an admission waits for a tag lookup, 0 for no limit. '
+                             'The lookup itself goes on, for other admissions of the same tag',
+                        type=float, default=0)
+
+arg_parser.add_argument('--cache-backend',
+                        help='Tag digest cache: memory, sqlite:///path/to/cache.db '
+                             'or http://host:port/prefix of a shared digest store',
+                        type=str, default='memory')
+arg_parser.add_argument('--cache-max-entries', help='Maximum number of cached tag lookups',
+                        type=int, default=10000)
+arg_parser.add_argument('--cache-max-bytes', help='Approximate memory budget of cached tag lookups',
+                        type=int, default=16 * 1024 * 1024)
+arg_parser.add_argument('--cache-ttl', help='Seconds to cache resolved digests, 0 to cache forever',
+                        type=float, default=86400)
+arg_parser.add_argument('--cache-negative-ttl', help='Seconds to cache failed tag lookups, 0 to cache forever',
+                        type=float, default=30)
+arg_parser.add_argument('--cache-stale-while-revalidate',
+                        help='Seconds after expiry a digest is served while being refreshed in background',
+                        type=float, default=0)
+arg_parser.add_argument('--cache-stale-if-error',
+                        help='Seconds after expiry a digest is served when its refresh fails, e.g. registry outage',
+                        type=float, default=0)
+arg_parser.add_argument('--cache-ttl-jitter', help='Random fraction added to or taken from cache TTLs',
+                        type=float, default=0.1)
+
+arg_parser.add_argument('--decision-cache-ttl',
+                        help='Seconds to reuse upstream decision for admissions of the same resolved images, '
+                             'namespace and operation, 0 to always ask upstream',
+                        type=float, default=0)
+arg_parser.add_argument('--decision-cache-max-entries', help='Maximum number of cached admission decisions',
+                        type=int, default=10000)
+
+arg_parser.add_argument('--warm-repository',
+                        help='Prefetch digests of all tags of given hub/org/software repository before serving',
+                        action='append', default=[])
+arg_parser.add_argument('--warm-images-file',
+                        help='Resolve whitespace separated images listed in given file before serving, e.g. '
+                             "output of kubectl get pods --all-namespaces -o jsonpath='{..image}'")
+arg_parser.add_argument('--warm-timeout', help='Maximum seconds to spend warming up digest cache',
+                        type=float, default=60)
+
+arg_parser.add_argument('--admission-timeout',
+                        help='Seconds to answer an admission in, 0 to only follow the apiserver webhook timeout',
+                        type=float, default=0)
+arg_parser.add_argument('--admission-timeout-margin',
+                        help='Seconds before the apiserver webhook timeout by which admissions are answered',
+                        type=float, default=0.5)
+arg_parser.add_argument('--admission-timeout-action',
+                        help='Decision of admissions not answered by upstream in time or failing to connect',
+                        choices=['deny', 'allow'], default='deny')
+
 arg_parser.add_argument('--port', help='A port to listen TLS', type=int, default=9443)
+arg_parser.add_argument('--workers', help='Number of worker processes sharing the port with SO_REUSEPORT',
+                        type=int, default=1)
+arg_parser.add_argument('--shutdown-timeout', help='Seconds to drain in-flight admissions on SIGTERM',
+                        type=float, default=30)
 
 arg_parser.add_argument('--upstream-uri', help='Upstream admission webhook server URL',
                         type=str, default='localhost')
+arg_parser.add_argument('--upstream-pool-size', help='Maximum open connections to upstream',
+                        type=int, default=100)
+arg_parser.add_argument('--upstream-pool-per-host', help='Maximum open connections per upstream host, 0 for no limit',
+                        type=int, default=0)
+arg_parser.add_argument('--upstream-keepalive', help='Seconds to keep idle upstream connections open',
+                        type=float, default=60)
+arg_parser.add_argument('--upstream-prewarm', help='Upstream connections to open at startup',
+                        type=int, default=0)
+arg_parser.add_argument('--upstream-connect-timeout', help='Upstream connect timeout, seconds',
+                        type=float, default=2)
+arg_parser.add_argument('--upstream-read-timeout', help='Upstream socket read timeout, seconds',
+                        type=float, default=8)
+arg_parser.add_argument('--upstream-timeout', help='Upstream request total timeout, seconds',
+                        type=float, default=9)
+arg_parser.add_argument('--upstream-response-mode',
+                        help='Stream upstream response body to the client as it arrives, '
+                             'or read it whole before responding',
+                        choices=['stream', 'buffer'], default='stream')
+arg_parser.add_argument('--log-format', help='Write log records as plain text or one JSON object per line',
+                        choices=['text', 'json'], default='text')
+arg_parser.add_argument('--log-level', help='Minimum level of written log records',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
+arg_parser.add_argument('--log-payload-sample-rate',
+                        help='Fraction of admissions logged with full request and upstream response bodies, '
+                             'which are always logged at DEBUG level',
+                        type=float, default=0)
 arg_parser.add_argument('--whitelist-registry',
                         help='Whitelist given registry, bypassing all checks',
                         action='append', default=[])
+arg_parser.add_argument('--whitelist-file',
+                        help='A file listing whitelisted registries one per line, reloaded on change')
+arg_parser.add_argument('--reload-interval',
+                        help='Seconds between checks of whitelist and token files for changes, 0 to never reload',
+                        type=float, default=10)
 
 auth = {}
+registry_options = {}
+# Domains of registries resolved by OCI distribution API
+oci_registries = []
 
 
-__all__ = ['arg_parser', 'auth']
+__all__ = ['arg_parser', 'auth', 'oci_registries', 'registry_options']
@@ -0,0 +1,124 @@
+"""Pooled HTTP client sessions with connection metrics."""
+import asyncio
+import logging
+import ssl
+import time
+import typing
+
+import aiohttp
+
+from tag_resolver_proxy import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS_CREATED = metrics.Counter(
+    'kritis_proxy_http_connections_created_total',
+    'New connections opened, each one a TLS handshake for HTTPS pools', ['pool'])
+CONNECTIONS_REUSED = metrics.Counter(
+    'kritis_proxy_http_connections_reused_total', 'Requests served over a pooled keep-alive connection', ['pool'])
+CONNECTIONS_QUEUED = metrics.Counter(
+    'kritis_proxy_http_connections_queued_total', 'Requests which waited for a free connection of a full pool',
+    ['pool'])
+CONNECT_SECONDS = metrics.Histogram(
+    'kritis_proxy_http_connect_seconds', 'Time to open a new connection, including DNS lookup and TLS handshake',
+    ['pool'])
+DNS_CACHE_MISSES = metrics.Counter(
+    'kritis_proxy_http_dns_cache_misses_total', 'Host name lookups not answered by the connector DNS cache', ['pool'])
+
+_pools = {}
+
+
+def _pool_connections():
+    for name, connector in _pools.items():
+        if not connector.closed:
+            # aiohttp exposes no public pool occupancy API
+            yield (name, 'acquired'), len(connector._acquired)
+            yield (name, 'idle'), sum(len(conns) for conns in connector._conns.values())
+            yield (name, 'limit'), connector.limit
+
+
+metrics.CallbackMetric('kritis_proxy_http_pool_connections', 'Connections of HTTP client pools',
+                       'gauge', ['pool', 'state'], _pool_connections)
+
+
+def trace_config(pool: str) -> aiohttp.TraceConfig:
+    """Count connections created, reused and waited for in given pool, and DNS cache misses."""
+    created, reused, queued, dns_misses = (
+        counter.labels(pool)
+        for counter in (CONNECTIONS_CREATED, CONNECTIONS_REUSED, CONNECTIONS_QUEUED, DNS_CACHE_MISSES))
+    connect_seconds = CONNECT_SECONDS.labels(pool)
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        created.inc()
+        connect_seconds.observe(time.perf_counter() - context.connect_started)
+
+    async def on_connection_reuseconn(session, context, params):
+        reused.inc()
+
+    async def on_connection_queued_start(session, context, params):
+        queued.inc()
+
+    async def on_dns_cache_miss(session, context, params):
+        dns_misses.inc()
+
+    config = aiohttp.TraceConfig()
+    config.on_connection_create_start.append(on_connection_create_start)
+    config.on_connection_create_end.append(on_connection_create_end)
+    config.on_connection_reuseconn.append(on_connection_reuseconn)
+    config.on_connection_queued_start.append(on_connection_queued_start)
+    config.on_dns_cache_miss.append(on_dns_cache_miss)
+    return config
+
+
+def create_session(pool: str,
+                   ssl_context: typing.Optional[ssl.SSLContext] = None,
+                   limit: int = 100,
+                   limit_per_host: int = 0,
+                   keepalive_timeout: float = 15,
+                   dns_cache_ttl: typing.Optional[float] = 10,
+                   connect_timeout: typing.Optional[float] = None,
+                   read_timeout: typing.Optional[float] = None,
+                   total_timeout: typing.Optional[float] = None,
+                   **session_kwargs) -> aiohttp.ClientSession:
+    """Create a client session over a tuned connection pool, reported in metrics under `pool` name.
+
+    Host names are resolved once per `dns_cache_ttl` seconds, None to cache them forever.
+    """
+    connector = aiohttp.TCPConnector(
+        ssl=ssl_context,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+    _pools[pool] = connector
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout),
+        trace_configs=[trace_config(pool)],
+        **session_kwargs,
+    )
+
+
+async def prewarm(session: aiohttp.ClientSession, url: str, connections: int):
+    """Open up to `connections` keep-alive connections to given URL before serving.
+
+    Connections are opened with concurrent HEAD requests, whose responses are ignored.
+    """
+
+    async def connect():
+        async with session.head(url) as response:
+            await response.read()
+
+    results = await asyncio.gather(*(connect() for _ in range(connections)), return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        logger.warning('Failed to pre-warm %d of %d connections to %s: %r',
+                       len(failures), connections, url, failures[0])
+
+
+__all__ = ['create_session', 'prewarm', 'trace_config']
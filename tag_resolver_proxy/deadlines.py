@@ -0,0 +1,76 @@
+"""Time budget of an admission.
+
+The apiserver gives up on a webhook after its timeout, passed as `?timeout=10s`
+query of the webhook URL. An admission deadline is the earliest of that timeout,
+less a margin to deliver the answer, and `--admission-timeout`. Deadlines are
+event loop times, None when the admission has no time budget.
+"""
+import asyncio
+import re
+import typing
+
+from tag_resolver_proxy import metrics
+
+GO_DURATION = re.compile(r'([0-9]*(?:\.[0-9]*)?)(ms|us|µs|ns|h|m|s)')
+GO_DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 1e-3, 'us': 1e-6, 'µs': 1e-6, 'ns': 1e-9}
+
+DEADLINES_EXCEEDED = metrics.Counter('kritis_proxy_admission_deadlines_exceeded_total',
+                                     'Admissions answered without upstream decision once their time budget ran out',
+                                     ['decision'])
+
+
+class DeadlineExceeded(Exception):
+    """Admission time budget ran out."""
+
+
+def parse_duration(value: typing.Optional[str]) -> typing.Optional[float]:
+    """Seconds of a Go duration, e.g. ``10s`` or ``1m30s``, None if it is missing or invalid."""
+    if not value or GO_DURATION.sub('', value):
+        return None
+    seconds = 0.0
+    for number, unit in GO_DURATION.findall(value):
+        if number in ('', '.'):
+            return None
+        seconds += float(number) * GO_DURATION_UNITS[unit]
+    return seconds
+
+
+def admission_deadline(apiserver_timeout: typing.Optional[str], timeout: float, margin: float) \
+        -> typing.Optional[float]:
+    """Deadline of admission from apiserver `timeout` query value and configured `timeout`, 0 for none."""
+    budgets = [timeout] if timeout > 0 else []
+    apiserver_seconds = parse_duration(apiserver_timeout)
+    if apiserver_seconds is not None:
+        budgets.append(max(apiserver_seconds - margin, 0))
+    if not budgets:
+        return None
+    return asyncio.get_event_loop().time() + min(budgets)
+
+
+def remaining(deadline: typing.Optional[float]) -> typing.Optional[float]:
+    """Seconds left until deadline, None for no deadline."""
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_event_loop().time(), 0)
+
+
+def expired(deadline: typing.Optional[float]) -> bool:
+    return deadline is not None and remaining(deadline) == 0
+
+
+async def within(deadline: typing.Optional[float], awaitable: typing.Awaitable, stage: str = 'processing'):
+    """Await awaitable, cancelling it and raising DeadlineExceeded once deadline passes.
+
+    Timeouts of the awaitable itself, e.g. of a registry request, are raised as they are.
+    """
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, remaining(deadline))
+    except asyncio.TimeoutError:
+        if expired(deadline):
+            raise DeadlineExceeded(f'Admission deadline exceeded during {stage}') from None
+        raise
+
+
+__all__ = ['DeadlineExceeded', 'admission_deadline', 'expired', 'parse_duration', 'remaining', 'within']
@@ -0,0 +1,98 @@
+"""Short-lived cache of upstream admission decisions.
+
+Controllers submit the same workload again and again, on scaling or
+reconciliation. Once its tags are resolved, an admission is looked up by its
+namespace, operation, set of resolved images and Kritis annotations, e.g.
+`kritis.grafeas.io/breakglass`, and answered with the cached upstream decision
+instead of calling upstream again.
+"""
+import collections
+import time
+import typing
+
+from tag_resolver_proxy import metrics
+from tag_resolver_proxy import payload
+from tag_resolver_proxy import process
+
+
+Decision = collections.namedtuple('Decision', ['allowed', 'message', 'expires_at'])
+
+DECISION_CACHE_EVENTS = metrics.Counter('kritis_proxy_decision_cache_events_total',
+                                        'Admission decision cache hits, misses, expirations and evictions', ['event'])
+# Prefix of annotations Kritis reads to decide, such as breakglass
+KRITIS_ANNOTATION_PREFIX = 'kritis.grafeas.io/'
+
+EVENTS = {event: DECISION_CACHE_EVENTS.labels(event) for event in ('hits', 'misses', 'expirations', 'evictions')}
+
+
+def kritis_annotations(request_payload) -> frozenset:
+    """Kritis annotations of admission request object and its pod templates."""
+    obj = request_payload['request'].get('object') or {}
+    metadatas = [obj.get('metadata') or {}]
+    spec = obj.get('spec') or {}
+    for template in (spec.get('template'), ((spec.get('jobTemplate') or {}).get('spec') or {}).get('template'),
+                     obj.get('template')):
+        if template:
+            metadatas.append(template.get('metadata') or {})
+    return frozenset(
+        (name, value)
+        for metadata in metadatas
+        for name, value in (metadata.get('annotations') or {}).items()
+        if name.startswith(KRITIS_ANNOTATION_PREFIX)
+    )
+
+
+def decision_key(request_payload) -> tuple:
+    """Cache key of admission request, with resolved images and Kritis annotations."""
+    req = request_payload['request']
+    images = frozenset(container_spec.get('image') for container_spec in process.container_specs(request_payload))
+    return req.get('namespace'), req.get('operation'), images, kritis_annotations(request_payload)
+
+
+class DecisionCache:
+    """Per-process LRU cache of upstream decisions, expiring after `ttl` seconds."""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 30):
+        self._entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple) -> typing.Optional[Decision]:
+        decision = self._entries.get(key)
+        if decision is not None and decision.expires_at <= time.time():
+            del self._entries[key]
+            EVENTS['expirations'].inc()
+            decision = None
+
+        if decision is None:
+            EVENTS['misses'].inc()
+        else:
+            self._entries.move_to_end(key)
+            EVENTS['hits'].inc()
+        return decision
+
+    def set(self, key: tuple, allowed: bool, message: str) -> Decision:
+        decision = self._entries[key] = Decision(allowed, message, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            EVENTS['evictions'].inc()
+        return decision
+
+    def set_upstream_response(self, key: tuple, body: bytes) -> typing.Optional[Decision]:
+        """Cache decision of upstream AdmissionReview response body, unless it has none."""
+        try:
+            response = payload.loads(body)['response']
+            allowed = response['allowed']
+            message = (response.get('status') or {}).get('message', '')
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(allowed, bool):
+            return None
+        return self.set(key, allowed, message)
+
+
+__all__ = ['Decision', 'DecisionCache', 'decision_key', 'kritis_annotations']
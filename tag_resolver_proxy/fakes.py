@@ -0,0 +1,258 @@
+"""Local stand-ins for remote services the proxy talks to, used by tests and benchmarks."""
+import asyncio
+import base64
+import collections
+import hashlib
+import os
+import random
+import ssl
+
+from aiohttp import web
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), 'test')
+
+
+def fake_digest(repository: str, tag: str) -> str:
+    return 'sha256:' + hashlib.sha256(f'{repository}:{tag}'.encode()).hexdigest()
+
+
+class FakeQuay:
+    """Quay repository API and registry v2 manifest endpoints.
+
+    Serves repositories of `tags_per_repository` tags each, named `1.0.0` .. `1.0.{N-1}`.
+    Counts requests and response body bytes sent.
+    The next `throttle` requests are answered with HTTP 429 and `retry_after` Retry-After header.
+    A fraction `error_rate` of requests fails with HTTP 500.
+    """
+
+    def __init__(self, tags_per_repository: int = 100, latency: float = 0.0, error_rate: float = 0.0):
+        self.tag_names = {f'1.0.{n}': n for n in range(tags_per_repository)}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.bytes_sent = 0
+        self.throttle = 0
+        self.retry_after = '1'
+
+    def tag(self, repository: str, name: str) -> dict:
+        """Tag metadata as served by Quay API, None for unknown tags."""
+        if name not in self.tag_names:
+            return None
+        n = self.tag_names[name]
+        return {
+            'name': name,
+            'reversion': False,
+            'start_ts': 1589450000 + n,
+            'image_id': hashlib.sha256(f'{repository}:{n}'.encode()).hexdigest(),
+            'last_modified': 'Thu, 14 May 2020 12:00:00 -0000',
+            'size': 5600000 + n,
+            'manifest_digest': fake_digest(repository, name),
+        }
+
+    @web.middleware
+    async def account(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttle:
+            self.throttle -= 1
+            return web.Response(status=429, headers={'Retry-After': self.retry_after})
+        if self.error_rate and random.random() < self.error_rate:
+            raise web.HTTPInternalServerError()
+        response = await handler(request)
+        self.bytes_sent += len(response.body or b'')
+        return response
+
+    async def repository(self, request):
+        repository = '{org}/{software}'.format(**request.match_info)
+        return web.json_response({'namespace': request.match_info['org'], 'name': request.match_info['software'],
+                                  'tags': {name: self.tag(repository, name) for name in self.tag_names}})
+
+    async def repository_tag(self, request):
+        repository = '{org}/{software}'.format(**request.match_info)
+        tag = self.tag(repository, request.query.get('specificTag'))
+        return web.json_response({'tags': [tag] if tag else [], 'page': 1, 'has_additional': False})
+
+    async def v2_auth(self, request):
+        return web.json_response({'token': 'fake'})
+
+    async def manifest(self, request):
+        repository = '{org}/{software}'.format(**request.match_info)
+        if request.match_info['tag'] not in self.tag_names:
+            raise web.HTTPNotFound()
+        return web.Response(headers={'Docker-Content-Digest': fake_digest(repository, request.match_info['tag'])})
+
+    def app(self) -> web.Application:
+        application = web.Application(middlewares=[self.account])
+        application.router.add_get('/api/v1/repository/{org}/{software}', self.repository)
+        application.router.add_get('/api/v1/repository/{org}/{software}/tag/', self.repository_tag)
+        application.router.add_get('/v2/auth', self.v2_auth)
+        application.router.add_route('HEAD', '/v2/{org}/{software}/manifests/{tag}', self.manifest)
+        return application
+
+
+class FakeDockerHub:
+    """Docker Hub token service and registry v2 manifest endpoints, serving any tag of any repository.
+
+    A fraction `error_rate` of requests fails with HTTP 500.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    @web.middleware
+    async def account(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise web.HTTPInternalServerError()
+        return await handler(request)
+
+    async def token(self, request):
+        return web.json_response({'token': 'fake', 'expires_in': 300, 'issued_at': '2020-05-14T12:00:00Z'})
+
+    async def manifest(self, request):
+        if request.headers.get('Authorization') != 'Bearer fake':
+            raise web.HTTPUnauthorized()
+        repository = '{org}/{software}'.format(**request.match_info)
+        return web.Response(headers={'Docker-Content-Digest': fake_digest(repository, request.match_info['tag'])})
+
+    def app(self) -> web.Application:
+        application = web.Application(middlewares=[self.account])
+        application.router.add_get('/token', self.token)
+        application.router.add_get('/v2/{org}/{software}/manifests/{tag}', self.manifest)
+        return application
+
+
+class FakeOCIRegistry:
+    """OCI distribution manifest endpoints of any tag of any repository, and a token service.
+
+    `auth` is None for anonymous access, `bearer` for tokens of the `/token` realm,
+    granted to `credentials` if set, or `basic` for `credentials` on every request.
+    Manifests are served without `Docker-Content-Digest` header when `digest_header` is False.
+    """
+
+    def __init__(self, auth: str = None, credentials: str = None, digest_header: bool = True):
+        self.auth = auth
+        self.credentials = credentials
+        self.digest_header = digest_header
+        self.requests = collections.Counter()
+
+    @staticmethod
+    def manifest_body(repository: str, tag: str) -> bytes:
+        return f'{{"schemaVersion": 2, "mediaType": "application/vnd.oci.image.index.v1+json", ' \
+               f'"annotations": {{"ref": "{repository}:{tag}"}}}}'.encode()
+
+    def basic_authorized(self, request) -> bool:
+        return request.headers.get('Authorization') == 'Basic ' + base64.b64encode(self.credentials.encode()).decode()
+
+    def challenge(self, request, repository: str) -> web.HTTPUnauthorized:
+        if self.auth == 'basic':
+            return web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Basic realm="fake"'})
+        realm = f'{request.scheme}://{request.host}/token'
+        return web.HTTPUnauthorized(headers={
+            'WWW-Authenticate': f'Bearer realm="{realm}",service="fake",scope="repository:{repository}:pull"'})
+
+    async def token(self, request):
+        self.requests['token'] += 1
+        if self.credentials and not self.basic_authorized(request):
+            raise web.HTTPUnauthorized()
+        return web.json_response({'token': f'fake {request.query["scope"]}', 'expires_in': 300})
+
+    async def version_check(self, request):
+        return web.Response(headers={'Docker-Distribution-API-Version': 'registry/2.0'})
+
+    async def manifest(self, request):
+        repository, tag = request.match_info['repository'], request.match_info['tag']
+        self.requests[request.method] += 1
+        if self.auth == 'basic' and not self.basic_authorized(request):
+            raise self.challenge(request, repository)
+        authorization = request.headers.get('Authorization')
+        if self.auth == 'bearer' and authorization != f'Bearer fake repository:{repository}:pull':
+            raise self.challenge(request, repository)
+        if tag == 'missing':
+            raise web.HTTPNotFound()
+        body = self.manifest_body(repository, tag)
+        headers = {'Content-Type': 'application/vnd.oci.image.index.v1+json'}
+        if self.digest_header:
+            headers['Docker-Content-Digest'] = 'sha256:' + hashlib.sha256(body).hexdigest()
+        return web.Response(body=body if request.method == 'GET' else None, headers=headers)
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_get('/token', self.token)
+        application.router.add_get('/v2/', self.version_check)
+        application.router.add_get('/v2/{repository:.+}/manifests/{tag}', self.manifest)
+        return application
+
+
+class FakeKritis:
+    """Kritis admission webhook, allowing every AdmissionReview after `latency` seconds.
+
+    A fraction `error_rate` of requests fails with HTTP 500.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    async def review(self, request):
+        self.requests += 1
+        admission = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise web.HTTPInternalServerError()
+        return web.json_response({
+            'apiVersion': 'admission.k8s.io/v1beta1',
+            'kind': 'AdmissionReview',
+            'response': {
+                'uid': admission['request']['uid'],
+                'allowed': True,
+                'status': {'message': 'Allowed by fake Kritis'},
+            },
+        })
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post('/{path:.*}', self.review)
+        return application
+
+
+def server_ssl_context() -> ssl.SSLContext:
+    """TLS context of test server certificate. Client certificates are not verified."""
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(os.path.join(TEST_DIR, 'server.crt'), os.path.join(TEST_DIR, 'server.key'))
+    return ssl_context
+
+
+def run_kritis(port: int, latency: float = 0.0, error_rate: float = 0.0):
+    """Serve fake Kritis over TLS in current process, e.g. a multiprocessing.Process target."""
+    web.run_app(FakeKritis(latency, error_rate).app(), host='127.0.0.1', port=port,
+                ssl_context=server_ssl_context(), print=None, access_log=None)
+
+
+def run_registries(quay_port: int, docker_port: int, latency: float = 0.0, error_rate: float = 0.0):
+    """Serve fake Quay and Docker Hub over HTTP in current process, e.g. a Process target."""
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve(FakeQuay(latency=latency, error_rate=error_rate).app(), quay_port))
+    loop.run_until_complete(serve(FakeDockerHub(latency, error_rate).app(), docker_port))
+    loop.run_forever()
+
+
+async def serve(application: web.Application, port: int = 0) -> (web.AppRunner, str):
+    """Serve application on localhost, returning its runner and base URI."""
+    runner = web.AppRunner(application)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+__all__ = ['FakeDockerHub', 'FakeKritis', 'FakeOCIRegistry', 'FakeQuay', 'TEST_DIR', 'fake_digest', 'run_kritis',
+           'run_registries', 'serve', 'server_ssl_context']
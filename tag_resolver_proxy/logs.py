@@ -0,0 +1,74 @@
+"""Logging setup: text or JSON records, written to stdout by a background thread.
+
+Records are put on a queue unformatted, so the event loop never formats
+messages nor blocks on stdout. Arguments of log calls must therefore not be
+mutated after logging.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+from tag_resolver_proxy import payload
+
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [pid=%(process)d] %(name)s: %(message)s'
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with fields given as ``extra={'fields': {...}}`` merged in."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', ()))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return payload.dumps(entry).decode()
+
+
+class UnformattedQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, leaving formatting to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(log_format: str = 'text', level: str = 'INFO'):
+    """Route root logger records through a queue to a stdout writer thread.
+
+    Safe to call again, e.g. in a forked worker which has no writer thread.
+    """
+    global _listener
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [UnformattedQueueHandler(records)]
+    root.setLevel(level)
+
+
+@atexit.register
+def stop_logging():
+    """Write out queued records and stop the writer thread."""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+__all__ = ['JsonFormatter', 'UnformattedQueueHandler', 'setup_logging', 'stop_logging']
@@ -0,0 +1,193 @@
+"""Process metrics in Prometheus text exposition format.
+
+Metrics are plain in-process objects, cheap enough to update on the admission hot path.
+"""
+import bisect
+import collections
+import time
+
+import aiohttp.web
+
+
+class Registry:
+    """Collection of metrics rendered by /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def unregister(self, metric):
+        self._metrics.pop(metric.name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Metric:
+    """A metric family with optional labels.
+
+    `labels(*values)` returns a child value object, which callers may keep
+    to skip the lookup on the hot path.
+    """
+
+    kind = 'untyped'
+    value_class = CounterValue
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            assert len(labelvalues) == len(self.labelnames), f'{self.name} expects labels {self.labelnames}'
+            child = self._children[labelvalues] = self.value_class()
+        return child
+
+    def samples(self):
+        for labelvalues, child in self._children.items():
+            yield '', zip(self.labelnames, labelvalues), child.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    value_class = GaugeValue
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class HistogramValue:
+    __slots__ = ('upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: Registry = REGISTRY,
+                 buckets=DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        self.value_class = lambda: HistogramValue(self.upper_bounds)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        for labelvalues, child in self._children.items():
+            labels = tuple(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds + (float('inf'),), child.counts):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else repr(float(upper_bound))
+                yield '_bucket', labels + (('le', le),), float(cumulative)
+            yield '_sum', labels, child.sum
+            yield '_count', labels, float(cumulative)
+
+
+class CallbackMetric(Metric):
+    """A metric family read from `callback` at collection time.
+
+    The callback returns an iterable of (label values tuple, value) pairs.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, labelnames, callback, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        for labelvalues, value in self.callback():
+            yield '', zip(self.labelnames, labelvalues), float(value)
+
+
+ADMISSION_STAGE_SECONDS = Histogram(
+    'kritis_proxy_admission_stage_seconds',
+    'Admission processing time by stage: parse, whitelist, resolve, upstream and total', ['stage'])
+ADMISSION_STAGES = {stage: ADMISSION_STAGE_SECONDS.labels(stage)
+                    for stage in ('parse', 'whitelist', 'resolve', 'upstream', 'total')}
+
+
+def observe_stage(request, stage: str, started: float) -> float:
+    """Observe admission stage time since `started`, keeping it in request timings for the summary log."""
+    elapsed = time.perf_counter() - started
+    ADMISSION_STAGES[stage].observe(elapsed)
+    # Timings are set up by webhook_middleware; setdefault would build a dict on every call
+    try:
+        request['timings'][stage] = elapsed
+    except KeyError:
+        request['timings'] = {stage: elapsed}
+    return elapsed
+
+
+def metrics_handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Render all registered metrics."""
+    return aiohttp.web.Response(body=REGISTRY.render().encode(),
+                                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+__all__ = ['Registry', 'REGISTRY', 'Counter', 'Gauge', 'Histogram', 'CallbackMetric', 'ADMISSION_STAGE_SECONDS',
+           'observe_stage', 'metrics_handler']
@@ -0,0 +1,127 @@
+"""Request-scoped AdmissionReview payload.
+
+The admission body is decoded once per request and stored on the
+``aiohttp.web.Request``, so middlewares and the handler share one object.
+orjson is used when installed, falling back to the standard json module.
+
+Only container images change on the way upstream. With the standard json
+module, the upstream body is the raw body with resolved images spliced in,
+and is encoded from the decoded payload only when the image fields can not
+be told apart. orjson encodes about as fast as the raw body is scanned, so
+with orjson installed the payload is always encoded.
+"""
+import json
+import re
+import time
+import typing
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from tag_resolver_proxy import metrics
+
+
+REQUEST_KEY = 'admission_payload'
+
+# "image" fields are found with bytes.find of their key, then the start of their value is matched after it
+IMAGE_KEY = b'"image"'
+VALUE_START = re.compile(rb'\s*:\s*"')
+ESCAPED_VALUE = re.compile(rb'(?:[^"\\]|\\.)*')
+# Characters of image references, encoded in JSON strings as they are
+PLAIN_STRING = re.compile(r'[\w.:/@+-]*', re.ASCII)
+
+UPSTREAM_BODIES = metrics.Counter('kritis_proxy_upstream_bodies_total',
+                                  'Upstream request bodies, forwarded as received, spliced or encoded', ['method'])
+BODY_METHODS = {method: UPSTREAM_BODIES.labels(method) for method in ('original', 'spliced', 'encoded')}
+
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:  # pragma: no cover
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+SPLICE_IMAGES = orjson is None
+
+
+def json_string(value: str) -> bytes:
+    """JSON string encoding of value, without quotes."""
+    return value.encode() if PLAIN_STRING.fullmatch(value) else dumps(value)[1:-1]
+
+
+def splice_images(raw: bytes, rewrites: list) -> typing.Optional[bytes]:
+    """Raw body with container images replaced, copying the bytes around them as they are.
+
+    `rewrites` holds an (image, resolved image) pair per rewritten container. Returns None
+    unless exactly that many image fields hold a rewritten image, e.g. when another
+    "image" field of the object holds one too.
+    """
+    replacements = {image: json_string(resolved) for image, resolved in rewrites}
+    if len(set(rewrites)) != len(replacements):
+        return None
+    view = memoryview(raw)
+    pieces = []
+    position = 0
+    found = raw.find(IMAGE_KEY)
+    while found != -1:
+        value_start = VALUE_START.match(raw, found + len(IMAGE_KEY))
+        if value_start is not None:
+            start = value_start.end()
+            end = raw.find(b'"', start)
+            image = raw[start:end]
+            if b'\\' in image:
+                end = ESCAPED_VALUE.match(raw, start).end()
+                image = loads(raw[start - 1:end + 1])
+            else:
+                image = image.decode()
+            resolved = replacements.get(image)
+            if resolved is not None:
+                pieces.append(view[position:start])
+                pieces.append(resolved)
+                position = end
+        found = raw.find(IMAGE_KEY, found + len(IMAGE_KEY))
+    if len(pieces) != 2 * len(rewrites):
+        return None
+    pieces.append(view[position:])
+    return b''.join(pieces)
+
+
+class AdmissionPayload:
+    """Raw and decoded AdmissionReview body of a single request."""
+
+    __slots__ = ('raw', 'data')
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.data = loads(raw)
+
+    def upstream_body(self, rewrites: list) -> bytes:
+        """Body to forward upstream, after container images were rewritten in decoded payload."""
+        if not rewrites:
+            BODY_METHODS['original'].inc()
+            return self.raw
+        body = splice_images(self.raw, rewrites) if SPLICE_IMAGES else None
+        if body is not None:
+            BODY_METHODS['spliced'].inc()
+            return body
+        BODY_METHODS['encoded'].inc()
+        return dumps(self.data)
+
+
+async def admission_payload(request) -> AdmissionPayload:
+    """Return the AdmissionReview of given request, decoding it on first access."""
+    payload = request.get(REQUEST_KEY)
+    if payload is None:
+        raw = await request.read()
+        started = time.perf_counter()
+        payload = request[REQUEST_KEY] = AdmissionPayload(raw)
+        metrics.observe_stage(request, 'parse', started)
+    return payload
+
+
+__all__ = ['AdmissionPayload', 'admission_payload', 'dumps', 'loads', 'splice_images']
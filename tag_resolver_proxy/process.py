@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 
 
 logger = logging.getLogger(__name__)
@@ -20,38 +19,59 @@ def admission_response(uid, status, message) -> dict:
     }
 
 
-async def process_spec(request_payload, callback):
-    """Process given admission request specification.
-       Check both spec containers and template spec containers.
-       Invoke callback on each found container spec.
-     """
-    spec = request_payload['request']['object']['spec']
+CONTAINER_LISTS = ('initContainers', 'containers', 'ephemeralContainers')
+
+
+def pod_specs(request_payload) -> list:
+    """Pod specs of given admission request object.
+
+    Pod specs are found in Pod and PodTemplate objects, in pod templates of workloads
+    (Deployment, ReplicaSet, StatefulSet, DaemonSet, Job, ReplicationController) and in CronJob job templates.
+    """
+    obj = request_payload['request'].get('object') or {}
+    found = []
 
-    for container_spec in spec.get('containers', []):
-        await callback(container_spec)
+    spec = obj.get('spec')
+    if spec:
+        template = spec.get('template')
+        if template:
+            found.append(template.get('spec') or {})
+        elif 'jobTemplate' in spec:
+            template = (spec['jobTemplate'].get('spec') or {}).get('template')
+            if template:
+                found.append(template.get('spec') or {})
+        else:
+            found.append(spec)
 
-    if 'template' in spec:
-        for container_spec in spec['template']['spec'].get('containers', []):
-            await callback(container_spec)
+    template = obj.get('template')
+    if template:
+        found.append(template.get('spec') or {})
+    return found
+
+
+def container_specs(request_payload) -> list:
+    """Container specs of given admission request specification.
+       Init, regular and ephemeral containers of any workload kind are returned.
+     """
+    specs = []
+    for pod_spec in pod_specs(request_payload):
+        for container_list in CONTAINER_LISTS:
+            containers = pod_spec.get(container_list)
+            if containers:
+                specs += containers
+    return specs
 
 
 def response_deny(req_body, msg="Prohibited resource for this cluster") -> str:
     req = req_body['request']
-    logger.warning("[pid={}] Denying admission for {} in proxy: {}".format(
-        os.getpid(),
-        req['userInfo']['username'], msg),
-    )
+    logger.debug('Denying admission for %s in proxy: %s', req['userInfo']['username'], msg)
     return json.dumps(admission_response(req['uid'], False, msg))
 
 
 def response_allow(req_body, msg="Whitelisted resource") -> str:
     req = req_body['request']
-    logger.warning("[pid={}] Allowing admission for {} in proxy: {}".format(
-        os.getpid(),
-        req['userInfo']['username'],
-        msg,
-    ))
+    logger.debug('Allowing admission for %s in proxy: %s', req['userInfo']['username'], msg)
     return json.dumps(admission_response(req['uid'], True, msg))
 
 
-__all__ = ['process_spec', 'response_allow', 'response_deny']
+__all__ = ['pod_specs', 'container_specs', 'response_allow', 'response_deny']
@@ -0,0 +1,67 @@
+"""Reload of whitelist and registry token files when they change.
+
+Files are polled for changes of modification time, size or inode, the latter
+catching Kubernetes Secret and ConfigMap volumes, which swap a symlink on update.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+
+import aiohttp.web
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_version(path: str):
+    """Stat based file version, None if file does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class FileWatcher:
+    """Calls back on changes of watched files, checked every `interval` seconds."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._files = {}
+
+    def watch(self, path: str, callback):
+        self._files[path] = (file_version(path), callback)
+
+    def check(self):
+        for path, (version, callback) in list(self._files.items()):
+            current = file_version(path)
+            if current == version:
+                continue
+            self._files[path] = (current, callback)
+            try:
+                callback()
+            except Exception:
+                logger.exception('Reload of %s failed', path)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
+
+
+async def start_file_watcher(application: aiohttp.web.Application):
+    watcher = application['file_watcher']
+    if watcher.interval > 0 and watcher._files:
+        application['file_watcher_task'] = asyncio.ensure_future(watcher.run())
+
+
+async def stop_file_watcher(application: aiohttp.web.Application):
+    task = application.get('file_watcher_task')
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+__all__ = ['FileWatcher', 'file_version', 'start_file_watcher', 'stop_file_watcher']
@@ -1,18 +1,151 @@
+import asyncio
+import collections
+
+from tag_resolver_proxy import arguments
+from tag_resolver_proxy import deadlines
+from tag_resolver_proxy import metrics
+from tag_resolver_proxy import process
 from .base import ResolverMeta
+from .cache import MemoryDigestCache, create_cache
 
 
-async def resolve_tags(container_spec):
+async def resolve_tags(container_spec, deadline=None):
     image = container_spec["image"]
 
     properties = ResolverMeta.for_image_url(image)
 
-    container_spec['image'] = await properties.resolver.resolve_tags(properties)
+    container_spec['image'] = await properties.resolver.resolve_tags(properties, deadline)
+
+
+async def resolve_spec_tags(request_payload, concurrency: int, deadline: float = None) -> list:
+    """Resolve all container images of admission request concurrently.
+
+    Identical images are resolved once per request, and at most `concurrency`
+    lookups run against a single registry at a time. Digests are written back in place,
+    returning the (image, resolved image) pair of every container whose image changed.
+    The first failed lookup is raised, and waiting for the remaining ones stops, as
+    it does for all of them once `deadline` passes, raising DeadlineExceeded. Shared
+    registry lookups go on regardless, see `SingleFlight`.
+    """
+    container_specs = list(process.container_specs(request_payload))
+
+    images = {}
+    for container_spec in container_specs:
+        image = container_spec['image']
+        if image not in images:
+            images[image] = ResolverMeta.for_image_url(image)
+
+    registry_slots = collections.defaultdict(lambda: asyncio.Semaphore(concurrency))
+
+    async def resolve(properties):
+        async with registry_slots[properties.domain]:
+            return await properties.resolver.resolve_tags(properties, deadline)
+
+    lookups = [asyncio.ensure_future(resolve(properties)) for properties in images.values()]
+    gathered = asyncio.gather(*lookups)
+    # Retrieve the exception of a gather cancelled at deadline, which Python 3.8 stores as CancelledError
+    gathered.add_done_callback(lambda done: done.cancelled() or done.exception())
+    try:
+        resolved = dict(zip(images, await deadlines.within(deadline, gathered, 'tag resolution')))
+    finally:
+        for lookup in lookups:
+            lookup.cancel()
+
+    rewrites = []
+    for container_spec in container_specs:
+        image = container_spec['image']
+        if resolved[image] != image:
+            container_spec['image'] = resolved[image]
+            rewrites.append((image, resolved[image]))
+    return rewrites
 
 
-def init_registries():
+def init_registries(cache_backend: str = 'memory', **cache_limits):
     # Import all known resolver implementations after auth is available
     from tag_resolver_proxy.resolve_tags.docker_io import DockerIOTagResolver
     from tag_resolver_proxy.resolve_tags.quay_io import QuayIOTagResolver
+    from tag_resolver_proxy.resolve_tags.oci import OCIDistributionTagResolver
+
+    for domain in arguments.oci_registries:
+        ResolverMeta.resolvers[domain] = OCIDistributionTagResolver(
+            domain, arguments.auth.get(domain), **arguments.registry_options.get(domain, {}))
+
+    digest_cache = create_cache(cache_backend, **cache_limits)
+    for resolver in ResolverMeta.resolvers.values():
+        resolver.tag_digest_cache = digest_cache
+
+
+def _digest_caches():
+    return {id(resolver.tag_digest_cache): resolver.tag_digest_cache
+            for resolver in ResolverMeta.resolvers.values()}.values()
+
+
+def _digest_cache_stats():
+    stats = collections.Counter()
+    for digest_cache in _digest_caches():
+        stats.update(getattr(digest_cache, 'stats', {}))
+    return (((event,), count) for event, count in stats.items())
+
+
+def _digest_cache_size():
+    caches = [digest_cache for digest_cache in _digest_caches() if isinstance(digest_cache, MemoryDigestCache)]
+    yield ('entries',), sum(len(digest_cache) for digest_cache in caches)
+    yield ('bytes',), sum(digest_cache.size_bytes for digest_cache in caches)
+
+
+def _tags_inflight():
+    return (((domain,), len(resolver.tags_inflight)) for domain, resolver in ResolverMeta.resolvers.items())
+
+
+def _registry_requests():
+    for domain, resolver in ResolverMeta.resolvers.items():
+        yield (domain, 'queued'), resolver.scheduler.queued
+        yield (domain, 'active'), resolver.scheduler.active
+
+
+def _registry_rate_limit():
+    return (((domain,), resolver.scheduler.rate) for domain, resolver in ResolverMeta.resolvers.items())
+
+
+def _registry_throttled():
+    return (((domain,), resolver.scheduler.stats['throttled']) for domain, resolver in ResolverMeta.resolvers.items())
+
+
+metrics.CallbackMetric('kritis_proxy_digest_cache_events_total', 'Digest cache hits, misses and evictions',
+                       'counter', ['event'], _digest_cache_stats)
+metrics.CallbackMetric('kritis_proxy_tags_inflight', 'Tag lookups in flight to registries', 'gauge', ['registry'],
+                       _tags_inflight)
+metrics.CallbackMetric('kritis_proxy_digest_cache_size', 'Digest cache size', 'gauge', ['unit'], _digest_cache_size)
+metrics.CallbackMetric('kritis_proxy_registry_requests', 'Registry requests waiting for a slot and in flight',
+                       'gauge', ['registry', 'state'], _registry_requests)
+metrics.CallbackMetric('kritis_proxy_registry_rate_limit', 'Current registry request rate limit, 0 for none',
+                       'gauge', ['registry'], _registry_rate_limit)
+metrics.CallbackMetric('kritis_proxy_registry_throttled_total', 'Registry responses with HTTP 429 or 503',
+                       'counter', ['registry'], _registry_throttled)
+
+
+async def prewarm_registries(_app=None, connections: int = 1):
+    """Open `connections` connections to every registry host. Used as application startup signal."""
+    await asyncio.gather(*(resolver.prewarm(connections) for resolver in ResolverMeta.resolvers.values()))
+
+
+async def close_registries(_app=None):
+    """Close HTTP clients of all registries. Used as application cleanup signal."""
+    for resolver in ResolverMeta.resolvers.values():
+        await resolver.close()
+
+
+async def load_digest_caches(_app=None):
+    """Warm-load digest caches of all registries. Used as application startup signal."""
+    for digest_cache in _digest_caches():
+        await digest_cache.load()
+
+
+async def close_digest_caches(_app=None):
+    """Close digest caches of all registries. Used as application cleanup signal."""
+    for digest_cache in _digest_caches():
+        await digest_cache.close()
 
 
-__all__ = ['resolve_tags', 'init_registries']
+__all__ = ['resolve_tags', 'resolve_spec_tags', 'init_registries', 'prewarm_registries', 'close_registries',
+           'load_digest_caches', 'close_digest_caches']
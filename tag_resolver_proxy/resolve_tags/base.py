@@ -1,17 +1,60 @@
 import abc
 import asyncio
-import collections
-import contextlib
+import functools
 import logging
-import os
+import time
 
 import aiohttp
 
 import tag_resolver_proxy.arguments
+from tag_resolver_proxy import connections
+from tag_resolver_proxy import deadlines
+from tag_resolver_proxy import metrics
+from tag_resolver_proxy.resolve_tags import cache
+from tag_resolver_proxy.resolve_tags import reference
+from tag_resolver_proxy.resolve_tags import scheduler
+from tag_resolver_proxy.resolve_tags import singleflight
 
 logger = logging.getLogger(__name__)
-ImageProperties = collections.namedtuple('ImageProperties',
-                                         ['url', 'domain', 'org', 'software', 'tag', 'resolver'])
+
+TAG_RESOLUTION_SECONDS = metrics.Histogram(
+    'kritis_proxy_tag_resolution_seconds',
+    'Tag resolution time by registry and outcome: pinned, hit, negative (cached failure), stale, miss, '
+    'inflight (waited for a concurrent lookup) or error', ['registry', 'outcome'])
+DIGEST_REFRESH_FAILURES = metrics.Counter(
+    'kritis_proxy_digest_refresh_failures_total', 'Failed refreshes of expired digests, served stale', ['registry'])
+
+# Accept header of manifest requests: a multi-platform image is pinned by the digest of its index
+MANIFEST_MEDIA_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+])
+
+
+class RegistryUnavailable(AssertionError):
+    """Registry could not be reached or did not answer in time."""
+
+
+# Lookup failures of a registry rather than of the tag, retried on the next admission
+UNCACHED_ERRORS = (scheduler.RegistryThrottled, RegistryUnavailable)
+
+
+class ImageProperties(reference.ImageReference):
+    """Parsed image reference, with the resolver of its registry."""
+
+    __slots__ = ()
+
+    @property
+    def resolver(self) -> 'TagResolver':
+        return ResolverMeta.resolvers[self.domain]
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_image_url(image_url: str) -> ImageProperties:
+    """Parse image URL, once for repeated images."""
+    return ImageProperties._make(reference.parse(image_url))
 
 
 class ResolverMeta(type):
@@ -22,69 +65,100 @@ class ResolverMeta(type):
         cls = super(ResolverMeta, mcs).__new__(mcs, *args, **kwargs)
         base_uri = getattr(cls, 'registry_base_uri', None)
         if base_uri and not isinstance(base_uri, property):
-            mcs.resolvers[base_uri] = cls(tag_resolver_proxy.arguments.auth.get(base_uri))
+            mcs.resolvers[base_uri] = cls(tag_resolver_proxy.arguments.auth.get(base_uri),
+                                          **tag_resolver_proxy.arguments.registry_options.get(base_uri, {}))
         return cls
 
     @classmethod
     def for_image_url(mcs, image_url) -> ImageProperties:
         """Finds a suitable resolver for given image URL.
 
-        Parses necessary metadata from URL. Picks right resolves.
-
-        Bundles metadata with URL into ImageProperties object.
+        Parses the URL into ImageProperties, whose resolver is the one of its registry.
 
         Performs initial validation for image URL.
         """
-        if ':' in image_url:
-            repo, tag = image_url.split(':')
-        else:
-            tag = 'latest'
-            repo = None
-
-        assert tag != 'latest', 'Can not use latest tag'
-
-        parts = repo.split('/')
-
-        if len(parts) == 1:
-            # docker.io/library
-            domain, org = 'docker.io', 'library'
-            software = parts[0]
-        elif len(parts) == 2:
-            # docker.io/{org}
-            domain = 'docker.io'
-            software, org = parts
-        elif len(parts) == 3:
-            domain, org, software = parts
-        else:
-            raise AssertionError(f'An image URL must have '
-                                 f'format hub/org/software')
+        image_props = parse_image_url(image_url)
 
-        assert domain in mcs.resolvers, f'Unknown Docker registry: {domain}'
+        assert image_props.tag not in ('latest', None) or image_props.digest, 'Can not use latest tag'
+        assert image_props.domain in mcs.resolvers, f'Unknown Docker registry: {image_props.domain}'
 
-        return ImageProperties(
-            image_url,
-            domain=domain,
-            org=org,
-            software=software,
-            tag=tag,
-            resolver=mcs.resolvers[domain],
-        )
+        return image_props
 
 
 class TagResolver(metaclass=ResolverMeta):
     """Resolves tags against remote Quay or Docker repository."""
 
-    def __init__(self, token_file):
+    # Seconds in-flight lookups may keep using an HTTP client replaced on token reload
+    client_close_delay = 60
+    # Token lifetime assumed by Docker registry auth spec, when expires_in is missing
+    default_token_ttl = 60
+    # Refresh tokens in background when they are about to expire in this many seconds
+    token_refresh_ahead = 20
+    # Longest Retry-After of a throttling registry to wait out within an admission, seconds
+    max_throttle_wait = 5
+    # Throttled attempts of a single request before giving up, e.g. on repeated Retry-After: 0
+    max_throttle_attempts = 5
+
+    def __init__(self, token_file, rate_limit: float = 0, burst: int = 10, max_requests: int = 16,
+                 lookup_timeout: float = None, pool_options: dict = None):
         self.client = None
-        self.tag_digest_cache = {}
-        self.tags_inflight = {}
-
-        if token_file and os.path.exists(token_file):
-            with open(token_file, 'r') as tkn:
-                self.token = tkn.read().strip()
-                logger.info('Loaded token file')
-        else:
+        # Connection pool settings of connections.create_session
+        self.pool_options = pool_options or {}
+        self.tag_digest_cache = cache.MemoryDigestCache()
+        self.tags_inflight = singleflight.SingleFlight()
+        self.lookup_timeout = lookup_timeout or None
+        self.revalidations = set()
+        self.scheduler = scheduler.RegistryScheduler(rate_limit, burst, max_requests)
+        self.scope_tokens = {}
+        self.scope_token_fetches = {}
+        # TAG_RESOLUTION_SECONDS children of the registry by outcome, looked up once
+        self.resolution_seconds = {}
+        self.token_file = token_file
+        self.token = None
+        self.load_token()
+
+    def load_token(self, keep_previous: bool = False):
+        """Read registry token from token file, if any.
+
+        A token file which can not be read leaves the registry without token,
+        or with its previous token with `keep_previous`.
+        """
+        previous_token = self.token
+        if not self.token_file:
             self.token = None
+        else:
+            try:
+                with open(self.token_file, 'r') as tkn:
+                    self.token = tkn.read().strip()
+                    logger.info('Loaded token file')
+            except OSError as exc:
+                if keep_previous:
+                    logger.warning('Keeping previous token, can not read %s: %r', self.token_file, exc)
+                    return
+                logger.warning('Continuing without token, can not read %s: %r', self.token_file, exc)
+                self.token = None
+        if self.token != previous_token:
+            # Scope tokens granted with previous credentials
+            self.scope_tokens.clear()
+
+    def reload_token(self):
+        """Re-read changed token file, replacing HTTP client authenticated with the previous token.
+
+        Lookups in flight finish with the previous client, which is closed later.
+        Cached digests are kept, as is the previous token if the file is missing, e.g. while a secret is remounted.
+        """
+        previous_token = self.token
+        self.load_token(keep_previous=True)
+        if self.token == previous_token:
+            return
+        logger.info('Reloaded %s token file %s', self.registry_base_uri, self.token_file)
+
+        previous_client = self.client
+        if previous_client is not None:
+            self.client = None
+            self.ensure_client()
+            asyncio.get_event_loop().call_later(
+                self.client_close_delay, lambda: asyncio.ensure_future(previous_client.close()))
 
     @property
     @abc.abstractmethod
@@ -98,55 +172,194 @@ class TagResolver(metaclass=ResolverMeta):
         raise NotImplementedError()
 
     def ensure_client(self):
-        """Create HTTP client for interacting with Docker registry."""
+        """Create HTTP client for interacting with Docker registry, over a connection pool of its own."""
         if self.client is None:
-            self.client = aiohttp.client.ClientSession(
+            self.client = connections.create_session(
+                f'registry:{self.registry_base_uri}',
                 headers=self.get_client_headers(),
+                **self.pool_options,
             )
 
+    def connection_urls(self) -> list:
+        """URLs of registry hosts, whose connections are opened at startup."""
+        return []
+
+    async def prewarm(self, connections_per_host: int):
+        """Open connections to registry hosts before serving."""
+        self.ensure_client()
+        for url in self.connection_urls():
+            await connections.prewarm(self.client, url, connections_per_host)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def registry_request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """Send request to registry within its rate and concurrency limits.
+
+        A throttled request is retried once the registry allows, unless it asks to wait
+        longer than `max_throttle_wait` seconds or throttled `max_throttle_attempts` attempts,
+        which fails the lookup without caching the failure.
+        """
+        self.ensure_client()
+        for _ in range(self.max_throttle_attempts):
+            async with self.scheduler.slot():
+                response = await getattr(self.client, method)(url, **kwargs)
+            if response.status not in scheduler.THROTTLE_STATUSES:
+                self.scheduler.succeeded()
+                return response
+
+            response.release()
+            wait = self.scheduler.throttled(response.headers.get('Retry-After'))
+            logger.warning('%s throttled request with HTTP %d, retrying in %.1f seconds',
+                           self.registry_base_uri, response.status, wait)
+            if wait > self.max_throttle_wait:
+                raise scheduler.RegistryThrottled(
+                    f'{self.registry_base_uri} throttled request with HTTP {response.status}, '
+                    f'retry after {wait:.0f} seconds')
+        raise scheduler.RegistryThrottled(
+            f'{self.registry_base_uri} throttled request {self.max_throttle_attempts} times in a row')
+
+    async def ensure_scope_token(self, scope: str, fetch) -> str:
+        """Return a registry token for scope, fetching it with `fetch` coroutine function on a miss.
+
+        `fetch` returns the token with its expiry time. Tokens are cached per scope until
+        they expire, and refreshed in background shortly before. Concurrent misses share one fetch.
+        """
+        token, expires_at = self.scope_tokens.get(scope, (None, 0))
+        now = time.time()
+
+        if token and expires_at - now > self.token_refresh_ahead:
+            return token
+
+        scope_fetch = self.scope_token_fetches.get(scope)
+        if scope_fetch is None:
+            scope_fetch = self.scope_token_fetches[scope] = asyncio.ensure_future(self._fetch_scope_token(scope, fetch))
+            scope_fetch.add_done_callback(lambda done: self._scope_token_fetched(scope, done))
+
+        if token and expires_at > now:
+            return token
+        return await asyncio.shield(scope_fetch)
+
+    async def _fetch_scope_token(self, scope: str, fetch) -> str:
+        token, expires_at = await fetch()
+        self.scope_tokens[scope] = (token, expires_at)
+        return token
+
+    def _scope_token_fetched(self, scope: str, fetch: asyncio.Future):
+        self.scope_token_fetches.pop(scope, None)
+        if not fetch.cancelled() and fetch.exception() is not None:
+            logger.warning('%s token fetch for %s failed: %r', self.registry_base_uri, scope, fetch.exception())
+
     def get_client_headers(self):
         """Retrieve headers for HTTP client authentication."""
         return {
             'User-Agent': 'kritis-reverse-proxy',
         }
 
-    @contextlib.asynccontextmanager
-    async def guard_event(self, image_url):
-        """Guard event for image URL, protecting tag cache of simultaneous access."""
-
-        self.tags_inflight[image_url] = asyncio.Event()
-        try:
-            yield
-        finally:
-            self.tags_inflight.pop(image_url).set()
-
-    async def resolve_tags(self, image_props: ImageProperties):
+    async def resolve_tags(self, image_props: ImageProperties, deadline: float = None):
         """Resolve tags for given k8s container spec.
 
         Cache the value for further usage.
         kritis-reverse-proxy assumes you don't use latest, and tags are immutable.
+        Digests expired for less than digest cache `stale_while_revalidate` seconds are returned
+        at once and refreshed in background. Older ones, up to `stale_if_error` seconds, are refreshed
+        before returning, falling back to the stale digest when the refresh fails.
+        Waiting for the lookup stops at `lookup_timeout` or the admission `deadline`, whichever comes first.
 
         :param image_props: Image IRL metadata properties, extracted into named tuple.
         """
         image = image_props.url
+        started = time.perf_counter()
+        outcome = 'error'
 
-        if '@sha256' in image:
-            logger.warning('Tag already resolved for %s', image)
-            resolved = image
-        else:
-
-            if image not in self.tag_digest_cache:
-
-                if image in self.tags_inflight:
-                    await self.tags_inflight[image].wait()
-                    resolved = self.tag_digest_cache[image]
+        try:
+            if image_props.digest:
+                logger.debug('Tag already resolved for %s', image)
+                outcome = 'pinned'
+                return image
+
+            entry = await self.tag_digest_cache.get_entry(image, stale=True)
+            stale_entry = None
+            if entry is not None and self.tag_digest_cache.is_stale(entry):
+                if time.time() - entry.expires_at <= self.tag_digest_cache.stale_while_revalidate:
+                    self.revalidate(image_props, entry)
+                    outcome = 'stale'
                 else:
-                    async with self.guard_event(image):
-                        self.ensure_client()
-                        resolved = await self.resolve_single_image(image_props)
-
-                self.tag_digest_cache[image] = resolved
-            else:
-                resolved = self.tag_digest_cache[image]
-
-        return resolved
+                    stale_entry, entry = entry, None
+            elif entry is not None:
+                outcome = 'hit'
+
+            if entry is None:
+                outcome = 'inflight' if image in self.tags_inflight else 'miss'
+                timeout = deadlines.remaining(deadline)
+                if self.lookup_timeout is not None and (timeout is None or self.lookup_timeout < timeout):
+                    timeout = self.lookup_timeout
+                try:
+                    entry = await self.tags_inflight.do(
+                        image, lambda: self.resolve_entry(image_props, stale_entry), timeout)
+                except asyncio.TimeoutError:
+                    if deadlines.expired(deadline):
+                        raise deadlines.DeadlineExceeded(f'Admission deadline exceeded resolving tag for {image}') \
+                            from None
+                    raise AssertionError(f'Timed out resolving tag for {image}') from None
+                if entry is stale_entry:
+                    outcome = 'stale'
+
+            if not entry.resolved:
+                outcome = 'negative' if outcome == 'hit' else 'error'
+            assert entry.resolved, entry.error
+            return entry.resolved
+        finally:
+            elapsed = time.perf_counter() - started
+            resolution_seconds = self.resolution_seconds.get(outcome)
+            if resolution_seconds is None:
+                resolution_seconds = self.resolution_seconds[outcome] = \
+                    TAG_RESOLUTION_SECONDS.labels(image_props.domain, outcome)
+            resolution_seconds.observe(elapsed)
+
+    def revalidate(self, image_props: ImageProperties, stale_entry: cache.CacheEntry):
+        """Refresh stale digest in background, unless it is being resolved already."""
+        if image_props.url in self.tags_inflight:
+            return
+        revalidation = asyncio.ensure_future(self._revalidate(image_props, stale_entry))
+        self.revalidations.add(revalidation)
+        revalidation.add_done_callback(self.revalidations.discard)
+
+    async def _revalidate(self, image_props: ImageProperties, stale_entry: cache.CacheEntry):
+        try:
+            await self.tags_inflight.do(image_props.url, lambda: self.resolve_entry(image_props, stale_entry))
+        except Exception:
+            logger.exception('Refresh of %s failed', image_props.url)
+
+    async def prefetch_repository(self, org: str, software: str) -> int:
+        """Fill digest cache with all tags of a repository, returning the number of cached tags."""
+        logger.warning('Repository prefetch is not supported for %s', self.registry_base_uri)
+        return 0
+
+    async def resolve_entry(self, image_props: ImageProperties,
+                            stale_entry: cache.CacheEntry = None) -> cache.CacheEntry:
+        """Resolve image digest and cache the result.
+
+        Failed assertions are cached too, so a bad tag does not hit the registry on every admission,
+        unless the registry throttled the lookup. Connection failures and timeouts are raised as
+        RegistryUnavailable, which is not cached either. When refreshing `stale_entry` fails,
+        it is returned instead.
+        """
+        self.ensure_client()
+        try:
+            try:
+                resolved = await self.resolve_single_image(image_props)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                raise RegistryUnavailable(f'Can not retrieve docker image digest: {exc!r}') from exc
+        except Exception as exc:
+            if stale_entry is not None:
+                DIGEST_REFRESH_FAILURES.labels(image_props.domain).inc()
+                logger.warning('Serving stale digest of %s, refresh failed: %r', image_props.url, exc)
+                return stale_entry
+            if isinstance(exc, AssertionError) and not isinstance(exc, UNCACHED_ERRORS):
+                return await self.tag_digest_cache.set_error(
+                    image_props.url, str(exc) or f'Can not resolve tag for {image_props.url}')
+            raise
+        return await self.tag_digest_cache.set(image_props.url, resolved)
@@ -0,0 +1,332 @@
+"""Tag to digest cache backends.
+
+Every backend keeps resolved digests in a bounded in-process LRU.
+Positive entries expire after `ttl` seconds, since tags like `v1` may move,
+and failed lookups are cached for `negative_ttl` seconds.
+Expiry is jittered so entries stored together do not expire together.
+Expired digests may be kept for `stale_while_revalidate` and `stale_if_error`
+seconds, to be served while they are refreshed or when a refresh fails.
+
+Persistent backends write resolved digests through to a shared store,
+warm-load it at startup and fall back to it on local misses,
+so restarts and other replicas start with a warm cache.
+"""
+import abc
+import asyncio
+import collections
+import json
+import logging
+import random
+import sqlite3
+import sys
+import time
+import typing
+import urllib.parse
+
+import aiohttp
+
+
+logger = logging.getLogger(__name__)
+
+CacheEntry = collections.namedtuple('CacheEntry', ['resolved', 'error', 'expires_at'])
+
+# Approximate size of OrderedDict slot and CacheEntry tuple per entry
+ENTRY_OVERHEAD = 200
+
+
+class DigestCache(abc.ABC):
+    """Maps a tagged image URL to the digest image URL it resolves to."""
+
+    stale_while_revalidate = 0
+    stale_if_error = 0
+
+    @staticmethod
+    def is_stale(entry: CacheEntry) -> bool:
+        return entry.expires_at is not None and entry.expires_at <= time.time()
+
+    async def load(self):
+        """Warm up the cache before serving requests."""
+
+    async def close(self):
+        """Release resources held by the cache."""
+
+    @abc.abstractmethod
+    async def get_entry(self, image: str, stale: bool = False) -> typing.Optional[CacheEntry]:
+        """Return cached lookup result, or None on cache miss.
+
+        With `stale`, expired digests kept for stale serving are returned too.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def set(self, image: str, resolved: str) -> CacheEntry:
+        """Store resolved image URL."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def set_error(self, image: str, error: str) -> CacheEntry:
+        """Store failed lookup message."""
+        raise NotImplementedError()
+
+    async def set_many(self, resolved: typing.Mapping[str, str]) -> typing.List[CacheEntry]:
+        """Store resolved image URLs of many images at once, e.g. of a repository listing."""
+        return [await self.set(image, resolved_url) for image, resolved_url in resolved.items()]
+
+    async def get(self, image: str) -> typing.Optional[str]:
+        """Return resolved image URL, or None on cache miss or cached failure."""
+        entry = await self.get_entry(image)
+        return entry.resolved if entry else None
+
+
+class MemoryDigestCache(DigestCache):
+    """Per-process LRU cache, bounded by entry count and approximate memory size."""
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None,
+                 ttl: float = None, negative_ttl: float = 30, jitter: float = 0.1,
+                 stale_while_revalidate: float = 0, stale_if_error: float = 0):
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.jitter = jitter
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.stats = collections.Counter(hits=0, negative_hits=0, stale_hits=0, misses=0, expirations=0, evictions=0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def expires_at(self, ttl: typing.Optional[float]) -> typing.Optional[float]:
+        """Jittered absolute expiry time for given TTL, None for entries which never expire."""
+        if not ttl:
+            return None
+        return time.time() + ttl * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def lookup(self, image: str, stale: bool = False) -> typing.Optional[CacheEntry]:
+        """Synchronously look up local entry, counting hits and misses."""
+        entry = self._entries.get(image)
+        if entry is not None and self.is_stale(entry):
+            stale_ttl = max(self.stale_while_revalidate, self.stale_if_error)
+            if not entry.resolved or entry.expires_at + stale_ttl <= time.time():
+                self._remove(image)
+                self.stats['expirations'] += 1
+                entry = None
+            elif not stale:
+                entry = None
+
+        if entry is None:
+            self.stats['misses'] += 1
+        elif self.is_stale(entry):
+            self._entries.move_to_end(image)
+            self.stats['stale_hits'] += 1
+        else:
+            self._entries.move_to_end(image)
+            self.stats['hits' if entry.resolved else 'negative_hits'] += 1
+        return entry
+
+    def store(self, image: str, entry: CacheEntry) -> CacheEntry:
+        """Synchronously store local entry, evicting least recently used entries over the limits."""
+        if image in self._entries:
+            self._remove(image)
+
+        size = sys.getsizeof(image) + sys.getsizeof(entry.resolved or entry.error) + ENTRY_OVERHEAD
+        self._entries[image] = entry
+        self._sizes[image] = size
+        self._bytes += size
+
+        while self._entries and (
+                (self.max_entries and len(self._entries) > self.max_entries) or
+                (self.max_bytes and self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+        return entry
+
+    def _remove(self, image: str):
+        del self._entries[image]
+        self._bytes -= self._sizes.pop(image)
+
+    async def get_entry(self, image: str, stale: bool = False) -> typing.Optional[CacheEntry]:
+        return self.lookup(image, stale)
+
+    async def set(self, image: str, resolved: str) -> CacheEntry:
+        return self.store(image, CacheEntry(resolved, None, self.expires_at(self.ttl)))
+
+    async def set_error(self, image: str, error: str) -> CacheEntry:
+        return self.store(image, CacheEntry(None, error, self.expires_at(self.negative_ttl)))
+
+    async def set_many(self, resolved: typing.Mapping[str, str]) -> typing.List[CacheEntry]:
+        return [self.store(image, CacheEntry(resolved_url, None, self.expires_at(self.ttl)))
+                for image, resolved_url in resolved.items()]
+
+
+class SqliteDigestCache(MemoryDigestCache):
+    """Write-through cache persisted into a sqlite database file.
+
+    The file may be shared by several proxy processes on the same host.
+    Only resolved digests are persisted. Queries run on the event loop, so a locked
+    database is waited for at most `timeout` seconds. Database failures are logged
+    and treated as cache misses.
+    """
+
+    def __init__(self, path: str, timeout: float = 0.05, **limits):
+        super().__init__(**limits)
+        self._path = path
+        self._timeout = timeout
+        self._db = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('CREATE TABLE IF NOT EXISTS digests '
+                           '(image TEXT PRIMARY KEY, resolved TEXT NOT NULL, expires_at REAL)')
+            except sqlite3.Error:
+                db.close()
+                raise
+            self._db = db
+        return self._db
+
+    async def load(self):
+        try:
+            rows = self._connect().execute(
+                'SELECT image, resolved, expires_at FROM digests WHERE expires_at IS NULL OR expires_at > ?',
+                (time.time(),),
+            ).fetchall()
+        except sqlite3.Error as exc:
+            logger.warning('Loading digests from %s failed: %r', self._path, exc)
+            return
+        for image, resolved, expires_at in rows:
+            self.store(image, CacheEntry(resolved, None, expires_at))
+        logger.info('Loaded %d digests from %s', len(self), self._path)
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def get_entry(self, image: str, stale: bool = False) -> typing.Optional[CacheEntry]:
+        entry = self.lookup(image, stale)
+        # Another process may have refreshed a stale digest
+        if entry is None or self.is_stale(entry):
+            try:
+                row = self._connect().execute(
+                    'SELECT resolved, expires_at FROM digests '
+                    'WHERE image = ? AND (expires_at IS NULL OR expires_at > ?)',
+                    (image, time.time()),
+                ).fetchone()
+            except sqlite3.Error as exc:
+                logger.warning('Digest store lookup for %s failed: %r', image, exc)
+                row = None
+            if row:
+                entry = self.store(image, CacheEntry(row[0], None, row[1]))
+        return entry
+
+    async def set(self, image: str, resolved: str) -> CacheEntry:
+        entry = await super().set(image, resolved)
+        try:
+            self._connect().execute('INSERT OR REPLACE INTO digests (image, resolved, expires_at) VALUES (?, ?, ?)',
+                                    (image, resolved, entry.expires_at))
+        except sqlite3.Error as exc:
+            logger.warning('Digest store update for %s failed: %r', image, exc)
+        return entry
+
+    async def set_many(self, resolved: typing.Mapping[str, str]) -> typing.List[CacheEntry]:
+        """Store digests locally, then persist them in a single transaction."""
+        entries = await super().set_many(resolved)
+        try:
+            with self._connect() as db:
+                db.execute('BEGIN')
+                db.executemany('INSERT OR REPLACE INTO digests (image, resolved, expires_at) VALUES (?, ?, ?)',
+                               [(image, entry.resolved, entry.expires_at) for image, entry in zip(resolved, entries)])
+        except sqlite3.Error as exc:
+            logger.warning('Digest store update of %d digests failed: %r', len(entries), exc)
+        return entries
+
+
+class HttpDigestCache(MemoryDigestCache):
+    """Write-through cache shared over a network key-value store.
+
+    The store serves `GET` and `PUT` on `{base_uri}/{quoted image URL}`, with a JSON
+    body holding `resolved` image URL and its `expires_at` timestamp.
+    Only resolved digests are shared. Store failures are logged and treated as cache misses.
+    """
+
+    def __init__(self, base_uri: str, timeout: float = 1.0, **limits):
+        super().__init__(**limits)
+        self._base_uri = base_uri.rstrip('/')
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._client = None
+
+    def _url(self, image: str) -> str:
+        return f'{self._base_uri}/{urllib.parse.quote(image, safe="")}'
+
+    def _ensure_client(self) -> aiohttp.ClientSession:
+        if self._client is None:
+            self._client = aiohttp.ClientSession(timeout=self._timeout)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def get_entry(self, image: str, stale: bool = False) -> typing.Optional[CacheEntry]:
+        entry = self.lookup(image, stale)
+        # Another replica may have refreshed a stale digest
+        if entry is None or self.is_stale(entry):
+            try:
+                async with self._ensure_client().get(self._url(image)) as response:
+                    if response.status == 200:
+                        stored = json.loads(await response.text())
+                        if stored['expires_at'] is None or stored['expires_at'] > time.time():
+                            entry = self.store(image, CacheEntry(stored['resolved'], None, stored['expires_at']))
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError, ValueError, KeyError) as exc:
+                logger.warning('Digest store lookup for %s failed: %r', image, exc)
+        return entry
+
+    async def _put(self, image: str, entry: CacheEntry):
+        try:
+            stored = json.dumps({'resolved': entry.resolved, 'expires_at': entry.expires_at})
+            async with self._ensure_client().put(self._url(image), data=stored) as response:
+                response.raise_for_status()
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as exc:
+            logger.warning('Digest store update for %s failed: %r', image, exc)
+
+    async def set(self, image: str, resolved: str) -> CacheEntry:
+        entry = await super().set(image, resolved)
+        await self._put(image, entry)
+        return entry
+
+    async def set_many(self, resolved: typing.Mapping[str, str]) -> typing.List[CacheEntry]:
+        entries = await super().set_many(resolved)
+        await asyncio.gather(*[self._put(image, entry) for image, entry in zip(resolved, entries)])
+        return entries
+
+
+def create_cache(backend: str, **limits) -> DigestCache:
+    """Construct a digest cache from `--cache-backend` value.
+
+    Supported values are `memory`, `sqlite:///path/to/cache.db` and `http(s)://host:port/prefix`.
+    Keyword arguments configure size limits and TTLs of the in-process LRU.
+    """
+    parts = urllib.parse.urlsplit(backend)
+
+    if backend == 'memory':
+        return MemoryDigestCache(**limits)
+    elif parts.scheme == 'sqlite':
+        return SqliteDigestCache(parts.netloc + parts.path, **limits)
+    elif parts.scheme in ('http', 'https'):
+        return HttpDigestCache(backend, **limits)
+    else:
+        raise ValueError(f'Unknown cache backend: {backend}')
+
+
+__all__ = ['CacheEntry', 'DigestCache', 'MemoryDigestCache', 'SqliteDigestCache', 'HttpDigestCache', 'create_cache']
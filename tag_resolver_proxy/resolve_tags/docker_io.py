@@ -1,5 +1,8 @@
 import base64
+import datetime
 import logging
+import re
+import time
 import urllib.parse
 
 from tag_resolver_proxy.resolve_tags import base
@@ -7,56 +10,85 @@ from tag_resolver_proxy.resolve_tags import base
 logger = logging.getLogger(__name__)
 
 
+def parse_issued_at(issued_at: str) -> float:
+    """Parse RFC 3339 token issue time into UNIX timestamp, returning None if unparseable."""
+    if not issued_at:
+        return None
+    # Trim nanoseconds and Zulu suffix unsupported by datetime.fromisoformat
+    issued_at = re.sub(r'(\.\d{6})\d+', r'\1', issued_at).replace('Z', '+00:00')
+    try:
+        return datetime.datetime.fromisoformat(issued_at).timestamp()
+    except ValueError:
+        return None
+
+
 class DockerIOTagResolver(base.TagResolver):
 
     registry_base_uri = 'docker.io'
     api_base_uri = f'https://index.{registry_base_uri}'
     auth_url = 'https://auth.docker.io'
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def connection_urls(self) -> list:
+        return [f'{self.api_base_uri}/v2/', f'{self.auth_url}/']
 
+    def load_token(self, keep_previous: bool = False):
+        super().load_token(keep_previous)
         if self.token:
             # --docker-auth-file must contain <username>:<password>
-            self._auth_str = base64.b64encode(self.token).decode()
+            self._auth_str = base64.b64encode(self.token.encode()).decode()
+
+    @staticmethod
+    def token_scope(image_props: base.ImageProperties) -> str:
+        return f'repository:{image_props.org}/{image_props.software}:pull'
 
     def login_uri(self, image_props: base.ImageProperties) -> str:
         query = urllib.parse.urlencode(
             {
-                'scope': f'repository:{image_props.org}/{image_props.software}:pull',
+                'scope': self.token_scope(image_props),
                 'service': 'registry.docker.io',
             },
         )
         return f'{self.auth_url}/token?{query}'
 
     async def ensure_docker_io_temporary_token(self, image_props: base.ImageProperties) -> str:
-        self.ensure_client()
-        response = await self.client.get(
-            url=self.login_uri(image_props),
+        """Return a pull token for image repository, cached per repository scope."""
+        return await self.ensure_scope_token(
+            self.token_scope(image_props), lambda: self.fetch_docker_io_temporary_token(image_props))
+
+    async def fetch_docker_io_temporary_token(self, image_props: base.ImageProperties) -> tuple:
+        """Fetch a pull token for image repository, returning it with its expiry time."""
+        requested_at = time.time()
+        response = await self.registry_request(
+            'get',
+            self.login_uri(image_props),
             headers={
                 'Content-Type': 'application/json',
             }
         )
         response_data = await response.json()
-        temp_token = response_data.get('token')
+        temp_token = response_data.get('token') or response_data.get('access_token')
         assert temp_token, 'Can not authenticate with Docker.io'
-        return temp_token
+
+        issued_at = parse_issued_at(response_data.get('issued_at')) or requested_at
+        expires_in = response_data.get('expires_in') or self.default_token_ttl
+        return temp_token, min(issued_at, requested_at) + expires_in
 
     async def resolve_single_image(self, image_props: base.ImageProperties) -> str:
-        """Resolve single image digest using Docker Hub API."""
+        """Resolve single image digest with a registry v2 manifest HEAD request."""
 
         token = await self.ensure_docker_io_temporary_token(image_props)
 
-        digest = (
-            await self.client.get(
-                f'{self.api_base_uri}'
-                f'/v2/{image_props.org}/{image_props.software}/manifests/{image_props.tag}',
-                headers={
-                    'Accept': 'application/vnd.docker.distribution.manifest.v2+json',
-                    'Authorization': f'Bearer {token}',
-                }
-            )
-        ).headers.get('Docker-Content-Digest')
+        response = await self.registry_request(
+            'head',
+            f'{self.api_base_uri}'
+            f'/v2/{image_props.org}/{image_props.software}/manifests/{image_props.tag}',
+            headers={
+                'Accept': base.MANIFEST_MEDIA_TYPES,
+                'Authorization': f'Bearer {token}',
+            }
+        )
+        response.release()
+        digest = response.headers.get('Docker-Content-Digest') if response.status == 200 else None
 
         assert digest, 'Can not retrieve docker image digest'
 
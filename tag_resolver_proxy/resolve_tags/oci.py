@@ -0,0 +1,125 @@
+"""Tag resolver of any registry implementing the OCI distribution API, e.g. gcr.io, ghcr.io or Harbor.
+
+Registries are configured with `--oci-registry`. Authentication follows the
+`WWW-Authenticate` challenge of the registry: a Bearer challenge is answered
+with a token of the repository scope from the challenge realm, a Basic one
+with the credentials of the registry auth file, holding `<username>:<password>`.
+"""
+import base64
+import hashlib
+import logging
+import re
+import time
+import typing
+
+from tag_resolver_proxy.resolve_tags import base
+from tag_resolver_proxy.resolve_tags.docker_io import parse_issued_at
+
+logger = logging.getLogger(__name__)
+
+CHALLENGE_PARAM = re.compile(r'(\w+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^\s,]+))')
+
+
+def parse_challenge(www_authenticate: typing.Optional[str]) -> tuple:
+    """Lower case scheme and parameters of `WWW-Authenticate` header."""
+    scheme, _, params = (www_authenticate or '').strip().partition(' ')
+    return scheme.lower(), {
+        match.group(1).lower(): match.group(2) if match.group(2) is not None else match.group(3)
+        for match in CHALLENGE_PARAM.finditer(params)
+    }
+
+
+class OCIDistributionTagResolver(base.TagResolver):
+    """Resolves tags with manifest HEAD requests to registry `domain`, served at `api_base_uri`.
+
+    The challenge of the first unauthorized response is kept, so later lookups
+    authenticate up front. Each registry has its own HTTP client and connection pool.
+    """
+
+    def __init__(self, domain: str, token_file=None, api_base_uri: str = None, **limits):
+        self.domain = domain
+        self.api_base_uri = (api_base_uri or f'https://{domain}').rstrip('/')
+        self.challenge = None
+        super().__init__(token_file, **limits)
+
+    @property
+    def registry_base_uri(self) -> str:
+        return self.domain
+
+    def connection_urls(self) -> list:
+        return [f'{self.api_base_uri}/v2/']
+
+    def basic_authorization(self) -> str:
+        assert self.token, f'No credentials for {self.domain}'
+        return 'Basic ' + base64.b64encode(self.token.encode()).decode()
+
+    async def fetch_token(self, params: dict, scope: str) -> tuple:
+        """Fetch Bearer token for scope from challenge realm, returning it with its expiry time."""
+        requested_at = time.time()
+        query = {'scope': scope}
+        if params.get('service'):
+            query['service'] = params['service']
+        response = await self.registry_request(
+            'get', params['realm'], params=query,
+            headers={'Authorization': self.basic_authorization()} if self.token else {},
+        )
+        response_data = await response.json(content_type=None) if response.status == 200 else {}
+        response.release()
+        token = response_data.get('token') or response_data.get('access_token')
+        assert token, f'Can not authenticate with {self.domain}: HTTP {response.status}'
+
+        issued_at = parse_issued_at(response_data.get('issued_at')) or requested_at
+        expires_in = response_data.get('expires_in') or self.default_token_ttl
+        return token, min(issued_at, requested_at) + expires_in
+
+    async def authorization(self, scope: str) -> typing.Optional[str]:
+        """Authorization header answering the known challenge of the registry, if any."""
+        if self.challenge is None:
+            return None
+        scheme, params = self.challenge
+        if scheme == 'bearer':
+            assert params.get('realm'), f'{self.domain} Bearer challenge has no realm'
+            return 'Bearer ' + await self.ensure_scope_token(scope, lambda: self.fetch_token(params, scope))
+        assert scheme == 'basic', f'Unsupported {self.domain} authentication scheme: {scheme}'
+        return self.basic_authorization()
+
+    async def manifest_request(self, method: str, image_props: base.ImageProperties):
+        """Send manifest request, authenticating once more after an unauthorized response."""
+        url = f'{self.api_base_uri}/v2/{image_props.path}/manifests/{image_props.tag}'
+        scope = f'repository:{image_props.path}:pull'
+        for attempt in range(2):
+            headers = {'Accept': base.MANIFEST_MEDIA_TYPES}
+            authorization = await self.authorization(scope)
+            if authorization:
+                headers['Authorization'] = authorization
+            response = await self.registry_request(method, url, headers=headers)
+            if response.status != 401 or attempt:
+                return response
+            response.release()
+            self.challenge = parse_challenge(response.headers.get('WWW-Authenticate'))
+            self.scope_tokens.pop(scope, None)
+
+    async def resolve_single_image(self, image_props: base.ImageProperties) -> str:
+        """Resolve single image digest from `Docker-Content-Digest` header of manifest HEAD request.
+
+        Registries omitting the header on HEAD are asked for the manifest, whose digest is its SHA-256.
+        """
+        response = await self.manifest_request('head', image_props)
+        response.release()
+        digest = response.headers.get('Docker-Content-Digest')
+
+        if response.status == 200 and not digest:
+            response = await self.manifest_request('get', image_props)
+            if response.status == 200:
+                digest = 'sha256:' + hashlib.sha256(await response.read()).hexdigest()
+            response.release()
+
+        assert response.status != 404, f'Unknown image {image_props.url}'
+        assert response.status != 401, f'Can not authenticate with {self.domain}'
+        assert response.status == 200 and digest, \
+            f'Can not retrieve {image_props.url} digest: HTTP {response.status}'
+
+        return f'{image_props.domain}/{image_props.path}@{digest}'
+
+
+__all__ = ['OCIDistributionTagResolver', 'parse_challenge']
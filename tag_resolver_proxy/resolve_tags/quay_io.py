@@ -1,30 +1,157 @@
+import logging
+import time
+import typing
+import urllib.parse
+
+import aiohttp
+
 from tag_resolver_proxy.resolve_tags import base
 from tag_resolver_proxy.resolve_tags.base import ImageProperties
 
+logger = logging.getLogger(__name__)
+
+QUAY_API_BASE_URI = 'https://quay.io'
+
 
-def quay_repository_url(organization: str, software: str) -> str:
-    return f'https://quay.io/api/v1/repository/{organization}/{software}'
+def quay_repository_url(organization: str, software: str, api_base_uri: str = QUAY_API_BASE_URI) -> str:
+    return f'{api_base_uri}/api/v1/repository/{organization}/{software}'
+
+
+def quay_tag_url(organization: str, software: str, tag: str, api_base_uri: str = QUAY_API_BASE_URI) -> str:
+    query = urllib.parse.urlencode({'specificTag': tag, 'onlyActiveTags': 'true', 'limit': 1})
+    return f'{quay_repository_url(organization, software, api_base_uri)}/tag/?{query}'
 
 
 class QuayIOTagResolver(base.TagResolver):
+    """Resolves Quay tags.
+
+    `resolve_mode` selects how a digest is looked up:
+
+    - `tag` asks Quay API for the single tag;
+    - `manifest` reads `Docker-Content-Digest` of a registry v2 manifest HEAD request;
+    - `repository` downloads the whole repository tag listing.
+
+    The repository listing is used as a fallback when the single tag lookup fails,
+    but not when the tag API answers that the tag does not exist.
+    With `prefetch` enabled, every tag of a downloaded listing is put into digest cache.
+    """
 
     registry_base_uri = 'quay.io'
+    api_base_uri = QUAY_API_BASE_URI
+    resolve_modes = ('tag', 'manifest', 'repository')
+
+    def __init__(self, token_file, resolve_mode: str = 'tag', prefetch: bool = False, **limits):
+        super().__init__(token_file, **limits)
+        assert resolve_mode in self.resolve_modes, f'Unknown Quay resolve mode: {resolve_mode}'
+        self.resolve_mode = resolve_mode
+        self.prefetch = prefetch
+
+    def connection_urls(self) -> list:
+        return [f'{self.api_base_uri}/']
 
     async def resolve_single_image(self, image_props: ImageProperties) -> str:
         """Resolve single image digest using Quay API."""
 
-        tags = (
+        digest = None
+        if self.resolve_mode == 'tag':
+            digest = await self.tag_digest(image_props)
+        elif self.resolve_mode == 'manifest':
+            digest = await self.manifest_digest(image_props)
+
+        if digest is None:
+            digest = await self.repository_tag_digest(image_props)
+
+        return f'quay.io/{image_props.org}/{image_props.software}@{digest}'
+
+    async def tag_digest(self, image_props: ImageProperties) -> typing.Optional[str]:
+        """Look up manifest digest of a single tag using Quay tag API, None when the API fails.
+
+        Raises AssertionError for tags unknown to the API, cached as negative entries.
+        """
+        response = await self.registry_request(
+            'get', quay_tag_url(image_props.org, image_props.software, image_props.tag, self.api_base_uri))
+        if response.status != 200:
+            response.release()
+            logger.warning('Quay tag lookup for %s failed with HTTP %d', image_props.url, response.status)
+            return None
+
+        for tag_metadata in (await response.json()).get('tags', []):
+            if tag_metadata.get('name') == image_props.tag:
+                # Tags of legacy images without manifest digest are looked up in the listing
+                return tag_metadata.get('manifest_digest')
+        raise AssertionError(f'Unknown image {image_props.url}')
+
+    async def registry_token(self, scope: str) -> tuple:
+        """Fetch registry v2 token for scope, returning it with its expiry time."""
+        requested_at = time.time()
+        response = await self.registry_request(
+            'get',
+            f'{self.api_base_uri}/v2/auth',
+            params={'service': 'quay.io', 'scope': scope},
+            headers=self.get_registry_auth_headers(),
+        )
+        response_data = await response.json() if response.status == 200 else {}
+        response.release()
+        return response_data.get('token'), requested_at + (response_data.get('expires_in') or self.default_token_ttl)
+
+    async def manifest_digest(self, image_props: ImageProperties) -> typing.Optional[str]:
+        """Look up manifest digest using registry v2 manifest HEAD request."""
+        repository = f'{image_props.org}/{image_props.software}'
+        scope = f'repository:{repository}:pull'
+        token = await self.ensure_scope_token(scope, lambda: self.registry_token(scope))
+
+        response = await self.registry_request(
+            'head',
+            f'{self.api_base_uri}/v2/{repository}/manifests/{image_props.tag}',
+            headers={
+                'Accept': base.MANIFEST_MEDIA_TYPES,
+                **({'Authorization': f'Bearer {token}'} if token else {}),
+            },
+        )
+        response.release()
+        if response.status != 200:
+            logger.warning('Quay manifest lookup for %s failed with HTTP %d', image_props.url, response.status)
+            return None
+        return response.headers.get('Docker-Content-Digest')
+
+    async def repository_tags(self, org: str, software: str) -> dict:
+        """Download tag metadata of the whole repository."""
+        return (
             await (
-                await self.client.get(quay_repository_url(image_props.org, image_props.software))
+                await self.registry_request('get', quay_repository_url(org, software, self.api_base_uri))
             ).json()
         ).get('tags', {})
 
+    async def repository_tag_digest(self, image_props: ImageProperties) -> str:
+        """Look up manifest digest in the whole repository tag listing."""
+        tags = await self.repository_tags(image_props.org, image_props.software)
+
+        if self.prefetch:
+            await self.cache_repository_tags(image_props.org, image_props.software, tags)
+
         tag_metadata = tags.get(image_props.tag)
 
         assert tag_metadata, f'Unknown image {image_props.url}'
         assert tag_metadata['manifest_digest'], 'Unknown Quay response format'
 
-        return f'quay.io/{image_props.org}/{image_props.software}@{tag_metadata["manifest_digest"]}'
+        return tag_metadata['manifest_digest']
+
+    async def cache_repository_tags(self, org: str, software: str, tags: dict) -> int:
+        """Put digests of all listed tags into digest cache, at once."""
+        return len(await self.tag_digest_cache.set_many({
+            f'quay.io/{org}/{software}:{name}': f'quay.io/{org}/{software}@{tag_metadata["manifest_digest"]}'
+            for name, tag_metadata in tags.items() if tag_metadata.get('manifest_digest')
+        }))
+
+    async def prefetch_repository(self, org: str, software: str) -> int:
+        self.ensure_client()
+        return await self.cache_repository_tags(org, software, await self.repository_tags(org, software))
+
+    def get_registry_auth_headers(self):
+        """Registry v2 auth accepts Quay OAuth tokens as basic auth password."""
+        if self.token:
+            return {'Authorization': aiohttp.BasicAuth('$oauthtoken', self.token).encode()}
+        return {}
 
     def get_client_headers(self):
         headers = super().get_client_headers()
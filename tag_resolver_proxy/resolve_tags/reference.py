@@ -0,0 +1,61 @@
+"""Container image reference parsing, after the grammar of the Docker distribution project.
+
+A reference is ``[domain[:port]/]path[:tag][@digest]``, its name (domain and
+path) being at most 255 characters long. The first path
+component is a domain when it holds a dot or a port, or is ``localhost``.
+References without domain are Docker Hub ones, single component paths
+there being official images of the ``library`` organization.
+"""
+import collections
+import re
+
+
+DEFAULT_DOMAIN = 'docker.io'
+# Docker Hub domains, normalized to DEFAULT_DOMAIN
+DEFAULT_DOMAIN_ALIASES = frozenset(['docker.io', 'index.docker.io', 'registry-1.docker.io'])
+OFFICIAL_ORG = 'library'
+
+_DOMAIN_COMPONENT = r'[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?'
+# Path components, separated by slashes, are lowercase alphanumerics separated by ., _, __ or dashes
+_PATH = r'[a-z0-9]+(?:(?:[._/]|__|-+)[a-z0-9]+)*'
+_TAG = r'[A-Za-z0-9_][A-Za-z0-9_.-]{0,127}'
+_DIGEST = r'[A-Za-z][A-Za-z0-9]*(?:[-_+.][A-Za-z][A-Za-z0-9]*)*:[0-9a-fA-F]{32,}'
+# Groups are domain, path, tag and digest. The lookahead tells a domain from a path component
+# before matching it, which is cheaper than trying alternative domain forms in turn.
+REFERENCE = re.compile(
+    rf'(?:(?=localhost[:/]|[^/]*[.:])({_DOMAIN_COMPONENT}(?:\.{_DOMAIN_COMPONENT})*(?::[0-9]+)?)/)?'
+    rf'({_PATH})(?::({_TAG}))?(?:@({_DIGEST}))?',
+    re.ASCII,
+)
+
+
+class ImageReference(collections.namedtuple('ImageReference', ['url', 'domain', 'path', 'tag', 'digest'])):
+    """Parsed image reference. Tag and digest are None when missing."""
+
+    __slots__ = ()
+
+    @property
+    def org(self) -> str:
+        """Path without its last component, e.g. ``team/project`` of ``gitlab.com/team/project/app``."""
+        return self.path.rpartition('/')[0]
+
+    @property
+    def software(self) -> str:
+        """Last path component."""
+        return self.path.rpartition('/')[2]
+
+
+def parse(image_url: str) -> tuple:
+    """Fields of ImageReference of given image URL, raising AssertionError if it is invalid."""
+    match = REFERENCE.fullmatch(image_url)
+    assert match is not None and match.end(2) <= 255, f'Invalid image reference: {image_url}'
+    domain, path, tag, digest = match.groups()
+
+    if domain is None or domain in DEFAULT_DOMAIN_ALIASES:
+        domain = DEFAULT_DOMAIN
+        if '/' not in path:
+            path = f'{OFFICIAL_ORG}/{path}'
+    return image_url, domain, path, tag, digest
+
+
+__all__ = ['DEFAULT_DOMAIN', 'ImageReference', 'parse']
@@ -0,0 +1,148 @@
+"""Per-registry request scheduling.
+
+Requests to a registry are limited by a cap on concurrent requests, admitted in
+arrival order, and a token bucket. When the registry throttles with HTTP 429 or
+503, requests pause for its `Retry-After` time, or an exponential backoff
+without one, and the rate limit is halved, then recovers step by step on
+successful requests.
+"""
+import asyncio
+import collections
+import contextlib
+import email.utils
+import time
+import typing
+
+
+THROTTLE_STATUSES = frozenset([429, 503])
+
+
+class RegistryThrottled(AssertionError):
+    """Registry throttled the request longer than the proxy is willing to wait."""
+
+
+def parse_retry_after(retry_after: typing.Optional[str], now: float = None) -> typing.Optional[float]:
+    """Seconds to wait from `Retry-After` header holding either seconds or an HTTP date."""
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at - (time.time() if now is None else now))
+
+
+class RegistryScheduler:
+    """Admits requests to one registry within its rate and concurrency limits.
+
+    `rate` is the number of requests per second, 0 for no limit, with up to
+    `burst` requests at once. At most `max_requests` requests are in flight.
+    """
+
+    # Backoff when throttling response carries no Retry-After, doubled on every consecutive throttling
+    initial_backoff = 1.0
+    max_backoff = 60.0
+
+    def __init__(self, rate: float = 0, burst: int = 10, max_requests: int = 16):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_requests = max_requests
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.backoff = self.initial_backoff
+        self.active = 0
+        self.queued = 0
+        self.stats = collections.Counter(throttled=0)
+        self._waiters = collections.deque()
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _delay(self, now: float) -> float:
+        """Seconds until a request holding a slot may be sent."""
+        delay = self.paused_until - now
+        if self.rate and self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    async def acquire(self):
+        self.queued += 1
+        try:
+            # Slots freed while requests are queued go straight to the oldest one, so newcomers can not overtake
+            if self.active < self.max_requests and not self._waiters:
+                self.active += 1
+            else:
+                waiter = asyncio.get_event_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    # Handed the slot by release() but cancelled before taking it: pass it on.
+                    # Cancelled waiters left in the queue are skipped by release()
+                    if not waiter.cancelled():
+                        self.release()
+                    raise
+            try:
+                await self._take_token()
+            except BaseException:
+                self.release()
+                raise
+        finally:
+            self.queued -= 1
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self._delay(now)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self.rate:
+            self.tokens -= 1
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot stays taken on behalf of the waiter
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def succeeded(self):
+        """Recover backoff and rate limit after a request which was not throttled."""
+        self.backoff = self.initial_backoff
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttled(self, retry_after: typing.Optional[str]) -> float:
+        """Pause requests after throttling response, returning seconds to wait."""
+        self.stats['throttled'] += 1
+        wait = parse_retry_after(retry_after)
+        if wait is None:
+            wait = self.backoff
+            self.backoff = min(self.max_backoff, self.backoff * 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + wait)
+        if self.max_rate:
+            self.rate = max(self.max_rate / 20, self.rate / 2)
+        return wait
+
+
+__all__ = ['THROTTLE_STATUSES', 'RegistryThrottled', 'RegistryScheduler', 'parse_retry_after']
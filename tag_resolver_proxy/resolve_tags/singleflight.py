@@ -0,0 +1,38 @@
+"""Sharing of concurrent identical calls."""
+import asyncio
+import typing
+
+
+class SingleFlight:
+    """Runs one call per key at a time, sharing its result or exception with every concurrent caller.
+
+    Callers wait on the shared call through `asyncio.shield`, so a caller cancelled or timed out
+    does not cancel the call for the others, and the call still completes, e.g. filling a cache.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, call: typing.Callable[[], typing.Awaitable], timeout: float = None):
+        """Await result of `call()` started by the first concurrent caller for key."""
+        shared = self._calls.get(key)
+        if shared is None:
+            shared = self._calls[key] = asyncio.ensure_future(call())
+            shared.add_done_callback(lambda done: self._done(key, done))
+        return await asyncio.wait_for(asyncio.shield(shared), timeout)
+
+    def _done(self, key, done: asyncio.Future):
+        if self._calls.get(key) is done:
+            del self._calls[key]
+        if not done.cancelled():
+            # Mark exception retrieved, it may have had no waiters left
+            done.exception()
+
+
+__all__ = ['SingleFlight']
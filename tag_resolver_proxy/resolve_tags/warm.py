@@ -0,0 +1,74 @@
+"""Digest cache warm-up, run before the proxy starts serving admissions."""
+import asyncio
+import collections
+import logging
+
+from .base import ResolverMeta
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_images_file(path: str) -> list:
+    """Read whitespace separated image URLs, as printed by
+
+    `kubectl get pods --all-namespaces -o jsonpath='{..image}'`
+    """
+    with open(path, 'r') as images_file:
+        return images_file.read().split()
+
+
+async def prefetch_repositories(repositories) -> int:
+    """Fill digest caches with all tags of given `registry/org/software` repositories."""
+    cached = 0
+    for repository in repositories:
+        parts = repository.split('/')
+        if len(parts) != 3 or parts[0] not in ResolverMeta.resolvers:
+            logger.warning('Can not prefetch %s: a repository must have format hub/org/software', repository)
+            continue
+        domain, org, software = parts
+        try:
+            cached += await ResolverMeta.resolvers[domain].prefetch_repository(org, software)
+        except Exception:
+            logger.exception('Prefetch of %s failed', repository)
+    return cached
+
+
+async def resolve_images(images, concurrency: int) -> int:
+    """Resolve given image URLs into digest caches, at most `concurrency` lookups per registry at a time."""
+    registry_slots = collections.defaultdict(lambda: asyncio.Semaphore(concurrency))
+
+    async def resolve(image):
+        try:
+            properties = ResolverMeta.for_image_url(image)
+            async with registry_slots[properties.domain]:
+                await properties.resolver.resolve_tags(properties)
+            return True
+        except Exception as exc:
+            logger.warning('Can not warm up %s: %r', image, exc)
+            return False
+
+    return sum(await asyncio.gather(*(resolve(image) for image in set(images))))
+
+
+def warmer(repositories, images_file: str, concurrency: int, timeout: float):
+    """Construct application startup signal handler, warming up digest caches."""
+
+    async def warm_digest_caches(_app=None):
+        images = read_images_file(images_file) if images_file else []
+        if not repositories and not images:
+            return
+
+        try:
+            prefetched, resolved = await asyncio.wait_for(
+                asyncio.gather(prefetch_repositories(repositories), resolve_images(images, concurrency)),
+                timeout,
+            )
+            logger.info('Digest cache warmed up with %d prefetched tags and %d images', prefetched, resolved)
+        except asyncio.TimeoutError:
+            logger.warning('Digest cache warm-up did not finish in %.1f seconds', timeout)
+
+    return warm_digest_caches
+
+
+__all__ = ['warmer', 'prefetch_repositories', 'resolve_images', 'read_images_file']
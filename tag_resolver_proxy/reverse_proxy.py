@@ -1,45 +1,229 @@
+import asyncio
 import logging
+import random
+import re
+import time
 
 import aiohttp.web
+import multidict
 
+from tag_resolver_proxy import deadlines
+from tag_resolver_proxy import decisions
+from tag_resolver_proxy import metrics
+from tag_resolver_proxy import payload
 from tag_resolver_proxy import process
 from tag_resolver_proxy import resolve_tags
 
 
 logger = logging.getLogger(__name__)
 
+SERVER = 'vgs-kritis-resolve-tags'
 
-async def webhook_handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
-    request_payload = await request.json()
-    logger.warning('REQUEST ::::::: %s', request_payload)
-    assert request_payload.get('kind') == 'AdmissionReview'
+ADMISSIONS = metrics.Counter('kritis_proxy_admissions_total', 'Admission decisions', ['decision'])
+DECISIONS = {decision: ADMISSIONS.labels(decision) for decision in ('allow', 'deny', 'error')}
+
+ALLOWED = re.compile(rb'"allowed"\s*:\s*(true|false)')
 
-    await process.process_spec(request_payload, resolve_tags.resolve_tags)
+# Headers describing upstream connection or body encoding, which are not forwarded
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'trailers',
+    'transfer-encoding', 'upgrade', 'content-length', 'content-encoding', 'server', 'date',
+])
 
-    response = await request.app['client'].post(
-        f'https://{request.app["upstream_uri"]}{request.path}',
-        json=request_payload,
+
+def forwarded_headers(upstream_headers) -> multidict.CIMultiDict:
+    """Upstream response headers, without hop-by-hop ones."""
+    headers = multidict.CIMultiDict(
+        (name, value) for name, value in upstream_headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
     )
-    response_text = (await response.text())
-    logger.warning('RESPONSE ::::::: %s', response_text)
-    response_webhook = aiohttp.web.Response(text=response_text)
-    response_webhook.headers.update(response.headers.copy())
-    response_webhook.set_status(response.status)
+    headers['SERVER'] = SERVER
+    headers.setdefault('CONTENT-TYPE', 'application/json')
+    return headers
+
+
+def upstream_decision(status: int, body: bytes) -> str:
+    """Admission decision of upstream response, found without decoding it."""
+    match = ALLOWED.search(body) if status == 200 else None
+    if match is None:
+        return 'error'
+    return 'allow' if match.group(1) == b'true' else 'deny'
+
+
+class DecisionScanner:
+    """Finds upstream admission decision in a response body streamed in chunks.
+
+    Only the last `tail_size` bytes of the body are kept between chunks, to match
+    an `"allowed"` field split over two of them.
+    """
+
+    tail_size = 64
+
+    def __init__(self):
+        self.allowed = None
+        self._tail = b''
+
+    def feed(self, chunk: bytes):
+        if self.allowed is not None:
+            return
+        window = self._tail + chunk
+        match = ALLOWED.search(window)
+        if match is None:
+            self._tail = window[-self.tail_size:]
+        else:
+            self.allowed = match.group(1)
+            self._tail = b''
+
+    def decision(self, status: int) -> str:
+        if status != 200 or self.allowed is None:
+            return 'error'
+        return 'allow' if self.allowed == b'true' else 'deny'
+
+
+def log_payload_sampled(request: aiohttp.web.Request) -> bool:
+    """Whether full request and response bodies of this admission are logged."""
+    sample_rate = request.app['log_payload_sample_rate']
+    return logger.isEnabledFor(logging.DEBUG) or (sample_rate > 0 and random.random() < sample_rate)
+
+
+def log_summary(request: aiohttp.web.Request):
+    """Log one line per admission, with its uid, images, decision and stage timings."""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    admission = request.get(payload.REQUEST_KEY)
+    req = admission.data.get('request', {}) if admission is not None else {}
+    try:
+        images = [container_spec.get('image') for container_spec in process.container_specs(admission.data)]
+    except (AttributeError, KeyError, TypeError):
+        images = []
+    timings = {stage: round(elapsed * 1000, 3) for stage, elapsed in request.get('timings', {}).items()}
+    fields = {
+        'uid': req.get('uid'),
+        'images': images,
+        'decision': request['decision'],
+        'decision_cached': request.get('decision_cached', False),
+        'reason': request.get('reason'),
+        'timings_ms': timings,
+    }
+    logger.info('Admission %s %s for %s in %.1f ms', fields['uid'], fields['decision'], images,
+                timings.get('total', 0), extra={'fields': fields})
+
+
+async def webhook_handler(request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+    admission = await payload.admission_payload(request)
+    request_payload = admission.data
+    log_payload = log_payload_sampled(request)
+    if log_payload:
+        logger.info('REQUEST ::::::: %s', admission.raw.decode(errors='replace'))
+    assert request_payload.get('kind') == 'AdmissionReview'
+
+    deadline = request['deadline']
+    started = time.perf_counter()
+    rewrites = await resolve_tags.resolve_spec_tags(request_payload, request.app['registry_concurrency'], deadline)
+    metrics.observe_stage(request, 'resolve', started)
+
+    decision_cache = request.app['decision_cache']
+    if decision_cache is not None:
+        decision_key = decisions.decision_key(request_payload)
+        decision = decision_cache.get(decision_key)
+        if decision is not None:
+            request['decision'] = 'allow' if decision.allowed else 'deny'
+            request['decision_cached'] = True
+            respond = process.response_allow if decision.allowed else process.response_deny
+            return aiohttp.web.json_response(text=respond(request_payload, msg=decision.message))
+
+    started = time.perf_counter()
+    try:
+        response = await deadlines.within(deadline, request.app['client'].post(
+            f'https://{request.app["upstream_uri"]}{request.path}',
+            data=admission.upstream_body(rewrites),
+            headers={'Content-Type': 'application/json'},
+        ), 'upstream request')
+    except deadlines.DeadlineExceeded:
+        metrics.observe_stage(request, 'upstream', started)
+        raise
+    try:
+        if request.app['upstream_response_mode'] == 'buffer':
+            body = await deadlines.within(deadline, response.read(), 'upstream request')
+            response_webhook = aiohttp.web.Response(
+                body=body,
+                status=response.status,
+                headers=forwarded_headers(response.headers),
+            )
+            request['decision'] = upstream_decision(response.status, body)
+        else:
+            response_webhook = aiohttp.web.StreamResponse(
+                status=response.status,
+                headers=forwarded_headers(response.headers),
+            )
+            await response_webhook.prepare(request)
+            request['response_started'] = True
+            # The whole body is only kept to cache or log it
+            keep_body = decision_cache is not None or log_payload
+            scanner = DecisionScanner()
+            chunks = []
+            async for chunk in response.content.iter_any():
+                scanner.feed(chunk)
+                if keep_body:
+                    chunks.append(chunk)
+                await response_webhook.write(chunk)
+            await response_webhook.write_eof()
+            body = b''.join(chunks)
+            request['decision'] = scanner.decision(response.status)
+        if decision_cache is not None and request['decision'] != 'error':
+            decision_cache.set_upstream_response(decision_key, body)
+        if log_payload:
+            logger.info('RESPONSE ::::::: HTTP %d %s', response.status, body.decode(errors='replace'))
+    finally:
+        response.release()
+        metrics.observe_stage(request, 'upstream', started)
     return response_webhook
 
 
+async def fallback_response(request: aiohttp.web.Request, reason: str) -> aiohttp.web.Response:
+    """Admission answered without upstream decision, denied or allowed as `--admission-timeout-action` says."""
+    req = (await payload.admission_payload(request)).data
+    request['reason'] = reason
+    request['decision'] = request.app['admission_timeout_action']
+    respond = process.response_allow if request['decision'] == 'allow' else process.response_deny
+    return aiohttp.web.json_response(text=respond(req, msg=reason))
+
+
 @aiohttp.web.middleware
-async def webhook_middleware(request: aiohttp.web.Request, handler) -> aiohttp.web.Response:
+async def webhook_middleware(request: aiohttp.web.Request, handler) -> aiohttp.web.StreamResponse:
+    if request.method != 'POST':
+        return await handler(request)
+    started = time.perf_counter()
+    request['decision'] = 'error'
+    request['timings'] = {}
+    request['deadline'] = deadlines.admission_deadline(
+        request.query.get('timeout'), request.app['admission_timeout'], request.app['admission_timeout_margin'])
     try:
         response = await handler(request)
     except aiohttp.web.HTTPException as exc:
         raise exc
+    except deadlines.DeadlineExceeded as exc:
+        logger.debug('Admission deadline exceeded.', exc_info=True)
+        response = await fallback_response(request, str(exc))
+        deadlines.DEADLINES_EXCEEDED.labels(request['decision']).inc()
+    except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as exc:
+        # Timeouts here are of the connection itself, e.g. `--upstream-timeout`, not of the admission deadline
+        if request.get('response_started'):
+            # Upstream response is partly sent, the connection can only be dropped
+            raise
+        logger.warning('Admission failed on registry or upstream connection: %r', exc)
+        response = await fallback_response(request, f'Can not reach registry or upstream: {exc!r}')
     except AssertionError as exc:
-        logger.exception('Processing assertion failed.')
-        req = await request.json()
-        response = aiohttp.web.json_response(text=process.response_deny(req, msg=str(exc.args[0])))
+        logger.debug('Processing assertion failed.', exc_info=True)
+        req = (await payload.admission_payload(request)).data
+        request['reason'] = str(exc.args[0])
+        response = aiohttp.web.json_response(text=process.response_deny(req, msg=request['reason']))
+        request['decision'] = 'deny'
+    finally:
+        DECISIONS[request['decision']].inc()
+        metrics.observe_stage(request, 'total', started)
+        log_summary(request)
     if not response.prepared:
-        response.headers['SERVER'] = 'vgs-kritis-resolve-tags'
+        response.headers['SERVER'] = SERVER
         response.headers['CONTENT-TYPE'] = 'application/json'
     return response
 
@@ -1,16 +1,25 @@
+import asyncio
 import contextlib
 import copy
+import hashlib
 import json
 import os
+import socket
+import sqlite3
+import tempfile
 import time
 
 import asynctest
 from asynctest import mock
-from aiohttp import client
+from aiohttp import client, web
 import yaml
 
-from tag_resolver_proxy.resolve_tags import base, resolve_tags, init_registries
-from tag_resolver_proxy.process import response_allow
+from tag_resolver_proxy import connections, deadlines, decisions, fakes, logs, metrics, payload, process, reload
+from tag_resolver_proxy import reverse_proxy, white_list
+from tag_resolver_proxy.resolve_tags import cache, docker_io, oci, quay_io, reference, scheduler, warm
+from tag_resolver_proxy.resolve_tags import base, resolve_tags, resolve_spec_tags, init_registries
+from tag_resolver_proxy.resolve_tags import prewarm_registries, close_registries
+from tag_resolver_proxy.process import container_specs, response_allow, response_deny
 from tag_resolver_proxy.webapp import app
 
 
@@ -18,6 +27,11 @@ test_dir = os.path.join(os.path.dirname(__file__), 'test/')
 init_registries()
 
 
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
 class KritisTest(asynctest.TestCase):
 
     @contextlib.contextmanager
@@ -50,15 +64,33 @@ class KritisReverseProxyTest(KritisTest):
     PORT = 8889
     REQ_UID = 'test'
     WHITELIST_REGISTRY = []
+    UPSTREAM_RESPONSE_MODE = 'stream'
+    DECISION_CACHE_TTL = 0
+    ADMISSION_TIMEOUT = 0
+    UPSTREAM_TIMEOUT = 9
 
     async def _admission_request(self, **deployment_data):
         """Performs an admission request to a backend."""
         resp = await self._client.post('http://127.0.0.1:{}/'.format(self.PORT),
                                        json=self._admission(**deployment_data))
         resp_body = await resp.json()
+        self._response_headers = resp.headers
         resp.close()
         return resp.status, resp_body
 
+    @contextlib.contextmanager
+    def _mock_upstream(self, body: bytes, headers: dict = None, split_at: int = None):
+        """Patches proxy client to get Kritis response with body, streamed in two chunks if split."""
+        response_mock = mock.Mock(client.ClientResponse)
+        response_mock.status = 200
+        response_mock.headers = headers or {'Content-Type': 'application/json'}
+        response_mock.read = mock.CoroutineMock(return_value=body)
+        chunks = (body[:split_at], body[split_at:]) if split_at else (body,)
+        response_mock.content.iter_any = lambda: _chunks(*chunks)
+        with mock.patch.object(self._app['client'], 'post', new=mock.CoroutineMock()) as upstream_post:
+            upstream_post.return_value = response_mock
+            yield upstream_post
+
     def _assert_admission_response_equal(self, status, msg, response):
         self.assertDictEqual(
             {
@@ -77,8 +109,29 @@ class KritisReverseProxyTest(KritisTest):
         args.client_ca_cert_file = self._testfile('ca.crt')
         args.quay_token_file = self._testfile('quay.token')
         args.upstream_uri = 'https://127.0.0.1/test'
+        args.upstream_response_mode = self.UPSTREAM_RESPONSE_MODE
+        args.upstream_pool_size = 10
+        args.upstream_pool_per_host = 0
+        args.upstream_keepalive = 60
+        args.upstream_prewarm = 0
+        args.registry_prewarm = 0
+        args.upstream_connect_timeout = 2
+        args.upstream_read_timeout = 8
+        args.upstream_timeout = self.UPSTREAM_TIMEOUT
         args.quay_io_organization = ['test', ]
         args.whitelist_registry = self.WHITELIST_REGISTRY
+        args.whitelist_file = None
+        args.reload_interval = 0
+        args.decision_cache_ttl = self.DECISION_CACHE_TTL
+        args.decision_cache_max_entries = 10
+        args.registry_concurrency = 8
+        args.admission_timeout = self.ADMISSION_TIMEOUT
+        args.admission_timeout_margin = 0.5
+        args.admission_timeout_action = 'deny'
+        args.log_payload_sample_rate = 0
+        args.warm_repository = []
+        args.warm_images_file = None
+        args.warm_timeout = 60
 
         self._app = app(args)
         self._server = await self.loop.create_server(self._app.make_handler(),
@@ -101,40 +154,70 @@ class KritisReverseProxyAdmissionTest(KritisReverseProxyTest):
             response,
         )
 
+    async def test_deploy_summary_logged(self):
+        with self.assertLogs('tag_resolver_proxy.reverse_proxy', 'INFO') as logged:
+            await self._admission_request(**self._deployment('latest'))
+
+        summary, = logged.records
+        self.assertEqual('test', summary.fields['uid'])
+        self.assertEqual('deny', summary.fields['decision'])
+        self.assertEqual('Can not use latest tag', summary.fields['reason'])
+        self.assertEqual(['tutum/curl:latest'], summary.fields['images'])
+        self.assertIn('total', summary.fields['timings_ms'])
+
+        entry = json.loads(logs.JsonFormatter().format(summary))
+        self.assertEqual('INFO', entry['level'])
+        self.assertEqual('deny', entry['decision'])
+        self.assertTrue(entry['message'].startswith('Admission test deny'))
+
+    async def test_deploy_payload_decoded_once(self):
+        with mock.patch('tag_resolver_proxy.payload.loads', wraps=payload.loads) as loads:
+            status, response = await self._admission_request(**self._deployment('latest'))
+        self.assertEqual(200, status)
+        self.assertFalse(response['response']['allowed'])
+        self.assertEqual(1, loads.call_count)
+
     async def test_deploy_kritis_pass(self):
+        deployment = self._deployment('kritis_pass')
 
-        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
-         mock.patch.object(self._app['client'], 'post') as upstream_post:
-            resolve_tags.return_value = \
-                'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
-            deployment = self._deployment('kritis_pass')
+        upstream_response = response_allow(self._admission(**deployment))
+        upstream_response_data = json.loads(upstream_response)
+        msg_mock = 'This message is generated during test at {}'.format(str(time.time()))
 
-            upstream_response = response_allow(self._admission(**deployment))
-            upstream_response_data = json.loads(upstream_response)
-            msg_mock = 'This message is generated during test at {}'.format(str(time.time()))
+        upstream_response_data['response']['status']['message'] = msg_mock
 
-            upstream_response_data['response']['status']['message'] = msg_mock
+        upstream_body = json.dumps(upstream_response_data).encode()
+        upstream_headers = {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(upstream_body)),
+            'Transfer-Encoding': 'chunked',
+            'X-Kritis-Check': 'passed',
+        }
 
-            response_mock = mock.CoroutineMock(client.ClientResponse)
-            response_mock.status = 200
-            response_mock.text = mock.CoroutineMock(return_value=json.dumps(upstream_response_data))
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
+                self._mock_upstream(upstream_body, headers=upstream_headers, split_at=10) as upstream_post:
+            resolve_tags.return_value = \
+                'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+            response_mock = upstream_post.return_value
 
             async def kritis_fake_response(*args, **kwargs):
                 etalon_dep = copy.copy(deployment)
                 etalon_dep['spec']['template']['spec']['containers'][0]['image'] = \
                     'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
                 self.assertDictEqual(
-                    {'json': {'request':{
+                    {'request':{
                         'uid': 'test',
                         'object': etalon_dep,
-                        'userInfo': {'username': 'test'}}, 'kind': 'AdmissionReview'}},
-                    kwargs,
+                        'userInfo': {'username': 'test'}}, 'kind': 'AdmissionReview'},
+                    json.loads(kwargs.pop('data')),
                 )
+                self.assertDictEqual({'headers': {'Content-Type': 'application/json'}}, kwargs)
                 self.assertTupleEqual(('https://https://127.0.0.1/test/',), args)
                 return response_mock
 
             upstream_post.side_effect = kritis_fake_response
 
+            allowed = reverse_proxy.DECISIONS['allow'].value
             status, response = await self._admission_request(**deployment)
 
         self.assertEqual(200, status)
@@ -143,6 +226,214 @@ class KritisReverseProxyAdmissionTest(KritisReverseProxyTest):
             msg_mock,
             response,
         )
+        self.assertEqual('passed', self._response_headers['X-Kritis-Check'])
+        self.assertEqual('vgs-kritis-resolve-tags', self._response_headers['Server'])
+        self.assertTrue(response_mock.release.called)
+        self.assertEqual(allowed + 1, reverse_proxy.DECISIONS['allow'].value)
+
+
+class KritisReverseProxyMetricsTest(KritisReverseProxyTest):
+
+    PORT = 8891
+
+    async def test_metrics(self):
+        resp = await self._client.get('http://127.0.0.1:{}/metrics'.format(self.PORT))
+        body = await resp.text()
+        resp.close()
+
+        self.assertEqual(200, resp.status)
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', resp.headers['Content-Type'])
+        self.assertIn('# TYPE kritis_proxy_http_pool_connections gauge', body)
+        self.assertIn('kritis_proxy_http_pool_connections{pool="upstream",state="limit"} 10.0', body)
+        self.assertIn('kritis_proxy_digest_cache_events_total{event="misses"}', body)
+
+    async def test_admission_metrics(self):
+        denied = reverse_proxy.DECISIONS['deny'].value
+        await self._admission_request(**self._deployment('latest'))
+        self.assertEqual(denied + 1, reverse_proxy.DECISIONS['deny'].value)
+
+        body = metrics.REGISTRY.render()
+        self.assertIn('# TYPE kritis_proxy_admission_stage_seconds histogram', body)
+        self.assertIn('kritis_proxy_admission_stage_seconds_bucket{stage="total",le="+Inf"}', body)
+        self.assertIn('kritis_proxy_admission_stage_seconds_count{stage="parse"}', body)
+        self.assertIn('kritis_proxy_admissions_total{decision="deny"}', body)
+
+    async def test_upstream_pool_metrics(self):
+        upstream = web.Application()
+        upstream.router.add_route('HEAD', '/', lambda request: web.Response())
+        runner, upstream_uri = await fakes.serve(upstream)
+        session = connections.create_session('test', limit=2)
+        created = connections.CONNECTIONS_CREATED.labels('test')
+        reused = connections.CONNECTIONS_REUSED.labels('test')
+        try:
+            await connections.prewarm(session, upstream_uri, 2)
+            self.assertEqual(2, created.value)
+            await connections.prewarm(session, upstream_uri, 2)
+            self.assertEqual(2, created.value)
+            self.assertEqual(2, reused.value)
+            self.assertIn('kritis_proxy_http_pool_connections{pool="test",state="idle"} 2.0', metrics.REGISTRY.render())
+        finally:
+            await session.close()
+            await runner.cleanup()
+
+
+class KritisReverseProxyBufferedAdmissionTest(KritisReverseProxyAdmissionTest):
+
+    UPSTREAM_RESPONSE_MODE = 'buffer'
+
+
+class KritisReverseProxyDecisionCacheTest(KritisReverseProxyTest):
+
+    DECISION_CACHE_TTL = 30
+    RESOLVED = 'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+
+    async def test_decision_reused_with_request_uid(self):
+        deployment = self._deployment('kritis_pass')
+        upstream_body = response_deny(self._admission(**deployment), msg='No attestation').encode()
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
+                self._mock_upstream(upstream_body) as upstream_post:
+            resolve_tags.return_value = self.RESOLVED
+
+            await self._admission_request(**deployment)
+            self.REQ_UID = 'test-again'
+            status, response = await self._admission_request(**deployment)
+
+            resolve_tags.return_value = self.RESOLVED.replace('8bb9', '0000')
+            await self._admission_request(**deployment)
+
+        self.assertEqual(200, status)
+        self._assert_admission_response_equal(False, 'No attestation', response)
+        self.assertEqual(2, upstream_post.call_count)
+
+    def test_decision_scanner_split_field(self):
+        body = response_deny(self._admission(spec={}), msg='x' * 200).encode()
+        split_at = body.index(b'"allowed"') + 5
+        scanner = reverse_proxy.DecisionScanner()
+        for start in range(0, len(body), split_at):
+            scanner.feed(body[start:start + split_at])
+        self.assertEqual('deny', scanner.decision(200))
+        self.assertEqual('error', scanner.decision(500))
+        self.assertLessEqual(len(scanner._tail), scanner.tail_size)
+
+    def test_decision_key(self):
+        pod = self._admission(spec={'containers': [{'image': 'a'}, {'image': 'b'}, {'image': 'a'}]})
+        pod['request'].update(namespace='test', operation='CREATE')
+        reordered = self._admission(spec={'containers': [{'image': 'b'}, {'image': 'a'}]})
+        reordered['request'].update(namespace='test', operation='CREATE')
+        self.assertEqual(decisions.decision_key(pod), decisions.decision_key(reordered))
+
+        reordered['request']['operation'] = 'UPDATE'
+        self.assertNotEqual(decisions.decision_key(pod), decisions.decision_key(reordered))
+        reordered['request'].update(namespace='other', operation='CREATE')
+        self.assertNotEqual(decisions.decision_key(pod), decisions.decision_key(reordered))
+
+    async def test_breakglass_allow_not_reused_without_breakglass(self):
+        deployment = self._deployment('kritis_pass')
+        breakglass = copy.deepcopy(deployment)
+        breakglass.setdefault('metadata', {})['annotations'] = {'kritis.grafeas.io/breakglass': 'true'}
+        upstream_body = response_allow(self._admission(**breakglass), msg='Breakglass').encode()
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
+                self._mock_upstream(upstream_body) as upstream_post:
+            resolve_tags.return_value = self.RESOLVED
+
+            await self._admission_request(**breakglass)
+            await self._admission_request(**deployment)
+
+        self.assertEqual(2, upstream_post.call_count)
+
+
+class KritisReverseProxyDeadlineTest(KritisReverseProxyTest):
+
+    PORT = 8892
+    ADMISSION_TIMEOUT = 0.05
+
+    async def test_deadline_during_resolution_denies(self):
+        async def slow_lookup(*args):
+            await asyncio.sleep(1)
+
+        denied = deadlines.DEADLINES_EXCEEDED.labels('deny').value
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags',
+                        side_effect=slow_lookup), \
+                mock.patch.object(self._app['client'], 'post') as upstream_post:
+            started = time.perf_counter()
+            status, response = await self._admission_request(**self._deployment('kritis_pass'))
+
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(200, status)
+        self._assert_admission_response_equal(False, 'Admission deadline exceeded during tag resolution', response)
+        self.assertFalse(upstream_post.called)
+        self.assertEqual(denied + 1, deadlines.DEADLINES_EXCEEDED.labels('deny').value)
+
+    async def test_apiserver_timeout_fails_open(self):
+        async def slow_upstream(*args, **kwargs):
+            await asyncio.sleep(1)
+
+        self._app['admission_timeout'] = 0
+        self._app['admission_timeout_action'] = 'allow'
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
+                mock.patch.object(self._app['client'], 'post', side_effect=slow_upstream):
+            resolve_tags.return_value = \
+                'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+            resp = await self._client.post(f'http://127.0.0.1:{self.PORT}/?timeout=600ms',
+                                           json=self._admission(**self._deployment('kritis_pass')))
+            response = await resp.json()
+            resp.close()
+
+        self._assert_admission_response_equal(True, 'Admission deadline exceeded during upstream request', response)
+
+    async def test_upstream_unreachable_denies(self):
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            self._app['upstream_uri'] = '127.0.0.1:{}'.format(closed.getsockname()[1])
+
+        with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags:
+            resolve_tags.return_value = \
+                'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+            status, response = await self._admission_request(**self._deployment('kritis_pass'))
+
+        self.assertEqual(200, status)
+        self.assertFalse(response['response']['allowed'])
+        self.assertTrue(response['response']['status']['message'].startswith('Can not reach registry or upstream'))
+
+    async def test_upstream_timeout_answered_by_action(self):
+        for action in ('deny', 'allow'):
+            self._app['admission_timeout_action'] = action
+            with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') as resolve_tags, \
+                    mock.patch.object(self._app['client'], 'post', side_effect=asyncio.TimeoutError):
+                resolve_tags.return_value = \
+                    'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+                status, response = await self._admission_request(**self._deployment('kritis_pass'))
+
+            self.assertEqual(200, status)
+            self._assert_admission_response_equal(
+                action == 'allow', 'Can not reach registry or upstream: TimeoutError()', response)
+
+    def test_parse_duration(self):
+        self.assertEqual([10, 90, 0.5, None, None],
+                         [deadlines.parse_duration(value) for value in ('10s', '1m30s', '500ms', '10', None)])
+
+
+class KritisReverseProxyUpstreamTimeoutTest(KritisReverseProxyTest):
+
+    PORT = 8893
+    UPSTREAM_TIMEOUT = 0.2
+
+    async def test_stalled_upstream_denies(self):
+        # Accepts connections but never answers, so the upstream request total timeout fires
+        stalled = await self.loop.create_server(asyncio.Protocol, '127.0.0.1', 0)
+        self._app['upstream_uri'] = '127.0.0.1:{}'.format(stalled.sockets[0].getsockname()[1])
+        try:
+            with mock.patch('tag_resolver_proxy.resolve_tags.quay_io.QuayIOTagResolver.resolve_tags') \
+                    as resolve_tags:
+                resolve_tags.return_value = \
+                    'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+                status, response = await self._admission_request(**self._deployment('kritis_pass'))
+        finally:
+            stalled.close()
+            await stalled.wait_closed()
+
+        self.assertEqual(200, status)
+        self._assert_admission_response_equal(False, 'Can not reach registry or upstream: TimeoutError()', response)
 
 
 class KritisReverseProxyWhiteListTest(KritisReverseProxyTest):
@@ -169,6 +460,212 @@ class KritisReverseProxyWhiteListTest(KritisReverseProxyTest):
         self.assertFalse(upstream_post.called)
 
 
+class ImageWhitelistTest(KritisTest):
+
+    REQ_UID = 'test'
+
+    def _pod(self, *images):
+        containers = [{'name': str(n), 'image': image} for n, image in enumerate(images)]
+        return self._admission(spec={'containers': containers})
+
+    def test_whitelisted_on_segment_boundary(self):
+        resolver = white_list.ImageWhitelistResolver(['docker.io/whitelisted', 'quay.io/org/curl/', 'localhost:5000'])
+
+        self.assertTrue(resolver.is_whitelisted('docker.io/whitelisted/curl:3.2.1'))
+        self.assertTrue(resolver.is_whitelisted('quay.io/org/curl:3.2.1'))
+        self.assertTrue(resolver.is_whitelisted('quay.io/org/curl@sha256:8bb9ec6e'))
+        self.assertTrue(resolver.is_whitelisted('localhost:5000/test/curl'))
+        self.assertFalse(resolver.is_whitelisted('docker.io/whitelisted-not/curl:3.2.1'))
+        self.assertFalse(resolver.is_whitelisted('quay.io/org/curly:3.2.1'))
+        self.assertFalse(resolver.is_whitelisted('docker.io/curl:3.2.1'))
+
+    def test_all_images_whitelisted_per_request(self):
+        resolver = white_list.ImageWhitelistResolver(['docker.io/whitelisted'])
+
+        self.assertFalse(resolver.all_images_whitelisted(self._pod('docker.io/whitelisted/a:1', 'docker.io/test/b:1')))
+        self.assertTrue(resolver.all_images_whitelisted(self._pod('docker.io/whitelisted/a:1')))
+        self.assertFalse(resolver.all_images_whitelisted(self._pod()))
+        self.assertFalse(white_list.ImageWhitelistResolver([]).all_images_whitelisted(self._pod('docker.io/a:1')))
+
+    def test_tagged_entries_match_exact_reference(self):
+        digest = 'sha256:' + '0' * 64
+        resolver = white_list.ImageWhitelistResolver(['quay.io/org/app:1.2', f'quay.io/org/tool@{digest}',
+                                                      'localhost:5000'])
+        self.assertTrue(resolver.is_whitelisted('quay.io/org/app:1.2'))
+        # Pulled by digest, whatever the tag
+        self.assertFalse(resolver.is_whitelisted(f'quay.io/org/app:1.2@{digest}'))
+        self.assertFalse(resolver.is_whitelisted('quay.io/org/app:1.3'))
+        self.assertFalse(resolver.is_whitelisted('quay.io/org/app'))
+        self.assertTrue(resolver.is_whitelisted(f'quay.io/org/tool@{digest}'))
+        self.assertTrue(resolver.is_whitelisted(f'quay.io/org/tool:1.0@{digest}'))
+        self.assertFalse(resolver.is_whitelisted('quay.io/org/tool@sha256:' + '1' * 64))
+        self.assertFalse(resolver.is_whitelisted('quay.io/org/tool:1.0'))
+        self.assertTrue(resolver.is_whitelisted('localhost:5000/app:1.0'))
+        self.assertTrue(resolver.all_images_whitelisted(self._pod('quay.io/org/app:1.2')))
+
+    def test_stops_at_first_image_not_whitelisted(self):
+        resolver = white_list.ImageWhitelistResolver(['docker.io/whitelisted'])
+        with mock.patch.object(resolver, 'is_whitelisted', wraps=resolver.is_whitelisted) as is_whitelisted:
+            resolver.all_images_whitelisted(self._pod('docker.io/test/a:1', 'docker.io/whitelisted/b:1'))
+        self.assertEqual(1, is_whitelisted.call_count)
+
+
+class ContainerSpecsTest(KritisTest):
+
+    REQ_UID = 'test'
+
+    def test_cronjob_containers(self):
+        pod_spec = {'initContainers': [{'name': 'init', 'image': 'quay.io/test/init:1'}],
+                    'containers': [{'name': 'main', 'image': 'quay.io/test/main:1'}]}
+        cronjob = self._admission(kind='CronJob', spec={'jobTemplate': {'spec': {'template': {'spec': pod_spec}}}})
+
+        self.assertEqual(['quay.io/test/init:1', 'quay.io/test/main:1'],
+                         [container_spec['image'] for container_spec in container_specs(cronjob)])
+
+    def test_pod_containers(self):
+        pod = self._admission(kind='Pod', spec={
+            'containers': [{'name': 'main', 'image': 'quay.io/test/main:1'}],
+            'ephemeralContainers': [{'name': 'debug', 'image': 'quay.io/test/debug:1'}],
+        })
+
+        self.assertEqual(['quay.io/test/main:1', 'quay.io/test/debug:1'],
+                         [container_spec['image'] for container_spec in container_specs(pod)])
+        self.assertEqual([], container_specs(self._admission(kind='ConfigMap', data={})))
+
+
+class SpliceImagesTest(KritisTest):
+
+    REQ_UID = 'test'
+    REWRITES = [('quay.io/test/curl:3.2.1', 'quay.io/test/curl@sha256:1'),
+                ('busybox:1', 'docker.io/library/busybox@sha256:2')]
+
+    def _payload(self, **metadata):
+        deployment = self._deployment('kritis_pass')
+        deployment['metadata'].update(metadata)
+        pod_spec = deployment['spec']['template']['spec']
+        pod_spec['initContainers'] = [{'name': 'init', 'image': 'busybox:1',
+                                       'env': [{'name': 'SPEC', 'value': '{"image": "quay.io/test/curl:3.2.1"}'}]}]
+        pod_spec['containers'].append({'name': 'pinned', 'image': 'quay.io/test/curl@sha256:0'})
+        return payload.AdmissionPayload(json.dumps(self._admission(**deployment), indent=1).encode())
+
+    def _rewrite(self, admission):
+        rewrites = []
+        for container_spec in process.container_specs(admission.data):
+            resolved = dict(self.REWRITES).get(container_spec['image'])
+            if resolved:
+                rewrites.append((container_spec['image'], resolved))
+                container_spec['image'] = resolved
+        return rewrites
+
+    @mock.patch('tag_resolver_proxy.payload.SPLICE_IMAGES', True)
+    def test_splice_equals_encoded(self):
+        admission = self._payload()
+        rewrites = self._rewrite(admission)
+
+        body = admission.upstream_body(rewrites)
+        self.assertEqual(admission.data, json.loads(body))
+        self.assertIn(b'"name": "SPEC",\n', body)
+        self.assertEqual(admission.raw, admission.upstream_body([]))
+
+    def test_escaped_image_spliced(self):
+        raw = b'{"containers": [{"image" : "quay.io\\/test\\/curl:3.2.1", "name": "curl"}]}'
+        self.assertEqual(b'{"containers": [{"image" : "quay.io/test/curl@sha256:1", "name": "curl"}]}',
+                         payload.splice_images(raw, self.REWRITES[:1]))
+
+    def test_unrelated_image_field_is_encoded(self):
+        admission = self._payload(annotations={'image': 'busybox:1'})
+        rewrites = self._rewrite(admission)
+
+        self.assertIsNone(payload.splice_images(admission.raw, rewrites))
+        with mock.patch('tag_resolver_proxy.payload.SPLICE_IMAGES', True):
+            self.assertEqual(admission.data, json.loads(admission.upstream_body(rewrites)))
+
+
+class ReloadTest(KritisTest):
+
+    def test_whitelist_file_reload(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            white_list_file = os.path.join(config_dir, 'whitelist')
+            with open(white_list_file, 'w') as fl:
+                fl.write('# Comment\ndocker.io/whitelisted\n')
+
+            resolver = white_list.ImageWhitelistResolver(['quay.io/test'], white_list_file)
+            watcher = reload.FileWatcher(1)
+            watcher.watch(white_list_file, resolver.reload)
+            self.assertTrue(resolver.is_whitelisted('docker.io/whitelisted/curl:3.2.1'))
+            self.assertFalse(resolver.is_whitelisted('docker.io/added/curl:3.2.1'))
+
+            with open(white_list_file, 'w') as fl:
+                fl.write('docker.io/added\ndocker.io/other\n')
+            watcher.check()
+            self.assertTrue(resolver.is_whitelisted('docker.io/added/curl:3.2.1'))
+            self.assertFalse(resolver.is_whitelisted('docker.io/whitelisted/curl:3.2.1'))
+            self.assertTrue(resolver.is_whitelisted('quay.io/test/curl:3.2.1'))
+
+            os.unlink(white_list_file)
+            watcher.check()
+            self.assertTrue(resolver.is_whitelisted('docker.io/added/curl:3.2.1'))
+
+    async def test_token_file_reload(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            token_file = os.path.join(config_dir, 'token')
+            with open(token_file, 'w') as fl:
+                fl.write('old\n')
+
+            resolver = quay_io.QuayIOTagResolver(token_file)
+            resolver.client_close_delay = 0
+            await resolver.tag_digest_cache.set('quay.io/test/curl:3.2.1', 'quay.io/test/curl@sha256:1')
+            resolver.ensure_client()
+            previous_client = resolver.client
+            resolver.scope_tokens['repository:test/curl:pull'] = ('scoped', time.time() + 300)
+
+            # Touched or remounted without change
+            with open(token_file, 'w') as fl:
+                fl.write('old\n')
+            resolver.reload_token()
+            self.assertIs(previous_client, resolver.client)
+            self.assertIn('repository:test/curl:pull', resolver.scope_tokens)
+
+            with open(token_file, 'w') as fl:
+                fl.write('rotated\n')
+            resolver.reload_token()
+
+            self.assertEqual('rotated', resolver.token)
+            self.assertEqual({}, resolver.scope_tokens)
+            self.assertIsNot(previous_client, resolver.client)
+            self.assertEqual('Bearer rotated', resolver.client._default_headers['Authorization'])
+            self.assertEqual('quay.io/test/curl@sha256:1',
+                             await resolver.tag_digest_cache.get('quay.io/test/curl:3.2.1'))
+            self.assertFalse(previous_client.closed)
+            await asyncio.sleep(0.01)
+            self.assertTrue(previous_client.closed)
+            await resolver.client.close()
+
+    async def test_missing_token_file_keeps_token(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            token_file = os.path.join(config_dir, 'token')
+            with open(token_file, 'w') as fl:
+                fl.write('secret\n')
+
+            resolver = quay_io.QuayIOTagResolver(token_file)
+            resolver.ensure_client()
+            previous_client = resolver.client
+            resolver.scope_tokens['repository:test/curl:pull'] = ('scoped', time.time() + 300)
+            watcher = reload.FileWatcher(1)
+            watcher.watch(token_file, resolver.reload_token)
+
+            # Removed while a secret is remounted
+            os.unlink(token_file)
+            with self.assertLogs('tag_resolver_proxy.resolve_tags.base', 'WARNING'):
+                watcher.check()
+
+            self.assertEqual('secret', resolver.token)
+            self.assertIs(previous_client, resolver.client)
+            self.assertEqual('Bearer secret', resolver.client._default_headers['Authorization'])
+            self.assertIn('repository:test/curl:pull', resolver.scope_tokens)
+            await resolver.client.close()
+
+
 class TagResolverBaseTest(KritisTest):
     container_spec = {'name': 'sleep', 'image': 'curl:3.2.1', 'command': ['/bin/sleep', 'infinity'],
                       'resources': {'requests': {'cpu': '0m', 'memory': '0M'}, 'limits': {'cpu': '0m', 'memory': '0M'}}}
@@ -188,6 +685,688 @@ class TagResolverBaseTest(KritisTest):
             self.assertDictEqual(spec, spec)
 
 
+class ImageReferenceTest(KritisTest):
+
+    DIGEST = 'sha256:e8f497444c8d663da3c8a7e4ea58d16f1b130c1122c098b9946cd23dca0f9aab'
+
+    def test_parse(self):
+        for image, expected in [
+            ('busybox:1.31', ('docker.io', 'library/busybox', '1.31', None)),
+            ('tutum/curl:1.0', ('docker.io', 'tutum/curl', '1.0', None)),
+            ('index.docker.io/nginx:1.19', ('docker.io', 'library/nginx', '1.19', None)),
+            ('quay.io/test/curl:3.2.1', ('quay.io', 'test/curl', '3.2.1', None)),
+            ('localhost:5000/x:y', ('localhost:5000', 'x', 'y', None)),
+            ('registry.example.com:443/team/group/app', ('registry.example.com:443', 'team/group/app', None, None)),
+            (f'quay.io/test/curl:3.2.1@{self.DIGEST}', ('quay.io', 'test/curl', '3.2.1', self.DIGEST)),
+            (f'quay.io/test/curl@{self.DIGEST}', ('quay.io', 'test/curl', None, self.DIGEST)),
+        ]:
+            self.assertEqual((image, *expected), reference.parse(image), image)
+
+        props = reference.ImageReference(*reference.parse('gitlab.com:8443/team/project/app:1.0'))
+        self.assertEqual(('team/project', 'app'), (props.org, props.software))
+
+    def test_parse_invalid(self):
+        for image in ['', 'quay.io/Test/curl:1.0', 'curl:1.0:2.0', 'quay.io/test/curl@sha256:0', 'curl:-1', 'a//b:1',
+                      'curl:1.0ü', 'curl@', 'quay.io/test/curl:', 'quay.io/' + 'a' * 248 + ':1.0']:
+            with self.assertRaisesRegex(AssertionError, 'Invalid image reference'):
+                reference.parse(image)
+
+    def test_parse_long_name_with_digest(self):
+        # Name of 255 characters, longer with tag and digest
+        image = 'quay.io/' + 'a' * 247 + ':1.0@sha256:' + '0' * 64
+        self.assertEqual(('quay.io', 'a' * 247, '1.0', 'sha256:' + '0' * 64), reference.parse(image)[1:])
+
+    def test_for_image_url(self):
+        resolver = TagResolverBaseTest.NoopTagResolver(None)
+        with self._replace_resolvermeta_resolvers({'docker.io': resolver}):
+            props = base.ResolverMeta.for_image_url('curl:3.2.1')
+            self.assertIs(props, base.ResolverMeta.for_image_url('curl:3.2.1'))
+            self.assertIs(resolver, props.resolver)
+            self.assertEqual(f'curl@{self.DIGEST}', base.ResolverMeta.for_image_url(f'curl@{self.DIGEST}').url)
+            for image in ['curl', 'curl:latest']:
+                with self.assertRaisesRegex(AssertionError, 'Can not use latest tag'):
+                    base.ResolverMeta.for_image_url(image)
+            with self.assertRaisesRegex(AssertionError, 'Unknown Docker registry: localhost:5000'):
+                base.ResolverMeta.for_image_url('localhost:5000/x:y')
+
+
+class ResolveSpecTagsTest(KritisTest):
+
+    REQ_UID = 'test'
+
+    class CountingTagResolver(base.TagResolver):
+
+        registry_base_uri = None
+
+        def __init__(self, token_file):
+            super().__init__(token_file)
+            self.lookups = []
+            self.running = self.max_running = 0
+
+        async def resolve_single_image(self, image_properties: base.ImageProperties) -> str:
+            self.lookups.append(image_properties.url)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            assert 'broken' not in image_properties.url, 'Can not retrieve docker image digest'
+            return '{}/{}@sha256:{}'.format(image_properties.domain, image_properties.org, image_properties.software)
+
+    def _pod(self, *images):
+        containers = [{'name': str(n), 'image': image} for n, image in enumerate(images)]
+        return self._admission(spec={'containers': containers})
+
+    async def test_resolve_concurrently_with_dedup(self):
+        resolver = ResolveSpecTagsTest.CountingTagResolver(None)
+        request_payload = self._pod('docker.io/test/a:1', 'docker.io/test/b:1',
+                                    'docker.io/test/a:1', 'docker.io/test/c:1')
+
+        with self._replace_resolvermeta_resolvers({'docker.io': resolver}):
+            await resolve_spec_tags(request_payload, concurrency=2)
+
+        self.assertEqual(['docker.io/test@sha256:a', 'docker.io/test@sha256:b',
+                          'docker.io/test@sha256:a', 'docker.io/test@sha256:c'],
+                         [c['image'] for c in request_payload['request']['object']['spec']['containers']])
+        self.assertCountEqual(['docker.io/test/a:1', 'docker.io/test/b:1', 'docker.io/test/c:1'], resolver.lookups)
+        self.assertEqual(2, resolver.max_running)
+
+    async def test_resolve_failure_is_raised(self):
+        resolver = ResolveSpecTagsTest.CountingTagResolver(None)
+        request_payload = self._pod('docker.io/test/a:1', 'docker.io/test/broken:1')
+
+        with self._replace_resolvermeta_resolvers({'docker.io': resolver}):
+            with self.assertRaisesRegex(AssertionError, 'Can not retrieve docker image digest'):
+                await resolve_spec_tags(request_payload, concurrency=2)
+
+
+class DigestCacheTest(asynctest.TestCase):
+
+    PORT = 8890
+    IMAGE = 'quay.io/test/curl:3.2.1'
+    RESOLVED = 'quay.io/test/curl@sha256:8bb9ec6e86c87e436402a2952eba54ed636754ba61ddf84d1b6e4844396383c9'
+
+    async def test_sqlite_cache_warm_load(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend = 'sqlite://{}/digests.db'.format(cache_dir)
+
+            writer = cache.create_cache(backend)
+            await writer.set(self.IMAGE, self.RESOLVED)
+
+            warm = cache.create_cache(backend)
+            await warm.load()
+            self.assertEqual(1, len(warm))
+            self.assertEqual(self.RESOLVED, await warm.get(self.IMAGE))
+
+            # Entries written by another process are found on local miss
+            await writer.set('quay.io/test/curl:3.2.2', self.RESOLVED)
+            self.assertEqual(self.RESOLVED, await warm.get('quay.io/test/curl:3.2.2'))
+            self.assertIsNone(await warm.get('quay.io/test/curl:3.2.3'))
+
+            for digest_cache in (writer, warm):
+                await digest_cache.close()
+
+    async def test_sqlite_cache_set_many(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend = 'sqlite://{}/digests.db'.format(cache_dir)
+            tags = {'quay.io/test/curl:{}'.format(tag): self.RESOLVED for tag in range(100)}
+
+            writer = cache.create_cache(backend)
+            with mock.patch.object(writer, 'set') as set_one:
+                self.assertEqual(100, len(await writer.set_many(tags)))
+            self.assertFalse(set_one.called)
+
+            warm = cache.create_cache(backend)
+            await warm.load()
+            self.assertEqual(100, len(warm))
+
+            for digest_cache in (writer, warm):
+                await digest_cache.close()
+
+    async def test_sqlite_cache_locked_is_miss(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            digest_cache = cache.create_cache('sqlite://{}/digests.db'.format(cache_dir))
+            await digest_cache.load()
+            locker = sqlite3.connect(os.path.join(cache_dir, 'digests.db'), isolation_level=None)
+            locker.execute('BEGIN EXCLUSIVE')
+            try:
+                with self.assertLogs('tag_resolver_proxy.resolve_tags.cache', 'WARNING'):
+                    await digest_cache.set(self.IMAGE, self.RESOLVED)
+                    self.assertIsNone(await digest_cache.get('quay.io/test/curl:3.2.2'))
+                self.assertEqual(self.RESOLVED, await digest_cache.get(self.IMAGE))
+            finally:
+                locker.close()
+                await digest_cache.close()
+
+    async def test_http_cache_shared(self):
+        store = {}
+
+        async def get_digest(request):
+            if request.match_info['image'] not in store:
+                raise web.HTTPNotFound()
+            return web.Response(text=store[request.match_info['image']])
+
+        async def put_digest(request):
+            store[request.match_info['image']] = await request.text()
+            return web.Response(status=204)
+
+        store_app = web.Application()
+        store_app.router.add_get('/digests/{image}', get_digest)
+        store_app.router.add_put('/digests/{image}', put_digest)
+        server = await self.loop.create_server(store_app.make_handler(), '127.0.0.1', self.PORT)
+
+        writer = cache.create_cache('http://127.0.0.1:{}/digests'.format(self.PORT))
+        reader = cache.create_cache('http://127.0.0.1:{}/digests'.format(self.PORT))
+        try:
+            await writer.set(self.IMAGE, self.RESOLVED)
+            self.assertEqual({'resolved': self.RESOLVED, 'expires_at': None}, json.loads(store[self.IMAGE]))
+            self.assertEqual(self.RESOLVED, await reader.get(self.IMAGE))
+            self.assertIsNone(await reader.get('quay.io/test/curl:3.2.2'))
+        finally:
+            await writer.close()
+            await reader.close()
+            server.close()
+            await server.wait_closed()
+
+        # Unavailable store is a cache miss
+        self.assertIsNone(await reader.get('quay.io/test/curl:3.2.2'))
+        await reader.close()
+
+    async def test_resolver_reads_cache(self):
+        resolver = TagResolverBaseTest.NoopTagResolver(None)
+        await resolver.tag_digest_cache.set(self.IMAGE, self.RESOLVED)
+
+        with mock.patch.object(resolver, 'resolve_single_image') as resolve_single_image:
+            self.assertEqual(self.RESOLVED, await resolver.resolve_tags(base.ResolverMeta.for_image_url(self.IMAGE)))
+
+        self.assertFalse(resolve_single_image.called)
+
+    async def test_lru_eviction(self):
+        digest_cache = cache.MemoryDigestCache(max_entries=2)
+        for tag in ('1', '2'):
+            await digest_cache.set('quay.io/test/curl:' + tag, self.RESOLVED)
+        await digest_cache.get('quay.io/test/curl:1')
+        await digest_cache.set('quay.io/test/curl:3', self.RESOLVED)
+
+        self.assertIsNone(await digest_cache.get('quay.io/test/curl:2'))
+        self.assertEqual(self.RESOLVED, await digest_cache.get('quay.io/test/curl:1'))
+        self.assertEqual(2, len(digest_cache))
+        self.assertEqual({'hits': 2, 'negative_hits': 0, 'stale_hits': 0, 'misses': 1,
+                          'expirations': 0, 'evictions': 1},
+                         dict(digest_cache.stats))
+
+        digest_cache.max_bytes = digest_cache.size_bytes // 2
+        await digest_cache.set('quay.io/test/curl:4', self.RESOLVED)
+        self.assertEqual(1, len(digest_cache))
+
+    async def test_ttl_expiry(self):
+        digest_cache = cache.MemoryDigestCache(ttl=60, negative_ttl=5, jitter=0.1)
+        with mock.patch('time.time', return_value=1000):
+            await digest_cache.set(self.IMAGE, self.RESOLVED)
+            await digest_cache.set_error('quay.io/test/curl:broken', 'Unknown image')
+        with mock.patch('time.time', return_value=1005.5):
+            self.assertEqual(self.RESOLVED, await digest_cache.get(self.IMAGE))
+            self.assertIsNone(await digest_cache.get_entry('quay.io/test/curl:broken'))
+        with mock.patch('time.time', return_value=1066.5):
+            self.assertIsNone(await digest_cache.get(self.IMAGE))
+        self.assertEqual(2, digest_cache.stats['expirations'])
+
+    async def test_resolver_caches_failures(self):
+        resolver = TagResolverBaseTest.NoopTagResolver(None)
+        image_props = base.ResolverMeta.for_image_url(self.IMAGE)
+
+        with mock.patch.object(resolver, 'resolve_single_image', side_effect=AssertionError('Unknown image')) \
+                as resolve_single_image:
+            for _ in range(2):
+                with self.assertRaisesRegex(AssertionError, 'Unknown image'):
+                    await resolver.resolve_tags(image_props)
+
+        self.assertEqual(1, resolve_single_image.call_count)
+        self.assertEqual(1, resolver.tag_digest_cache.stats['negative_hits'])
+
+    async def test_resolver_connection_failures_not_cached(self):
+        resolver = TagResolverBaseTest.NoopTagResolver(None)
+        image_props = base.ResolverMeta.for_image_url(self.IMAGE)
+
+        with mock.patch.object(resolver, 'resolve_single_image', side_effect=client.ServerDisconnectedError()) \
+                as resolve_single_image:
+            for _ in range(2):
+                with self.assertRaisesRegex(base.RegistryUnavailable, 'Can not retrieve docker image digest'):
+                    await resolver.resolve_tags(image_props)
+
+        self.assertEqual(2, resolve_single_image.call_count)
+        self.assertEqual(0, len(resolver.tag_digest_cache))
+
+
+class SingleFlightTest(KritisTest):
+
+    IMAGE = 'quay.io/test/curl:3.2.1'
+
+    class GatedTagResolver(base.TagResolver):
+
+        registry_base_uri = None
+
+        def __init__(self, error=None, **limits):
+            super().__init__(None, **limits)
+            self.gate = asyncio.Event()
+            self.error = error
+            self.lookups = 0
+
+        async def resolve_single_image(self, image_properties: base.ImageProperties) -> str:
+            self.lookups += 1
+            await self.gate.wait()
+            if self.error:
+                raise self.error
+            return 'quay.io/test/curl@sha256:1'
+
+    def _lookups(self, resolver, count):
+        with self._replace_resolvermeta_resolvers({'quay.io': resolver}):
+            image_props = base.ResolverMeta.for_image_url(self.IMAGE)
+            return [asyncio.ensure_future(resolver.resolve_tags(image_props)) for _ in range(count)]
+
+    async def test_burst_shares_result(self):
+        resolver = SingleFlightTest.GatedTagResolver()
+        lookups = self._lookups(resolver, 10)
+        await asyncio.sleep(0.01)
+        self.assertEqual(1, len(resolver.tags_inflight))
+        resolver.gate.set()
+        self.assertEqual(['quay.io/test/curl@sha256:1'] * 10, await asyncio.gather(*lookups))
+        self.assertEqual(1, resolver.lookups)
+        self.assertEqual(0, len(resolver.tags_inflight))
+
+    async def test_burst_shares_error(self):
+        resolver = SingleFlightTest.GatedTagResolver(client.ClientConnectionError('Connection refused'))
+        lookups = self._lookups(resolver, 10)
+        await asyncio.sleep(0.01)
+        resolver.gate.set()
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+        self.assertEqual(1, resolver.lookups)
+        self.assertTrue(all(isinstance(result, base.RegistryUnavailable) for result in results))
+
+    async def test_timeout_and_cancellation_keep_shared_lookup(self):
+        resolver = SingleFlightTest.GatedTagResolver(lookup_timeout=0.05)
+        cancelled, timed_out = self._lookups(resolver, 2)
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        with self.assertRaisesRegex(AssertionError, 'Timed out resolving tag'):
+            await timed_out
+        self.assertEqual(1, len(resolver.tags_inflight))
+
+        waiting, = self._lookups(resolver, 1)
+        await asyncio.sleep(0.01)
+        resolver.gate.set()
+        self.assertEqual('quay.io/test/curl@sha256:1', await waiting)
+        self.assertEqual(1, resolver.lookups)
+
+    async def test_deadline_keeps_shared_lookup(self):
+        resolver = SingleFlightTest.GatedTagResolver(lookup_timeout=10)
+        with self._replace_resolvermeta_resolvers({'quay.io': resolver}):
+            image_props = base.ResolverMeta.for_image_url(self.IMAGE)
+            with self.assertRaisesRegex(deadlines.DeadlineExceeded, 'resolving tag for quay.io/test/curl:3.2.1'):
+                await resolver.resolve_tags(image_props, self.loop.time() + 0.02)
+        self.assertEqual(1, len(resolver.tags_inflight))
+        resolver.gate.set()
+
+
+class StaleDigestTest(KritisTest):
+
+    IMAGE = 'quay.io/test/curl:3.2.1'
+
+    class FlakyTagResolver(base.TagResolver):
+
+        registry_base_uri = None
+
+        def __init__(self):
+            super().__init__(None)
+            self.digests = ['quay.io/test/curl@sha256:1', 'quay.io/test/curl@sha256:2']
+            self.failing = False
+
+        async def resolve_single_image(self, image_properties: base.ImageProperties) -> str:
+            await asyncio.sleep(0)
+            assert not self.failing, 'Registry is down'
+            return self.digests.pop(0)
+
+    def _resolver(self, **windows):
+        resolver = StaleDigestTest.FlakyTagResolver()
+        resolver.tag_digest_cache = cache.MemoryDigestCache(ttl=10, jitter=0, **windows)
+        return resolver
+
+    async def _resolve_at(self, resolver, now):
+        with mock.patch('time.time', return_value=now):
+            with self._replace_resolvermeta_resolvers({'quay.io': resolver}):
+                return await resolver.resolve_tags(base.ResolverMeta.for_image_url(self.IMAGE))
+
+    async def test_stale_while_revalidate(self):
+        resolver = self._resolver(stale_while_revalidate=60)
+        now = time.time()
+        self.assertEqual('quay.io/test/curl@sha256:1', await self._resolve_at(resolver, now))
+
+        self.assertEqual('quay.io/test/curl@sha256:1', await self._resolve_at(resolver, now + 20))
+        self.assertEqual(1, len(resolver.revalidations))
+        with mock.patch('time.time', return_value=now + 20):
+            await asyncio.gather(*resolver.revalidations)
+        self.assertEqual('quay.io/test/curl@sha256:2', await self._resolve_at(resolver, now + 21))
+
+        with self.assertRaisesRegex(AssertionError, 'Registry is down'):
+            resolver.failing = True
+            await self._resolve_at(resolver, now + 120)
+
+    async def test_stale_if_error(self):
+        resolver = self._resolver(stale_if_error=60)
+        refresh_failures = base.DIGEST_REFRESH_FAILURES.labels('quay.io')
+        failures = refresh_failures.value
+        now = time.time()
+        await self._resolve_at(resolver, now)
+
+        resolver.failing = True
+        self.assertEqual('quay.io/test/curl@sha256:1', await self._resolve_at(resolver, now + 20))
+        self.assertEqual(failures + 1, refresh_failures.value)
+        self.assertEqual(0, len(resolver.revalidations))
+
+        resolver.failing = False
+        self.assertEqual('quay.io/test/curl@sha256:2', await self._resolve_at(resolver, now + 30))
+
+
+class DockerTokenCacheTest(asynctest.TestCase):
+
+    def _resolver(self, **token_response):
+        resolver = docker_io.DockerIOTagResolver(None)
+        response = mock.Mock()
+        response.json = mock.CoroutineMock(return_value=token_response)
+        resolver.client = mock.Mock()
+        resolver.client.get = mock.CoroutineMock(return_value=response)
+        return resolver
+
+    def _image(self, image='docker.io/calico/node:v3.14.0'):
+        return base.ResolverMeta.for_image_url(image)
+
+    async def test_token_cached_per_scope(self):
+        resolver = self._resolver(token='secret', expires_in=300)
+
+        tokens = await asyncio.gather(*(resolver.ensure_docker_io_temporary_token(self._image()) for _ in range(5)))
+        await resolver.ensure_docker_io_temporary_token(self._image('docker.io/calico/node:v3.15.0'))
+
+        self.assertEqual(['secret'] * 5, tokens)
+        self.assertEqual(1, resolver.client.get.call_count)
+
+        await resolver.ensure_docker_io_temporary_token(self._image('docker.io/calico/cni:v3.14.0'))
+        self.assertEqual(2, resolver.client.get.call_count)
+
+    async def test_token_refreshed_ahead_of_expiry(self):
+        resolver = self._resolver(token='secret', expires_in=300, issued_at='2020-05-14T12:00:00.123456789Z')
+        issued_at = docker_io.parse_issued_at('2020-05-14T12:00:00.123456Z')
+
+        with mock.patch('time.time', return_value=issued_at + 1):
+            await resolver.ensure_docker_io_temporary_token(self._image())
+        self.assertEqual(issued_at + 300, resolver.scope_tokens['repository:calico/node:pull'][1])
+
+        # Still valid token is returned while a refresh runs in background
+        with mock.patch('time.time', return_value=issued_at + 290):
+            self.assertEqual('secret', await resolver.ensure_docker_io_temporary_token(self._image()))
+            await asyncio.gather(*resolver.scope_token_fetches.values())
+        self.assertEqual(2, resolver.client.get.call_count)
+
+        # Expired token is never returned
+        resolver.client.get.return_value.json.return_value = {'token': 'rotated'}
+        with mock.patch('time.time', return_value=issued_at + 1000):
+            self.assertEqual('rotated', await resolver.ensure_docker_io_temporary_token(self._image()))
+
+
+class RegistrySchedulerTest(asynctest.TestCase):
+
+    async def test_concurrency_limit(self):
+        registry = scheduler.RegistryScheduler(max_requests=2)
+        running = []
+
+        async def request():
+            async with registry.slot():
+                running.append(registry.active)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(request() for _ in range(5)))
+        self.assertEqual(2, max(running))
+        self.assertEqual((0, 0), (registry.active, registry.queued))
+
+    async def test_rate_limit(self):
+        registry = scheduler.RegistryScheduler(rate=100, burst=1)
+        started = time.monotonic()
+        for _ in range(5):
+            async with registry.slot():
+                pass
+        self.assertGreaterEqual(time.monotonic() - started, 0.035)
+
+    async def test_cancelled_wakeup_passed_on(self):
+        registry = scheduler.RegistryScheduler(max_requests=1)
+        await registry.acquire()
+        first = asyncio.ensure_future(registry.acquire())
+        second = asyncio.ensure_future(registry.acquire())
+        await asyncio.sleep(0)
+        registry.release()
+        # Woken up, but cancelled before taking the slot
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        self.assertTrue(first.cancelled())
+        self.assertEqual((1, 0), (registry.active, registry.queued))
+
+    async def test_released_slot_handed_to_oldest_waiter(self):
+        registry = scheduler.RegistryScheduler(max_requests=1)
+        await registry.acquire()
+        admitted = []
+
+        async def request(name):
+            async with registry.slot():
+                admitted.append(name)
+
+        queued = asyncio.ensure_future(request('queued'))
+        await asyncio.sleep(0)
+        registry.release()
+        # Arrives after the slot was freed, but before the queued request got to run
+        await request('newcomer')
+        await queued
+        self.assertEqual(['queued', 'newcomer'], admitted)
+        self.assertEqual((0, 0), (registry.active, registry.queued))
+
+    def test_throttled_backoff(self):
+        registry = scheduler.RegistryScheduler(rate=100)
+        self.assertEqual(2, registry.throttled('2'))
+        self.assertEqual(50, registry.rate)
+        self.assertEqual(1, registry.throttled(None))
+        self.assertEqual(2, registry.throttled(None))
+        self.assertEqual(12.5, registry.rate)
+        registry.succeeded()
+        self.assertEqual(17.5, registry.rate)
+        self.assertEqual(registry.initial_backoff, registry.backoff)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, scheduler.parse_retry_after('120'))
+        self.assertEqual(30, scheduler.parse_retry_after('Thu, 14 May 2020 12:00:30 GMT',
+                                                         now=1589457600))
+        self.assertIsNone(scheduler.parse_retry_after('soon'))
+
+
+class QuayResolveModeTest(KritisTest):
+
+    async def setUp(self):
+        self.fake_quay = fakes.FakeQuay(tags_per_repository=10)
+        self.runner, self.api_base_uri = await fakes.serve(self.fake_quay.app())
+
+    async def tearDown(self):
+        await self.runner.cleanup()
+
+    def _resolver(self, mode, **options):
+        resolver = quay_io.QuayIOTagResolver(None, resolve_mode=mode, **options)
+        resolver.api_base_uri = self.api_base_uri
+        return resolver
+
+    async def _resolve(self, mode, image):
+        resolver = self._resolver(mode)
+        resolver.ensure_client()
+        try:
+            return await resolver.resolve_single_image(base.ResolverMeta.for_image_url(image))
+        finally:
+            await resolver.client.close()
+
+    async def test_single_tag_lookup(self):
+        for mode, requests in (('tag', 1), ('manifest', 2), ('repository', 1)):
+            self.fake_quay.requests = 0
+            self.assertEqual('quay.io/test/curl@' + fakes.fake_digest('test/curl', '1.0.3'),
+                             await self._resolve(mode, 'quay.io/test/curl:1.0.3'))
+            self.assertEqual(requests, self.fake_quay.requests, mode)
+
+    async def test_throttled_lookup_retried(self):
+        self.fake_quay.throttle = 1
+        self.fake_quay.retry_after = '0.01'
+        resolver = self._resolver('tag')
+        image = base.ResolverMeta.for_image_url('quay.io/test/curl:1.0.3')
+        try:
+            self.assertEqual('quay.io/test/curl@' + fakes.fake_digest('test/curl', '1.0.3'),
+                             await resolver.resolve_tags(image))
+        finally:
+            await resolver.client.close()
+        self.assertEqual(2, self.fake_quay.requests)
+        self.assertEqual(1, resolver.scheduler.stats['throttled'])
+
+    async def test_throttled_lookup_not_cached(self):
+        self.fake_quay.throttle = 1
+        self.fake_quay.retry_after = '60'
+        resolver = self._resolver('tag')
+        image = base.ResolverMeta.for_image_url('quay.io/test/curl:1.0.3')
+        try:
+            with self.assertRaisesRegex(AssertionError, 'quay.io throttled request with HTTP 429, retry after 60'):
+                await resolver.resolve_tags(image)
+        finally:
+            await resolver.client.close()
+        self.assertIsNone(await resolver.tag_digest_cache.get_entry(image.url))
+
+    async def test_throttled_attempts_bounded(self):
+        self.fake_quay.throttle = 100
+        self.fake_quay.retry_after = '0'
+        resolver = self._resolver('tag')
+        image = base.ResolverMeta.for_image_url('quay.io/test/curl:1.0.3')
+        try:
+            with self.assertRaisesRegex(AssertionError, 'quay.io throttled request 5 times in a row'):
+                await resolver.resolve_tags(image)
+        finally:
+            await resolver.client.close()
+        self.assertEqual(resolver.max_throttle_attempts, self.fake_quay.requests)
+
+    async def test_manifest_token_per_repository(self):
+        resolver = self._resolver('manifest')
+        try:
+            for tag in ('1.0.1', '1.0.2', '1.0.3'):
+                await resolver.resolve_single_image(base.ResolverMeta.for_image_url(f'quay.io/test/curl:{tag}'))
+        finally:
+            await resolver.client.close()
+        self.assertEqual(4, self.fake_quay.requests)
+
+    async def test_unknown_tag(self):
+        for mode in ('tag', 'manifest'):
+            self.fake_quay.requests = 0
+            with self.assertRaisesRegex(AssertionError, 'Unknown image quay.io/test/curl:2.0.0'):
+                await self._resolve(mode, 'quay.io/test/curl:2.0.0')
+            self.assertEqual({'tag': 1, 'manifest': 3}[mode], self.fake_quay.requests)
+
+    async def test_prefetch_repository_listing(self):
+        resolver = self._resolver('repository', prefetch=True)
+
+        with self._replace_resolvermeta_resolvers({'quay.io': resolver}):
+            self.assertEqual('quay.io/test/curl@' + fakes.fake_digest('test/curl', '1.0.3'),
+                             await resolver.resolve_tags(base.ResolverMeta.for_image_url('quay.io/test/curl:1.0.3')))
+            self.assertEqual(10, len(resolver.tag_digest_cache))
+            self.assertEqual('quay.io/test/curl@' + fakes.fake_digest('test/curl', '1.0.7'),
+                             await resolver.resolve_tags(base.ResolverMeta.for_image_url('quay.io/test/curl:1.0.7')))
+        await resolver.client.close()
+        self.assertEqual(1, self.fake_quay.requests)
+
+    async def test_startup_warm_up(self):
+        resolver = self._resolver('tag')
+
+        with tempfile.NamedTemporaryFile('w') as images_file, \
+                self._replace_resolvermeta_resolvers({'quay.io': resolver}):
+            images_file.write('quay.io/test/curl:1.0.1 quay.io/test/sleep:1.0.2\nquay.io/test/curl:9.9.9')
+            images_file.flush()
+
+            await warm.warmer(['quay.io/test/proxy', 'quay.io/test'], images_file.name, 8, 10)()
+        await resolver.client.close()
+
+        self.assertEqual(10 + 2 + 1, len(resolver.tag_digest_cache))
+        self.assertEqual('quay.io/test/sleep@' + fakes.fake_digest('test/sleep', '1.0.2'),
+                         await resolver.tag_digest_cache.get('quay.io/test/sleep:1.0.2'))
+        self.assertIsNone(await resolver.tag_digest_cache.get('quay.io/test/curl:9.9.9'))
+
+
+class OCIDistributionTagResolverTest(KritisTest):
+
+    IMAGE = 'registry.test:5000/team/group/app:1.0'
+
+    async def _resolve(self, fake_registry, credentials=None, images=(IMAGE,)):
+        runner, api_base_uri = await fakes.serve(fake_registry.app())
+        with tempfile.NamedTemporaryFile('w') as credentials_file:
+            credentials_file.write(credentials or '')
+            credentials_file.flush()
+            resolver = oci.OCIDistributionTagResolver(
+                'registry.test:5000', credentials_file.name if credentials else None, api_base_uri=api_base_uri)
+        try:
+            with self._replace_resolvermeta_resolvers({'registry.test:5000': resolver}):
+                return [await resolver.resolve_single_image(base.ResolverMeta.for_image_url(image)) for image in images]
+        finally:
+            await resolver.client.close()
+            await runner.cleanup()
+
+    def _digest(self, repository, tag):
+        return 'sha256:' + hashlib.sha256(fakes.FakeOCIRegistry.manifest_body(repository, tag)).hexdigest()
+
+    async def test_bearer_challenge(self):
+        fake_registry = fakes.FakeOCIRegistry(auth='bearer', credentials='user:secret')
+        resolved = await self._resolve(fake_registry, 'user:secret', [self.IMAGE, self.IMAGE])
+        self.assertEqual(['registry.test:5000/team/group/app@' + self._digest('team/group/app', '1.0')] * 2, resolved)
+        self.assertEqual({'HEAD': 3, 'token': 1}, fake_registry.requests)
+
+    async def test_basic_challenge(self):
+        fake_registry = fakes.FakeOCIRegistry(auth='basic', credentials='user:secret')
+        self.assertEqual(['registry.test:5000/team/group/app@' + self._digest('team/group/app', '1.0')],
+                         await self._resolve(fake_registry, 'user:secret'))
+        with self.assertRaisesRegex(AssertionError, 'No credentials for registry.test:5000'):
+            await self._resolve(fake_registry)
+
+    async def test_digest_of_manifest_without_header(self):
+        fake_registry = fakes.FakeOCIRegistry(digest_header=False)
+        self.assertEqual(['registry.test:5000/team/group/app@' + self._digest('team/group/app', '1.0')],
+                         await self._resolve(fake_registry))
+        self.assertEqual({'HEAD': 1, 'GET': 1}, fake_registry.requests)
+
+    async def test_unknown_image(self):
+        with self.assertRaisesRegex(AssertionError, 'Unknown image registry.test:5000/app:missing'):
+            await self._resolve(fakes.FakeOCIRegistry(auth='bearer'), images=['registry.test:5000/app:missing'])
+
+    async def test_registry_pool_prewarmed_and_reused(self):
+        runner, api_base_uri = await fakes.serve(fakes.FakeOCIRegistry().app())
+        resolver = oci.OCIDistributionTagResolver('registry.test:5000', api_base_uri=api_base_uri,
+                                                  pool_options={'limit': 4, 'dns_cache_ttl': 300})
+        created = connections.CONNECTIONS_CREATED.labels('registry:registry.test:5000')
+        reused = connections.CONNECTIONS_REUSED.labels('registry:registry.test:5000')
+        created_before, reused_before = created.value, reused.value
+        try:
+            with self._replace_resolvermeta_resolvers({'registry.test:5000': resolver}):
+                await prewarm_registries(connections=1)
+                self.assertEqual(created_before + 1, created.value)
+                self.assertEqual(4, resolver.client.connector.limit)
+
+                await resolver.resolve_single_image(base.ResolverMeta.for_image_url(self.IMAGE))
+                self.assertEqual((created_before + 1, reused_before + 1), (created.value, reused.value))
+
+                await close_registries()
+                self.assertIsNone(resolver.client)
+        finally:
+            await resolver.close()
+            await runner.cleanup()
+
+    def test_parse_challenge(self):
+        self.assertEqual(('bearer', {'realm': 'https://auth.test/token', 'service': 'registry.test',
+                                     'scope': 'repository:a/b:pull,push'}),
+                         oci.parse_challenge('Bearer realm="https://auth.test/token",service=registry.test,'
+                                             'scope="repository:a/b:pull,push"'))
+
+
 class QuayTagResolverTest(KritisTest):
     container_spec = {'name': 'sleep', 'image': 'quay.io/calico/node:v3.14.0-0.dev-55-g785f8b2',
                       'command': ['/bin/sleep', 'infinity'],
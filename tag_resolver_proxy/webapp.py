@@ -1,34 +1,90 @@
+import functools
 import ssl
 
 import aiohttp
 import aiohttp.client
 import aiohttp.web
 
+import tag_resolver_proxy.connections
+import tag_resolver_proxy.decisions
+import tag_resolver_proxy.metrics
+import tag_resolver_proxy.reload
 import tag_resolver_proxy.resolve_tags
+import tag_resolver_proxy.resolve_tags.warm
 import tag_resolver_proxy.reverse_proxy
 import tag_resolver_proxy.white_list
 
 
+async def prewarm_upstream(application: aiohttp.web.Application, connections: int):
+    if connections:
+        await tag_resolver_proxy.connections.prewarm(
+            application['client'], f'https://{application["upstream_uri"]}/', connections)
+
+
+async def close_upstream(application: aiohttp.web.Application):
+    await application['client'].close()
+
+
 def app(args) -> aiohttp.web.Application:
     """Construct reverse proxy web application."""
 
     ssl_ctx_client = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH, cafile=args.client_ca_cert_file)
     ssl_ctx_client.load_cert_chain(args.client_cert_file, args.client_key_file)
 
-    connector = aiohttp.TCPConnector(ssl_context=ssl_ctx_client)
-
-    kritis_client = aiohttp.client.ClientSession(connector=connector)
+    kritis_client = tag_resolver_proxy.connections.create_session(
+        'upstream',
+        ssl_context=ssl_ctx_client,
+        limit=args.upstream_pool_size,
+        limit_per_host=args.upstream_pool_per_host,
+        keepalive_timeout=args.upstream_keepalive,
+        connect_timeout=args.upstream_connect_timeout,
+        read_timeout=args.upstream_read_timeout,
+        total_timeout=args.upstream_timeout,
+    )
     kritis_client.verify = ssl_ctx_client
 
+    white_list_resolver = tag_resolver_proxy.white_list.ImageWhitelistResolver(
+        args.whitelist_registry or [], args.whitelist_file)
+
     application = aiohttp.web.Application(
         middlewares=[
             tag_resolver_proxy.reverse_proxy.webhook_middleware,
-            tag_resolver_proxy.white_list.create_middleware_from_white_list(args.whitelist_registry),
+            tag_resolver_proxy.white_list.create_middleware_from_white_list(white_list_resolver),
         ])
 
+    file_watcher = tag_resolver_proxy.reload.FileWatcher(args.reload_interval)
+    if args.whitelist_file:
+        file_watcher.watch(args.whitelist_file, white_list_resolver.reload)
+    for resolver in tag_resolver_proxy.resolve_tags.ResolverMeta.resolvers.values():
+        if resolver.token_file:
+            file_watcher.watch(resolver.token_file, resolver.reload_token)
+
     # Application state singletons
     application['client'] = kritis_client
     application['upstream_uri'] = args.upstream_uri
+    application['upstream_response_mode'] = args.upstream_response_mode
+    application['registry_concurrency'] = args.registry_concurrency
+    application['admission_timeout'] = args.admission_timeout
+    application['admission_timeout_margin'] = args.admission_timeout_margin
+    application['admission_timeout_action'] = args.admission_timeout_action
+    application['log_payload_sample_rate'] = args.log_payload_sample_rate
+    application['file_watcher'] = file_watcher
+    application['decision_cache'] = tag_resolver_proxy.decisions.DecisionCache(
+        args.decision_cache_max_entries, args.decision_cache_ttl) if args.decision_cache_ttl > 0 else None
+
+    application.on_startup.append(tag_resolver_proxy.resolve_tags.load_digest_caches)
+    application.on_startup.append(tag_resolver_proxy.resolve_tags.warm.warmer(
+        args.warm_repository, args.warm_images_file, args.registry_concurrency, args.warm_timeout))
+    application.on_startup.append(functools.partial(prewarm_upstream, connections=args.upstream_prewarm))
+    if args.registry_prewarm:
+        application.on_startup.append(functools.partial(
+            tag_resolver_proxy.resolve_tags.prewarm_registries, connections=args.registry_prewarm))
+    application.on_startup.append(tag_resolver_proxy.reload.start_file_watcher)
+    application.on_cleanup.append(tag_resolver_proxy.reload.stop_file_watcher)
+    application.on_cleanup.append(tag_resolver_proxy.resolve_tags.close_digest_caches)
+    application.on_cleanup.append(tag_resolver_proxy.resolve_tags.close_registries)
+    application.on_cleanup.append(close_upstream)
 
     application.router.add_post('/', tag_resolver_proxy.reverse_proxy.webhook_handler)
+    application.router.add_get('/metrics', tag_resolver_proxy.metrics.metrics_handler)
     return application
@@ -1,55 +1,134 @@
 """Image whitelist helper."""
 import logging
+import time
+import typing
 
 import aiohttp.web
 
+from tag_resolver_proxy import metrics
+from tag_resolver_proxy import payload
 from tag_resolver_proxy import process
 
 
 logger = logging.getLogger(__name__)
 
+# Trie node key marking a whitelisted repository, holding its whitelist entry
+WHITELISTED = None
 
-class ImageWhitelistResolver:
-    """Checks all images in deployment/pod spec.
 
-    If all images belong to whitelisted repository, allows deployment.
-    """
+def read_white_list_file(path: str) -> list:
+    """Whitelisted repositories listed one per line, ignoring blank lines and # comments."""
+    with open(path) as white_list_file:
+        lines = (line.partition('#')[0].strip() for line in white_list_file)
+        return [line for line in lines if line]
 
-    def __init__(self, white_list):
-        self._white_list = white_list
-        self._all_whitelisted = None
 
-    async def is_whitelisted(self, container_spec):
-        """Finds out if all the images in request payload are whitelisted."""
+def image_segments(image: str) -> list:
+    """Path segments of image repository, without tag or digest."""
+    segments = image.split('/')
+    segments[-1] = segments[-1].partition('@')[0].partition(':')[0]
+    return segments
 
-        image = container_spec["image"]
 
-        for repository in self._white_list:
-            if image.startswith(repository):
-                logger.warning('Image {} belongs to whitelisted '
-                               'repository {}'.format(image, repository))
-                whitelisted = True
-                break
-        else:
-            whitelisted = False
+def digest_reference(image: str) -> str:
+    """Reference of image pinned by digest without its tag, which is ignored when pulling by digest."""
+    name, _, digest = image.partition('@')
+    repository, slash, last_segment = name.rpartition('/')
+    return f'{repository}{slash}{last_segment.partition(":")[0]}@{digest}'
 
-        self._all_whitelisted = (self._all_whitelisted in (None, True)) and whitelisted
 
-    @property
-    def all_images_whitelisted(self) -> bool:
-        return bool(self._all_whitelisted)
+class ImageWhitelistResolver:
+    """Checks all images in deployment/pod spec.
 
+    Whitelisted repositories are compiled into a trie of path segments, so an
+    image is checked in time proportional to its number of path segments,
+    whatever the whitelist size. A repository whitelists the images under it:
+    ``docker.io/org`` matches ``docker.io/org/software:tag`` but not
+    ``docker.io/organization/software:tag``.
+
+    Entries with a tag or digest whitelist that exact reference, looked up in a
+    set: ``quay.io/org/app:1.2`` matches only ``quay.io/org/app:1.2``. Images
+    pinned by digest are pulled by it whatever their tag, so they match only
+    entries with the same digest.
+    Repositories listed in `white_list_file` are added to `white_list` ones,
+    and swapped in on `reload`.
+    """
 
-def create_middleware_from_white_list(white_list):
+    def __init__(self, white_list, white_list_file: str = None):
+        self._white_list = list(white_list)
+        self._white_list_file = white_list_file
+        self._trie, self._references = self.compile(self._white_list + self.read_file())
+
+    @staticmethod
+    def compile(white_list) -> typing.Tuple[dict, frozenset]:
+        """Trie of whitelisted repositories and set of whitelisted image references."""
+        trie, references = {}, set()
+        for repository in white_list:
+            segments = repository.strip('/').split('/')
+            # A single segment may be a registry with port, e.g. localhost:5000
+            if len(segments) > 1 and segments[-1] != image_segments(repository.strip('/'))[-1]:
+                reference = repository.strip('/')
+                references.add(digest_reference(reference) if '@' in reference else reference)
+                continue
+            node = trie
+            for segment in segments:
+                node = node.setdefault(segment, {})
+            node[WHITELISTED] = repository
+        return trie, frozenset(references)
+
+    def read_file(self) -> list:
+        return read_white_list_file(self._white_list_file) if self._white_list_file else []
+
+    def reload(self):
+        """Re-read whitelist file, keeping previous whitelist if it can not be read."""
+        try:
+            white_list = self._white_list + self.read_file()
+        except OSError as exc:
+            logger.warning('Keeping previous whitelist, can not read %s: %r', self._white_list_file, exc)
+            return
+        self._trie, self._references = self.compile(white_list)
+        logger.info('Reloaded whitelist of %d repositories from %s', len(white_list), self._white_list_file)
+
+    def is_whitelisted(self, image: str) -> bool:
+        """Finds out if image is whitelisted or belongs to a whitelisted repository."""
+        if (digest_reference(image) if '@' in image else image) in self._references:
+            logger.debug('Image %s is whitelisted', image)
+            return True
+        node = self._trie
+        for segment in image_segments(image):
+            node = node.get(segment)
+            if node is None:
+                return False
+            if WHITELISTED in node:
+                logger.debug('Image %s belongs to whitelisted repository %s', image, node[WHITELISTED])
+                return True
+        return False
+
+    def all_images_whitelisted(self, request_payload) -> bool:
+        """Finds out if all the images in request payload are whitelisted, stopping at the first one which is not."""
+        if not self._trie and not self._references:
+            return False
+        images = 0
+        for container_spec in process.container_specs(request_payload):
+            if not self.is_whitelisted(container_spec['image']):
+                return False
+            images += 1
+        return images > 0
+
+
+def create_middleware_from_white_list(white_list_resolver: ImageWhitelistResolver):
     """Construct a middleware to check for white listed images."""
 
-    white_list_resolver = ImageWhitelistResolver(white_list or [])
-
     @aiohttp.web.middleware
     async def whitelist_middleware(request: aiohttp.web.Request, handler) -> aiohttp.web.Response:
-        request_payload = await request.json()
-        await process.process_spec(request_payload, white_list_resolver.is_whitelisted)
-        if white_list_resolver.all_images_whitelisted:
+        if request.method != 'POST':
+            return await handler(request)
+        request_payload = (await payload.admission_payload(request)).data
+        started = time.perf_counter()
+        all_whitelisted = white_list_resolver.all_images_whitelisted(request_payload)
+        metrics.observe_stage(request, 'whitelist', started)
+        if all_whitelisted:
+            request['decision'] = 'allow'
             response = aiohttp.web.json_response(text=process.response_allow(
                 request_payload, msg='All images whitelisted'))
         else: